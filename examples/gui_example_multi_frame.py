@@ -39,6 +39,11 @@ from cas_gui.threads.image_processor_class import ImageProcessorClass
 class AverageProcessor(ImageProcessorClass):  
     """ We subclass ImageProcessorClass to create a custom image processor.
     """
+    
+    # Ask for batches of shape (n, h, w), keeping the dtype of the raw
+    # images rather than converting them to float
+    batchLayout = ImageProcessorClass.FRAMES_FIRST
+    batchDtype = None
        
     def __init__(self):
         """ Technically not needed since we are not adding anything, but
@@ -53,7 +58,7 @@ class AverageProcessor(ImageProcessorClass):
         
         # If we have a stack of frames, take the average
         if inputFrame.ndim == 3:
-            outputFrame = np.mean(inputFrame, 2)
+            outputFrame = np.mean(inputFrame, 0)
         else:
             outputFrame = inputFrame
         
@@ -14,11 +14,13 @@ provide further functionality.
 
 import sys 
 import os
+import copy
 import inspect
 from threading import Lock
 from pathlib import Path
 import time
 from datetime import datetime
+from contextlib import nullcontext
 import math
 import multiprocessing as mp
 
@@ -45,6 +47,15 @@ from cas_gui.widgets.double_slider import DoubleSlider
 from cas_gui.threads.image_acquisition_thread import ImageAcquisitionThread
 from cas_gui.widgets.image_display import ImageDisplay
 from cas_gui.threads.image_processor_thread import ImageProcessorThread
+from cas_gui.threads.image_processor_class import ImageProcessorClass
+from cas_gui.threads.shared_frame_buffer import SharedFrameBuffer
+from cas_gui.threads.recorder_thread import RecorderThread, TriggeredRecorderThread
+from cas_gui.threads.circular_frame_buffer import CircularFrameBuffer
+from cas_gui.utils.pipeline_metrics import PipelineMetrics
+from cas_gui.utils.recorders import TifRecorder, VideoRecorder, RawStreamRecorder, ChunkedRecorder, to_video_frame
+from cas_gui.utils.compression import available_codecs
+from cas_gui.utils.frame_cache import FrameCache
+from cas_gui.batch_engine import BatchEngine
 import cas_gui.res.resources
 from cas_gui.cameras.FileInterface import FileInterface
 from cas_gui.utils.im_tools import to8bit, to16bit
@@ -61,6 +72,8 @@ class CAS_GUI(QMainWindow):
     SIM_TYPE = 2
     TIF = 0
     AVI = 1
+    RAW_STREAM = 2
+    CHUNKED = 3
     REG = 0    
     INI = 1
    
@@ -88,9 +101,14 @@ class CAS_GUI(QMainWindow):
     fallBackToRaw = True      # True to display raw images if no processed images
     multiCore = False         # True to run processing on a different core
     sharedMemory = False      # True to use shared memory to transfer processed image when using multiCore
+    multiCoreWorkers = 1      # Number of processes to use for processing when using multiCore
     showInfoBar = True        # True to show bar at bottom of screen
+    showMetrics = False       # True to show timings of each pipeline stage in the camera status panel
+    renderDisplayInThread = False   # True to prepare images for display in a separate thread, see ImageDisplay
     defaultBackgroundFile = "background.tif"
-    sharedMemoryArraySize = (2048,2048)
+    sharedMemoryArraySize = (2048,2048)   # No longer used, shared memory is sized from the processed images
+    sharedInputMemory = False # True to pass raw images to the processor via a shared memory ring buffer
+    sharedInputMemoryFrameBytes = 2048 * 2048 * 2   # Largest raw image (in bytes) when using sharedInputMemory
 
     # Default source for simulated camera
     sourceFilename = os.path.abspath(os.path.join(os.path.dirname(__file__), 'example_data/vid_example.tif'))
@@ -99,6 +117,34 @@ class CAS_GUI(QMainWindow):
     # then the oldest image will be removed.
     rawImageBufferSize = 10
     
+    # Number of preallocated buffers which are reused for raw images, for 
+    # cameras which can write images into them. Buffers are in use until all
+    # references to an image are released, if all are in use a new array is
+    # allocated. 0 to always allocate a new array.
+    framePoolSize = 16
+    
+    # The size of the queue of images waiting to be written to file when 
+    # recording (not buffered). If this is exceeded then images are dropped.
+    recordQueueSize = 100
+    
+    # Codecs which can be chosen for video recording. FFV1 is lossless and 
+    # records 16 bit monochrome images without conversion.
+    videoCodecs = {"MJPEG (8 bit)": "MJPG", "FFV1 (lossless 16 bit)": "FFV1"}
+    
+    # Maximum number of raw images, and maximum memory in bytes, held by the 
+    # pre-trigger buffer. The buffer holds the most recent images so that
+    # a recording can include images from before it was started.
+    preTriggerBufferSize = 1000
+    preTriggerBufferMemory = 1024**3
+    
+    # Maximum memory in bytes used to keep processed images from a file, so
+    # that returning to an image does not process it again unless the 
+    # processor has changed. 0 to always process images.
+    processedCacheBytes = 256 * 1024**2
+    
+    # Number of processes used by Process Whole File, 0 for one per CPU
+    processFileWorkers = 0
+    
     # GUI display defaults
     imageDisplaySize = 300
     menuPanelSize = 300
@@ -116,11 +162,14 @@ class CAS_GUI(QMainWindow):
     backgroundImage = None
     imageProcessor = None
     currentProcessedImage = None
+    currentProcessedFrame = None
     settings = {}  
     panelsList = []
     menuButtonsList = []
     recording = False
-    videoOut = None
+    recorderThread = None
+    batchEngine = None
+    preTriggerBuffer = None
     numFramesRecorded  = 0
     imageThread = None
     imageProcessor = None
@@ -139,6 +188,12 @@ class CAS_GUI(QMainWindow):
         
         super(CAS_GUI, self).__init__(parent)
         
+        # Timings, queue depths and dropped frames for each stage of the
+        # pipeline, shared with the acquisition and processing threads
+        self.metrics = PipelineMetrics()
+        self.processedCache = FrameCache(self.processedCacheBytes) if self.processedCacheBytes > 0 else None
+        self.processingSettingsVersion = 0
+        
         self.defaultIcon = os.path.join(self.resPath, self.iconFilename)
 
         self.recordFolder = os.path.join(Path.cwd().as_posix(), self.studyPath)
@@ -185,7 +240,10 @@ class CAS_GUI(QMainWindow):
         self.cam_source_changed()
         self.recordFolderLabel.setText(self.recordFolder)
         
-        self.inputQueue = mp.Queue(maxsize=self.rawImageBufferSize)
+        if self.sharedInputMemory:
+            self.inputQueue = SharedFrameBuffer(self.rawImageBufferSize, self.sharedInputMemoryFrameBytes)
+        else:    
+            self.inputQueue = mp.Queue(maxsize=self.rawImageBufferSize)
         self.create_processors()
         self.show()
         self.update_GUI()        
@@ -248,6 +306,10 @@ class CAS_GUI(QMainWindow):
         self.imageTimer=QTimer()
         self.imageTimer.timeout.connect(self.handle_images)
         
+        # Create timer for progress of processing a whole file
+        self.processFileTimer=QTimer()
+        self.processFileTimer.timeout.connect(self.update_process_file_status)
+        
         
     def create_layout(self):
         """ Assemble the GUI from Qt Widget. Overload this in subclass to
@@ -456,6 +518,37 @@ class CAS_GUI(QMainWindow):
         self.recordTifCheck = QCheckBox("Record Tif", objectName = "RecordTif")
         self.recordLayout.addWidget(self.recordTifCheck)
         
+        self.recordRawStreamCheck = QCheckBox("Record Raw Stream", objectName = "RecordRawStream")
+        self.recordRawStreamCheck.setToolTip("Record images unchanged to a .raw file with an index, for high frame rates")
+        self.recordLayout.addWidget(self.recordRawStreamCheck)
+        
+        self.recordChunkedCheck = QCheckBox("Record Compressed Chunks", objectName = "RecordChunked")
+        self.recordChunkedCheck.setToolTip("Record images losslessly compressed, with camera and processor settings, to a .chunks folder")
+        self.recordLayout.addWidget(self.recordChunkedCheck)
+        
+        self.recordTifCheck.stateChanged.connect(self.record_options_changed)
+        self.recordRawStreamCheck.stateChanged.connect(self.record_options_changed)
+        self.recordChunkedCheck.stateChanged.connect(self.record_options_changed)
+        
+        self.recordCodecCombo = QComboBox(objectName = "RecordCodec")
+        self.recordCodecCombo.addItems(self.videoCodecs.keys())
+        self.recordCodecLabel = QLabel("Video Codec:")
+        self.recordLayout.addWidget(self.recordCodecLabel)
+        self.recordLayout.addWidget(self.recordCodecCombo)
+        
+        self.recordCompressionCombo = QComboBox(objectName = "RecordCompression")
+        self.recordCompressionCombo.addItems(available_codecs())
+        self.recordCompressionLabel = QLabel("Compression:")
+        self.recordLayout.addWidget(self.recordCompressionLabel)
+        self.recordLayout.addWidget(self.recordCompressionCombo)
+        
+        self.recordThreadsSpin = QSpinBox(objectName = "RecordThreads")
+        self.recordThreadsSpin.setMaximum(os.cpu_count() or 1)
+        self.recordThreadsSpin.setToolTip("Number of threads used to encode video or compress chunks, 0 for automatic")
+        self.recordThreadsLabel = QLabel("Encoding Threads:")
+        self.recordLayout.addWidget(self.recordThreadsLabel)
+        self.recordLayout.addWidget(self.recordThreadsSpin)
+        
         self.recordBufferCheck = QCheckBox("Buffered", objectName = "RecordBuffered")
         self.recordLayout.addWidget(self.recordBufferCheck)
         self.recordBufferCheck.stateChanged.connect(self.record_options_changed)
@@ -466,6 +559,25 @@ class CAS_GUI(QMainWindow):
         self.recordLayout.addWidget(self.recordBufferSpin)
         self.recordBufferSpin.setMaximum(1000)
         
+        self.recordPreTriggerCheck = QCheckBox("Pre-Trigger", objectName = "RecordPreTrigger")
+        self.recordPreTriggerCheck.setToolTip("Keep the most recent raw images so that recordings start before 'Start Recording' is clicked")
+        self.recordLayout.addWidget(self.recordPreTriggerCheck)
+        self.recordPreTriggerCheck.stateChanged.connect(self.record_options_changed)
+        
+        self.recordPreTimeSpin = QDoubleSpinBox(objectName = "RecordPreTriggerTime")
+        self.recordPreTimeSpin.setMaximum(3600)
+        self.recordPreTimeSpin.setValue(5)
+        self.recordPreTimeLabel = QLabel("Seconds Before:")
+        self.recordLayout.addWidget(self.recordPreTimeLabel)
+        self.recordLayout.addWidget(self.recordPreTimeSpin)
+        
+        self.recordPostTimeSpin = QDoubleSpinBox(objectName = "RecordPostTriggerTime")
+        self.recordPostTimeSpin.setMaximum(3600)
+        self.recordPostTimeSpin.setToolTip("0 to record until 'Stop Recording' is clicked")
+        self.recordPostTimeLabel = QLabel("Seconds After:")
+        self.recordLayout.addWidget(self.recordPostTimeLabel)
+        self.recordLayout.addWidget(self.recordPostTimeSpin)
+        
         self.recordLayout.addItem(QSpacerItem(60, 60, QSizePolicy.Minimum, QSizePolicy.Minimum))
         
         self.recordFolderButton = QPushButton("Choose Folder")
@@ -613,6 +725,14 @@ class CAS_GUI(QMainWindow):
 
         inputFileLayout.addWidget(self.loadFileButton)
         
+        self.processFileButton = QPushButton('Process Whole File')
+        self.processFileButton.clicked.connect(self.process_file_button_clicked)
+        inputFileLayout.addWidget(self.processFileButton)
+        
+        self.processFileStatusLabel = QLabel()
+        self.processFileStatusLabel.setWordWrap(True)
+        inputFileLayout.addWidget(self.processFileStatusLabel)
+        
         self.fileIdxWidget = QWidget()
         self.fileIdxWidgetLayout = QVBoxLayout()
         self.fileIdxWidgetLayout.addWidget(QLabel("Frame No.:"))
@@ -661,6 +781,13 @@ class CAS_GUI(QMainWindow):
         camStatusLayout.addWidget(QLabel('Skipped Frames:'),4,0)
         camStatusLayout.addWidget(QLabel('Dropped Frames:'),5,0)
         
+        # Optional table of pipeline metrics
+        self.metricsLabel = QLabel()
+        self.metricsLabel.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.metricsLabel.setToolTip("Mean and 90th percentile time, frames dropped and queue depth for each stage")
+        camStatusLayout.addWidget(self.metricsLabel,6,0,1,2)
+        self.metricsLabel.setVisible(self.showMetrics)
+        
         self.camSettingsLayout.addWidget(self.camStatusPanel)        
     
         # Add stretch at bottom
@@ -760,6 +887,7 @@ class CAS_GUI(QMainWindow):
         display = ImageDisplay(name = name)
         display.isStatusBar = statusBar
         display.autoScale = autoScale        
+        display.set_render_thread_enabled(self.renderDisplayInThread, metrics = self.metrics)
         
         # Create an outer widget to put the display frame in
         displayFrame = QWidget()
@@ -805,8 +933,10 @@ class CAS_GUI(QMainWindow):
             # Create the processor
             self.imageProcessor = ImageProcessorThread(self.processor, 10, 10, inputQueue = self.inputQueue, 
                                                        multiCore = self.multiCore, 
+                                                       numWorkers = self.multiCoreWorkers,
                                                        sharedMemory = self.sharedMemory,
-                                                       sharedMemoryArraySize = self.sharedMemoryArraySize)
+                                                       sharedMemoryArraySize = self.sharedMemoryArraySize,
+                                                       metrics = self.metrics)
             
             # Update the processor based on initial values of widgets
             self.processing_options_changed()
@@ -867,17 +997,16 @@ class CAS_GUI(QMainWindow):
         
         if self.imageProcessor is not None:
       
-            # If there is a new processed image, pull it off the queue
-            im = self.imageProcessor.get_next_image()
-            
-            # Some processors return a tuple containing other information. If
-            # we get a tuple then the first element is always the image and the second
-            # element is an ID number for the image
-            if isinstance(im, tuple):
-                self.imageId = im[1]
-                im = im[0]           
+            # If there is a new processed image, pull it off the queue. This is
+            # a FrameRecord, which also stores the frame number, timings and,
+            # if the processor returned one, an ID number for the image
+            frame = self.imageProcessor.get_next_frame()
             
-            if im is not None:
+            if frame is not None:
+                if frame.imageId is not None:
+                    self.imageId = frame.imageId
+                im = frame.image
+                self.currentProcessedFrame = frame
                 self.currentProcessedImage = im
                 self.gotProcessedImage = True
                 
@@ -885,7 +1014,7 @@ class CAS_GUI(QMainWindow):
             
             self.currentProcessedImage = None         
             
-        if self.recording:
+        if self.recording or self.recorderThread is not None:
             self.record() 
             
         if self.buffering and self.imageThread is not None:
@@ -894,21 +1023,20 @@ class CAS_GUI(QMainWindow):
                 
 
     def record(self):
-        """ If we are recording, handles recording of a frame.
+        """ If we are recording, handles recording of a frame. Images are 
+        written to file by a RecorderThread, so that this does not wait for 
+        the file. Raw images are taken by the RecorderThread directly from the 
+        auxillary queue, processed images are added to its queue here.
         """
             
-        if self.recording and self.videoOut is not None:
+        if self.recording and self.recorderThread is not None:
             
-            imToSave = None
             if self.recordRaw is False:
                 if self.currentProcessedImage is not None and self.gotProcessedImage:
                     imToSave = self.currentProcessedImage.copy()
-
-            elif not self.recordBuffered:
-                #if self.currentImage is not None and self.gotRawImage:  
-                 #   imToSave = self.currentImage
-                imToSave = self.imageThread.get_next_auxillary_image() 
-            
+                    if self.currentProcessedFrame is not None:
+                        imToSave = self.currentProcessedFrame.with_image(imToSave)
+                    self.recorderThread.add_frame(imToSave)
             
             if self.recordBuffered:
                 self.numFramesBuffered = self.imageThread.get_num_images_in_auxillary_queue()
@@ -917,17 +1045,41 @@ class CAS_GUI(QMainWindow):
                 else:
                     self.record_buffer_full()
             else:
-                if imToSave is not None:
+                self.numFramesRecorded = self.recorderThread.numFramesRecorded
+                self.recordStatusLabel.setText(self.record_status_text(f"Recorded {self.numFramesRecorded} frames."))
+                
+                # The thread finishes by itself at the end of a pre-trigger
+                # recording, or if there is an error
+                if self.recorderThread.is_finished():
+                    self.stop_recording()
+                
+        elif self.recorderThread is not None:
+            
+            # Writing the buffer, or the images still waiting, to file after 
+            # recording has stopped
+            self.numFramesRecorded = self.recorderThread.numFramesRecorded
+            if self.recordBuffered:
+                status = f"Saved {self.numFramesRecorded} frames of {self.numFramesBuffered}."
+            else:
+                status = f"Saved {self.numFramesRecorded} frames."
+            self.recordStatusLabel.setText(self.record_status_text(status))
+            if self.recorderThread.is_finished():
+                self.recorderThread = None
+                self.stop_recording()
+                
                 
-                    self.numFramesRecorded = self.numFramesRecorded + 1
-                    if self.recordType == self.AVI:
-                        outImg = self.im_to_vid_frame(imToSave)
-                        self.videoOut.write(outImg)
-                    if self.recordType == self.TIF:
-                        im = Image.fromarray(to16bit(imToSave))
-                        im.save(self.videoOut)
-                        self.videoOut.newFrame()
-                    self.recordStatusLabel.setText(f"Recorded {self.numFramesRecorded} frames.")
+    def record_status_text(self, status):
+        """ Adds the number of frames dropped and any error from the 
+        RecorderThread to the recording status message, status.
+        """
+        numDropped = self.recorderThread.numDroppedFrames
+        if self.recordRaw and self.imageThread is not None:
+            numDropped = numDropped + self.imageThread.numAuxillaryDroppedFrames
+        if numDropped > 0:
+            status = status + f" Dropped {numDropped} frames."
+        if self.recorderThread.error is not None:
+            status = status + f" Error: {self.recorderThread.error}"
+        return status
 
 
     def update_image_display(self):
@@ -935,23 +1087,33 @@ class CAS_GUI(QMainWindow):
        if additional display boxes used.
        """
 
+       # If the display has a render thread, the thread records the time
+       # taken to render each image
+       if self.mainDisplay.renderThread is None:
+           displayTimer = self.metrics.timer(PipelineMetrics.DISPLAY)
+       else:
+           displayTimer = nullcontext()
+
        if self.currentProcessedImage is not None:   
-           self.mainDisplay.set_image(self.currentProcessedImage) 
+           with displayTimer:
+               self.mainDisplay.set_image(self.currentProcessedImage) 
 
 
        elif self.currentImage is not None and self.fallBackToRaw:
-           if np.iscomplexobj(self.currentImage):
-               self.mainDisplay.set_image(np.abs(self.currentImage) )  
-           else:
-               self.mainDisplay.set_image(self.currentImage)   
+           with displayTimer:
+               if np.iscomplexobj(self.currentImage):
+                   self.mainDisplay.set_image(np.abs(self.currentImage) )  
+               else:
+                   self.mainDisplay.set_image(self.currentImage)   
 
             
          
         
     def update_camera_status(self):
-       """ Updates real-time camera frame rate display. If the source
-       panel has not been created this will cause an error, in which case this 
-       function must be overridden.
+       """ Updates real-time camera frame rate display, and the pipeline
+       metrics if showMetrics is True. If the source panel has not been 
+       created this will cause an error, in which case this function must be
+       overridden.
        """                 
       
        if self.imageProcessor is not None:
@@ -974,6 +1136,9 @@ class CAS_GUI(QMainWindow):
        self.frameRateLabel.setText(str(round(fps,1)))
        self.bufferFillLabel.setText(str(nWaiting))
        
+       if self.showMetrics:
+           self.metricsLabel.setText(self.metrics.format_summary())
+       
        
     def update_camera_ranges_and_values(self):       
         """ After updating a camera parameter, the valid range of other parameters
@@ -1107,8 +1272,42 @@ class CAS_GUI(QMainWindow):
         else:   
             self.recordBufferSpin.hide()
             self.recordBufferSizeLabel.hide()            
+            
+        self.recordPreTriggerCheck.setVisible(self.recordRawCheck.isChecked())
+        isPreTrigger = self.recordRawCheck.isChecked() and self.recordPreTriggerCheck.isChecked()
+        for widget in (self.recordPreTimeLabel, self.recordPreTimeSpin, self.recordPostTimeLabel, self.recordPostTimeSpin):
+            widget.setVisible(isPreTrigger)
+        self.update_pre_trigger_buffer()
+            
+        isChunked = self.recordChunkedCheck.isChecked() and not self.recordRawStreamCheck.isChecked()
+        isVideo = not (self.recordTifCheck.isChecked() or self.recordRawStreamCheck.isChecked() 
+                       or self.recordChunkedCheck.isChecked())
+        for widget in (self.recordCodecLabel, self.recordCodecCombo):
+            widget.setVisible(isVideo)
+        for widget in (self.recordCompressionLabel, self.recordCompressionCombo):
+            widget.setVisible(isChunked)
+        for widget in (self.recordThreadsLabel, self.recordThreadsSpin):
+            widget.setVisible(isVideo or isChunked)
 
     
+    def update_pre_trigger_buffer(self):
+        """ Creates the pre-trigger buffer and starts the image acquisition 
+        thread copying raw images into it if the pre-trigger option is 
+        selected, otherwise removes it to release the memory.
+        """
+        
+        usePreTrigger = self.recordRawCheck.isChecked() and self.recordPreTriggerCheck.isChecked()
+        
+        if usePreTrigger and self.preTriggerBuffer is None:
+            self.preTriggerBuffer = CircularFrameBuffer(self.preTriggerBufferSize, 
+                                                        maxBytes = self.preTriggerBufferMemory)
+        elif not usePreTrigger and not isinstance(self.recorderThread, TriggeredRecorderThread):
+            self.preTriggerBuffer = None
+            
+        if self.imageThread is not None:
+            self.imageThread.set_circular_buffer(self.preTriggerBuffer)
+            
+        
     def start_acquire(self):       
         """ Begin acquiring images by creating an image acquisition thread 
         and starting it. The image acquisition thread grabs images to a queue
@@ -1117,6 +1316,8 @@ class CAS_GUI(QMainWindow):
         # Take the camera source selected in the GUI
         self.camSource = self.camSources[self.camSourceCombo.currentIndex()]
         self.camType = self.camTypes[self.camSourceCombo.currentIndex()]
+        
+        self.metrics.reset()
 
         if self.camType == self.SIM_TYPE:
             
@@ -1128,11 +1329,11 @@ class CAS_GUI(QMainWindow):
 
             if self.sourceFilename is not None:
 
-                self.imageThread = ImageAcquisitionThread(self.camSource, self.rawImageBufferSize, self.acquisitionLock, imageQueue = self.inputQueue, filename=self.sourceFilename)                                                  
+                self.imageThread = ImageAcquisitionThread(self.camSource, self.rawImageBufferSize, self.acquisitionLock, imageQueue = self.inputQueue, filename=self.sourceFilename, metrics = self.metrics, framePoolSize = self.framePoolSize)                                                  
                 self.cam = self.imageThread.get_camera()
                 self.cam.pre_load(-1)
         else:
-            self.imageThread = ImageAcquisitionThread(self.camSource, self.rawImageBufferSize, self.acquisitionLock,imageQueue = self.inputQueue, cameraID = self.cameraIDSpin.value())
+            self.imageThread = ImageAcquisitionThread(self.camSource, self.rawImageBufferSize, self.acquisitionLock,imageQueue = self.inputQueue, cameraID = self.cameraIDSpin.value(), metrics = self.metrics, framePoolSize = self.framePoolSize)
             
         # Sub-classes can overload create_processor to create processing threads
         if self.imageThread is not None:            
@@ -1148,6 +1349,7 @@ class CAS_GUI(QMainWindow):
                 self.update_image_display()
                 
                 # Start the camera image acquirer  and the timers 
+                self.update_pre_trigger_buffer()
                 self.imageThread.start()       
                 self.GUITimer.start(self.GUIupdateInterval)
                 self.imageTimer.start(self.imagesUpdateInterval)
@@ -1287,6 +1489,8 @@ class CAS_GUI(QMainWindow):
                     self.GUITimer.stop()
                 except:
                     pass
+            if isinstance(self.cam, FileInterface):
+                self.cam.dispose()
             self.cam = FileInterface(filename = filename)
             if self.cam.is_file_open():
                 if self.imageProcessor is None: self.create_processors()   
@@ -1303,6 +1507,66 @@ class CAS_GUI(QMainWindow):
                 QMessageBox.about(self, "Error", "Could not load file.") 
         
 
+    def process_file(self, outputFilename = None):
+        """ Processes every image of the current file using the current 
+        processor settings and writes the processed images to a file. The
+        processing is done by a BatchEngine running in the background, 
+        using processFileWorkers processes. If it is stopped, processing the
+        same file to the same output again continues from where it stopped.
+        
+        Optional Keyword Arguments:
+            outputFilename : str
+                             Full path to file to write, the type of file is
+                             determined from the extension. If not given the
+                             user is asked for a filename.
+        """
+        
+        if not isinstance(self.cam, FileInterface) or self.imageProcessor is None:
+            QMessageBox.about(self, "Error", "Load a file and choose a processor first.") 
+            return
+        
+        if outputFilename is None:
+            outputFilename, filter = QFileDialog.getSaveFileName(parent=self, caption='Save processed images as', filter='*.tif;; *.raw;; *.chunks;; *.mkv;; *.avi')
+        
+        if outputFilename != "":
+            
+            # The engine uses a copy of the processor so that the settings
+            # can be changed while it runs
+            try:
+                processor = copy.deepcopy(self.imageProcessor.get_processor())
+            except Exception:
+                processor = self.imageProcessor.get_processor()
+                
+            self.batchEngine = BatchEngine(self.cam.filename, processor, outputFilename, 
+                                           numWorkers = self.processFileWorkers)
+            self.batchEngine.start()
+            self.processFileButton.setText("Stop Processing")
+            self.processFileStatusLabel.setText("Processing...")
+            self.processFileTimer.start(self.GUIupdateInterval)
+            
+            
+    def update_process_file_status(self):
+        """ Shows the progress of processing a whole file, and tidies up once
+        it has finished.
+        """
+        engine = self.batchEngine
+        if engine is None:
+            return
+        
+        status = f"Processed {engine.numDone} of {engine.numImages} images."
+        if engine.is_finished():
+            self.processFileTimer.stop()
+            self.processFileButton.setText("Process Whole File")
+            self.batchEngine = None
+            if engine.error is not None:
+                status = status + f" Error: {engine.error}"
+            elif engine.numDone >= engine.numImages:
+                status = f"Processed {engine.numImages} images to {engine.outputFilename}."
+            else:
+                status = status + " Stopped."
+        self.processFileStatusLabel.setText(status)
+        
+
     def file_index_changed(self, event):
         """ Handles change in the spinbox which controls which image in a 
         multi-page tif is shown.
@@ -1310,7 +1574,7 @@ class CAS_GUI(QMainWindow):
         
         if self.cam is not None:
             self.cam.set_image_idx(self.fileIdxInput.value())
-            self.update_file_processing()
+            self.update_file_processing(settingsChanged = False)
         self.fileIdxSlider.setValue(self.fileIdxInput.value())
                 
         
@@ -1321,22 +1585,67 @@ class CAS_GUI(QMainWindow):
         self.fileIdxInput.setValue(self.fileIdxSlider.value())            
 
    
-    def update_file_processing(self):
+    def update_file_processing(self, settingsChanged = True):
         """ For use when processing a file, not live feeds. Whenever we need
         to reprocessed the file (e.g. due to changed processing options)
         this function can be called. It processes the current raw image, 
         updates currentProcessedImage, and then refreshes displayed
         images and GUI . 
+        
+        Keyword Arguments:
+            settingsChanged : boolean
+                              if True (default), the processing options may
+                              have changed, and so processed images stored
+                              from earlier are not used. Use False when only
+                              the image has changed.
         """  
+        if settingsChanged:
+            self.processingSettingsVersion = self.processingSettingsVersion + 1
         if self.camTypes[self.camSourceCombo.currentIndex()] == self.FILE_TYPE:
             try:
                 self.currentImage = self.cam.get_image()
             except:
                 pass
             if self.imageProcessor is not None and self.currentImage is not None:
-                self.currentProcessedImage = self.imageProcessor.process_frame(self.currentImage)
+                self.currentProcessedImage = self.process_file_image(self.currentImage)
             self.update_image_display()
             self.update_GUI()
+            
+            
+    def process_file_image(self, image):
+        """ Processes the current image from a file, and returns the processed
+        image. If the image has already been processed with the same
+        processing options, the stored result is returned instead.
+        """
+        key = self.get_processed_cache_key()
+        if key is not None:
+            processed = self.processedCache.get(key)
+            if processed is not None:
+                return processed
+            
+        processed = self.imageProcessor.process_frame(image)
+        if key is not None and isinstance(processed, np.ndarray):
+            self.processedCache.put(key, processed)
+        return processed
+    
+    
+    def get_processed_cache_key(self):
+        """ Returns the key for the current image from a file in the cache of
+        processed images, a tuple of the filename, the image index and the 
+        versions of the processing options, which change whenever
+        update_file_processing is called because of changed options or the
+        processor is updated (see ImageProcessorThread.settingsVersion). 
+        Returns None if processed images cannot be cached, including for 
+        processors which are not STATELESS, since their output depends on 
+        previous images.
+        """
+        if self.processedCache is None or not isinstance(self.cam, FileInterface):
+            return None
+        processor = self.imageProcessor.get_processor()
+        if not isinstance(processor, ImageProcessorClass) or processor.get_parallel_mode() != ImageProcessorClass.STATELESS:
+            return None
+        return (self.cam.filename, self.cam.currentImageIdx, 
+                self.processingSettingsVersion, self.imageProcessor.settingsVersion)
 
     
     def exposure_slider_changed(self):
@@ -1371,17 +1680,35 @@ class CAS_GUI(QMainWindow):
         """ Called when main window closed.
         """ 
         self.gui_save()
+        
+        # Write any images still waiting and close the file, the 
+        # RecorderThread would otherwise stop the interpreter from exiting
+        if self.recording:
+            if self.recordBuffered:
+                self.record_buffer_full()
+            else:
+                self.stop_recording()
+        if self.recorderThread is not None:
+            self.recorderThread.stop()
+            self.recorderThread = None
 
         if self.camOpen:
             self.end_acquire()
             
         if self.imageProcessor is not None:
             self.imageProcessor.stop() 
+            
+        if self.batchEngine is not None:
+            self.batchEngine.stop()
           
+        self.mainDisplay.set_render_thread_enabled(False)
         
         active = mp.active_children()
         for child in active:
             child.terminate()           
+            
+        if isinstance(self.inputQueue, SharedFrameBuffer):
+            self.inputQueue.close()
              
 
     def save_image_ac(self, img, fileName):
@@ -1494,18 +1821,36 @@ class CAS_GUI(QMainWindow):
         a buffer.
         """
         
-        if self.recordTifCheck.isChecked():
+        if self.recorderThread is not None:
+            QMessageBox.about(self, "Error", f"The previous recording is still being saved.")
+            return
+        
+        if self.recordRawStreamCheck.isChecked():
+            self.recordType = self.RAW_STREAM
+        elif self.recordChunkedCheck.isChecked():
+            self.recordType = self.CHUNKED
+        elif self.recordTifCheck.isChecked():
             self.recordType = self.TIF
         else:
             self.recordType = self.AVI
+            self.recordCodec = self.videoCodecs.get(self.recordCodecCombo.currentText(), "MJPG")
         
         now = datetime.now()
-        if self.recordType == self.TIF:
+        if self.recordType == self.RAW_STREAM:
+            self.recordFilename = (self.recordFolder / Path(now.strftime('record_%Y_%m_%d_%H_%M_%S.raw'))).as_posix()
+        elif self.recordType == self.CHUNKED:
+            self.recordFilename = (self.recordFolder / Path(now.strftime('record_%Y_%m_%d_%H_%M_%S.chunks'))).as_posix()
+        elif self.recordType == self.TIF:
             self.recordFilename = (self.recordFolder / Path(now.strftime('record_%Y_%m_%d_%H_%M_%S.tif'))).as_posix()
+        elif self.recordCodec in VideoRecorder.losslessCodecs:
+            self.recordFilename = (self.recordFolder / Path(now.strftime('record_%Y_%m_%d_%H_%M_%S.mkv'))).as_posix()
         else:
             self.recordFilename = (self.recordFolder / Path(now.strftime('record_%Y_%m_%d_%H_%M_%S.avi'))).as_posix()
         
-        self.recordBuffered = self.recordBufferCheck.isChecked() and self.recordRawCheck.isChecked()
+        self.recordPreTrigger = (self.recordPreTriggerCheck.isChecked() and self.recordRawCheck.isChecked() 
+                                 and self.preTriggerBuffer is not None)
+        self.recordBuffered = (self.recordBufferCheck.isChecked() and self.recordRawCheck.isChecked() 
+                               and not self.recordPreTrigger)
         self.recordBufferSize = self.recordBufferSpin.value()
         
         self.numFramesRecorded = 0
@@ -1515,12 +1860,18 @@ class CAS_GUI(QMainWindow):
             if self.imageThread is not None:
                 self.recordRaw = True
                 recordImage = self.currentImage
-                self.imageThread.flush_auxillary_buffer()
-                self.imageThread.set_use_auxillary_queue(True)
-                if self.recordBuffered:
-                    # Create it one larger, otherwise image acquisition thread sees it
-                    # full after last frame and tries to make space by removing the first frame
-                    self.imageThread.set_auxillary_queue_size(self.recordBufferSize + 1)
+                
+                # If using the pre-trigger buffer, images are taken from 
+                # there rather than from the auxillary queue
+                if not self.recordPreTrigger:
+                    if self.recordBuffered:
+                        # Create it one larger, otherwise image acquisition thread sees it
+                        # full after last frame and tries to make space by removing the first frame
+                        self.imageThread.set_auxillary_queue_size(self.recordBufferSize + 1)
+                    else:
+                        self.imageThread.set_auxillary_queue_size(self.recordQueueSize)
+                    self.imageThread.numAuxillaryDroppedFrames = 0
+                    self.imageThread.set_use_auxillary_queue(True)
             else:
                 QMessageBox.about(self, "Error", f"Images not being acquired.")
                 return
@@ -1534,13 +1885,36 @@ class CAS_GUI(QMainWindow):
             return
 
 
-        if self.recordType == self.TIF:
-            self.videoOut = TiffImagePlugin.AppendingTiffWriter(self.recordFilename)
-            success = True
+        if self.recordType == self.RAW_STREAM:
+            success = self.create_raw_stream_file(recordImage)
+        elif self.recordType == self.CHUNKED:
+            success = self.create_chunked_file(recordImage)
+        elif self.recordType == self.TIF:
+            success = self.create_tif_file(recordImage)
         else:    
             success = self.create_video_file(recordImage)
 
         if success:
+            
+            # Raw images are written directly from the auxillary queue, or
+            # from the pre-trigger buffer starting from the images acquired
+            # recordPreTimeSpin seconds ago. If buffering, the thread is 
+            # started once the buffer is full.
+            if self.recordPreTrigger:
+                postTime = self.recordPostTimeSpin.value()
+                self.recorderThread = TriggeredRecorderThread(self.preTriggerBuffer, self.recorder,
+                                                              preTime = self.recordPreTimeSpin.value(),
+                                                              postTime = postTime if postTime > 0 else None,
+                                                              metrics = self.metrics)
+            elif self.recordRaw:
+                self.recorderThread = RecorderThread(self.recorder, inputQueue = self.imageThread.auxillaryQueue,
+                                                     metrics = self.metrics)
+            else:
+                self.recorderThread = RecorderThread(self.recorder, bufferSize = self.recordQueueSize, 
+                                                     metrics = self.metrics)
+            if not self.recordBuffered:
+                self.recorderThread.start()
+            
             self.recording = True
             self.toggleRecordButton.setText("Stop Recording")
             self.recordRawCheck.setEnabled(False)
@@ -1550,12 +1924,15 @@ class CAS_GUI(QMainWindow):
             self.toggleRecordButton.setText("Start Recording")
             self.recordRawCheck.setEnabled(True)
             self.recordFolderButton.setEnabled(True)
+            if self.imageThread is not None:
+                self.imageThread.set_use_auxillary_queue(False)
             QMessageBox.about(self, "Error", f"Unable to create video file.")
             
             
 
     def create_video_file(self, exampleImage, frameRate = 20.0):
-        """ Creates a MJPEG video file.
+        """ Creates a video file using the codec and number of encoding 
+        threads chosen in the record panel.
         
         Arguments:
             exampleImage  : numpy.ndarray
@@ -1570,76 +1947,172 @@ class CAS_GUI(QMainWindow):
         """
         
         try:
-            fourcc = cv.VideoWriter_fourcc(*"MJPG")
-            imSize = (np.shape(exampleImage)[1],np.shape(exampleImage)[0]) 
             self.numFramesRecorded = 0
-            self.videoOut = cv.VideoWriter(self.recordFilename, fourcc, frameRate, imSize)            
+            self.recorder = VideoRecorder(self.recordFilename, frameRate, codec = self.recordCodec,
+                                          numThreads = self.recordThreadsSpin.value())
+            self.recorder.open(exampleImage)
+            return True
+
+        except:
+            return False
+        
+        
+    def create_tif_file(self, exampleImage):
+        """ Creates a multi-page TIF file.
+        
+        Arguments:
+            exampleImage  : numpy.ndarray
+                            example image frame
+                            
+        Returns: 
+            Boolean       : True if file created successfully, otherwise False                    
+        """
+        
+        try:
+            self.numFramesRecorded = 0
+            self.recorder = TifRecorder(self.recordFilename)
+            self.recorder.open(exampleImage)
+            return True
+
+        except:
+            return False
+        
+        
+    def create_raw_stream_file(self, exampleImage):
+        """ Creates a raw stream file and its index. Images are recorded 
+        unchanged, and can be read using RawStreamReader.
+        
+        Arguments:
+            exampleImage  : numpy.ndarray
+                            example image frame used to determine image type
+                            
+        Returns: 
+            Boolean       : True if file created successfully, otherwise False                    
+        """
+        
+        try:
+            self.numFramesRecorded = 0
+            self.recorder = RawStreamRecorder(self.recordFilename)
+            self.recorder.open(exampleImage)
+            return True
+
+        except:
+            return False
+        
+        
+    def create_chunked_file(self, exampleImage):
+        """ Creates a folder to record losslessly compressed chunks of 
+        images to, using the compression and number of threads chosen in the 
+        record panel. The camera and processor settings are stored with the
+        images, see get_recording_metadata(). The recording can be read using
+        load_chunked_stack in im_tools.
+        
+        Arguments:
+            exampleImage  : numpy.ndarray
+                            example image frame used to determine image type
+                            
+        Returns: 
+            Boolean       : True if file created successfully, otherwise False                    
+        """
+        
+        try:
+            self.numFramesRecorded = 0
+            self.recorder = ChunkedRecorder(self.recordFilename, 
+                                            codec = self.recordCompressionCombo.currentText(),
+                                            numThreads = self.recordThreadsSpin.value(),
+                                            metadata = self.get_recording_metadata())
+            self.recorder.open(exampleImage)
             return True
 
         except:
             return False
+        
+        
+    def get_recording_metadata(self):
+        """ Returns a dictionary of information to store with a recording: 
+        the camera source, exposure, gain and frame rate, whether raw
+        images are being recorded and the processor class and the values of 
+        its attributes which are numbers, strings or booleans. Override this 
+        to store additional information.
+        """
+        
+        metadata = {'camSource': getattr(self, 'camSource', None),
+                    'recordRaw': self.recordRaw}
+        
+        if self.cam is not None:
+            for name, getter in (('exposure', 'get_exposure'), ('gain', 'get_gain'), 
+                                 ('frameRate', 'get_frame_rate')):
+                try:
+                    metadata[name] = getattr(self.cam, getter)()
+                except Exception:
+                    metadata[name] = None
+        
+        if self.imageProcessor is not None:
+            processor = self.imageProcessor.get_processor()
+        else:
+            processor = None
+            
+        if processor is not None:
+            metadata['processor'] = type(processor).__name__
+            metadata['processorSettings'] = {name: value for name, value in vars(processor).items()
+                                             if isinstance(value, (bool, int, float, str))}
+            
+        return metadata
        
     
     def record_buffer_full(self):
-        """ When the recording buffer has been filled, writes the buffer to 
-        the video recording file.
+        """ When the recording buffer has been filled, starts writing the 
+        buffer to the video recording file. The file is written by the
+        RecorderThread, record() then reports progress and calls 
+        stop_recording() when it is complete.
         """
         
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        
         self.recording = False
 
         self.imageThread.set_use_auxillary_queue(False)
-            
-        for idx in range(self.numFramesBuffered):  
-            imToSave = self.imageThread.get_next_auxillary_image()
-            if imToSave is not None:
-                self.numFramesRecorded = self.numFramesRecorded + 1
-                
-                if self.recordType == self.AVI:
-                    outImg = self.im_to_vid_frame(imToSave)
-                    self.videoOut.write(outImg)
-                elif self.recordType == self.TIF:
-                    im = Image.fromarray(imToSave)
-                    im.save(self.videoOut)
-                    self.videoOut.newFrame()
-              
-            self.recordStatusLabel.setText(f"Saved {idx + 1} frames.")
-        self.recordBuffer = []
-        self.numFramesBuffered = 0
-        self.stop_recording()
-        self.imageThread.set_use_auxillary_queue(False)
-
-        QApplication.restoreOverrideCursor()
-
         
+        self.recorderThread.start()
+        self.recorderThread.finish()
+        
+        self.recordStatusLabel.setText(f"Saving {self.numFramesBuffered} frames.")
+        self.toggleRecordButton.setText("Saving...")
+        self.toggleRecordButton.setEnabled(False)
+
         
     def stop_recording(self):
-        """ Handles everything needed to stop a recording.
+        """ Handles everything needed to stop a recording. Any images still
+        waiting to be written are written by the RecorderThread, which then
+        closes the file. recorderThread is kept until then, so that a new
+        recording cannot be started while the file is still being written.
         """
-        if self.recordType == self.AVI and self.videoOut is not None:
-            self.videoOut.release()
-        self.imageThread.set_use_auxillary_queue(False)
-        self.videoOut = None
+        if self.recorderThread is not None:
+            if self.recorderThread.is_alive():
+                
+                # record() reports progress and calls stop_recording() again
+                # once the file has been closed
+                self.recorderThread.finish()
+            else:
+                if not self.recorderThread.is_finished():
+                    self.recorderThread.recorder.close()
+                self.recorderThread = None
+        if self.imageThread is not None:
+            self.imageThread.set_use_auxillary_queue(False)
         self.recording = False
-        self.toggleRecordButton.setText("Start Recording")
-        self.recordRawCheck.setEnabled(True)
-        self.recordFolderButton.setEnabled(True)
+        if self.recorderThread is not None:
+            self.toggleRecordButton.setText("Saving...")
+            self.toggleRecordButton.setEnabled(False)
+        else:
+            self.toggleRecordButton.setText("Start Recording")
+            self.toggleRecordButton.setEnabled(True)
+            self.recordRawCheck.setEnabled(True)
+            self.recordFolderButton.setEnabled(True)
 
 
     def im_to_vid_frame(self, imToSave):
         """ Converts image to video frame that can be recorded using video
         writer.
         """
-        
-        if imToSave.ndim  == 3:
-            return to8it(imToSave)
-        else:
-            outImg = np.zeros((np.shape(imToSave)[0], np.shape(imToSave)[1], 3), dtype = 'uint8')
-            outImg[:,:,0] = imToSave
-            outImg[:,:,1] = imToSave
-            outImg[:,:,2] = imToSave
-            return outImg
+        return to_video_frame(imToSave)
         
     
     def cam_source_changed(self):
@@ -1824,6 +2297,13 @@ class CAS_GUI(QMainWindow):
 
     def load_file_clicked(self):
         self.load_file()     
+        
+    def process_file_button_clicked(self):
+        if self.batchEngine is not None:
+            self.batchEngine.stop()
+            self.update_process_file_status()
+        else:
+            self.process_file()
 
     def load_background_clicked(self, event):
         self.load_background()        
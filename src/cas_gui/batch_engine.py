@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+BatchEngine
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Processes every image of a recorded file, folder of images or array of
+images using an Image Processor Class, and writes the processed images to
+a file, without playing the file through the GUI. This is used by the
+Process Whole File button of CAS_GUI, and can also be used directly:
+
+    engine = BatchEngine('vid.tif', MyProcessor, 'processed.tif')
+    engine.run()
+
+or from the command line, using the cas-batch command (or python -m
+cas_gui.batch_engine), see main().
+
+The source can be anything accepted by open_source (see frame_sources), and
+the type of the output file is determined from its extension, as for
+create_recorder. The images are divided into chunks of chunkSize images,
+which are processed by a pool of numWorkers processes (one per CPU by
+default). Each worker reads the images of its chunks from the source itself,
+except for arrays, which are sent to the workers. At most 2 * numWorkers
+chunks are in progress at once, and the processed images are written in
+order as each chunk is finished, so memory use does not depend on the
+length of the file. How the processing is divided follows the parallel mode
+of the processor, as for the worker pool of ImageProcessorThread:
+
+    STATELESS  - chunks are processed in parallel by the workers.
+    STATEFUL   - images are processed in order in this process.
+    MAP_REDUCE - process_map() is run in parallel by the workers, and
+                 process_reduce() in order in this process.
+
+Images are also processed in this process if numWorkers is 1 or if the
+processor cannot be pickled. process() must return an image for every
+image.
+
+progressCallback, if given, is called with the number of images processed
+and the total number of images after each chunk. Alternatively, when the
+engine is run in a thread using start(), numDone and numImages can be read
+while it runs.
+
+If processing of a chunk fails it is tried again, up to maxRetries times,
+and the pool of workers is restarted if a worker has died. If processing
+still fails, or stop() is called, the output file is closed so that it holds
+the images processed so far. For TIFF, raw stream and chunked outputs (see
+Recorder.checkpoint) a progress file is also written alongside the output,
+with the output filename and .progress.json appended. The progress file is
+updated every checkpointInterval seconds while processing, so that it is
+available even if the program itself fails. Running the engine again with
+the same source, output and processor settings then continues from where it
+stopped, unless resume is False. This is only possible for STATELESS
+processors, others start again from the first image.
+
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cas_gui.threads.image_processor_class import ImageProcessorClass
+from cas_gui.utils.frame_sources import open_source
+from cas_gui.utils.frame_cache import state_hash
+from cas_gui.utils.recorders import create_recorder
+from cas_gui.pipeline import import_class, parse_value
+
+
+# Processor and source used by each worker process, set by init_worker
+workerProcessor = None
+workerSource = None
+workerMapOnly = False
+
+
+def init_worker(processor, source, mapOnly):
+    """ Called in each worker process when it starts.
+    """
+    global workerProcessor, workerSource, workerMapOnly
+    workerProcessor = processor
+    workerSource = source
+    workerMapOnly = mapOnly
+
+
+def process_chunk(start, stop, images = None):
+    """ Processes images start up to stop in a worker process, reading them
+    from the source unless images are given. Returns a list of the processed
+    images, or of the results of process_map() for MAP_REDUCE processors.
+    """
+    if images is None:
+        images = workerSource.get_images(start, stop)
+    process = workerProcessor.process_map if workerMapOnly else workerProcessor.process
+    return [process(image) for image in images]
+
+
+class BatchEngine:
+    """ Processes all the images of a source and writes them to a file.
+
+    Arguments:
+        source             : str, Path, ndarray, list or FrameSource
+                             images to process, see open_source
+        processor          : ImageProcessorClass or instance
+                             Image Processor Class, or an instance of one
+                             with the settings to use. An instance is used by
+                             the engine, so should not be used elsewhere
+                             while it is running.
+        outputFilename     : str or Path
+                             file to write processed images to
+
+    Keyword Arguments:
+        numWorkers         : int
+                             number of processes, 0 (default) for one per
+                             CPU
+        chunkSize          : int
+                             number of images processed by a worker at a time
+                             (default is 16)
+        resume             : boolean
+                             if True (default) continues from the progress
+                             file if there is one
+        maxRetries         : int
+                             number of times to retry a chunk (default is 2)
+        checkpointInterval : float
+                             time in seconds between updates of the progress
+                             file (default is 5)
+        progressCallback   : function or None
+                             called with the number of images processed and
+                             the total after each chunk (default is None)
+        recorderArgs       : dict or None
+                             keyword arguments for create_recorder
+    """
+
+    waitTimeout = 0.1
+    progressExtension = '.progress.json'
+
+    def __init__(self, source, processor, outputFilename, numWorkers = 0, chunkSize = 16,
+                 resume = True, maxRetries = 2, checkpointInterval = 5.0,
+                 progressCallback = None, recorderArgs = None):
+
+        self.source = open_source(source)
+        self.processor = processor() if isinstance(processor, type) else processor
+        self.outputFilename = str(outputFilename)
+        self.numWorkers = numWorkers if numWorkers > 0 else (os.cpu_count() or 1)
+        self.chunkSize = max(chunkSize, 1)
+        self.resume = resume
+        self.maxRetries = maxRetries
+        self.checkpointInterval = checkpointInterval
+        self.progressCallback = progressCallback
+        self.recorderArgs = recorderArgs if recorderArgs is not None else {}
+
+        self.numImages = 0
+        self.numDone = 0
+        self.numResumed = 0
+        self.numRetries = 0
+        self.recorder = None
+        self.error = None
+        self.isRunning = False
+        self.thread = None
+        self.lastCheckpointTime = 0
+        self._stop_event = threading.Event()
+
+
+    def run(self):
+        """ Processes all the images, or until stop() is called, and closes
+        the output. Any exception which stops processing is raised after the
+        output is closed.
+
+        Returns:
+            int : number of images processed, not including any processed
+                  before resuming
+        """
+        self.isRunning = True
+        self.error = None
+        try:
+            self.numImages = len(self.source)
+            self.processorHash = state_hash(self.processor)
+            self.parallelMode = self.processor.get_parallel_mode()
+            self.recorder = create_recorder(self.outputFilename, **self.recorderArgs)
+            self.numDone = self.numResumed = self.resume_progress()
+            self.lastCheckpointTime = time.perf_counter()
+
+            if self.use_workers():
+                self.process_with_workers()
+            else:
+                self.process_in_order()
+
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.finish()
+
+        return self.numDone - self.numResumed
+
+
+    def start(self):
+        """ Runs the engine in a thread, returning immediately. Use
+        is_finished() to check when it has finished, and error for any
+        exception which stopped it.
+        """
+        self.thread = threading.Thread(target = self.run_in_thread, daemon = True)
+        self.thread.start()
+
+
+    def run_in_thread(self):
+        try:
+            self.run()
+        except Exception as e:
+            logging.error(f"Error processing {self.source}: {e}")
+
+
+    def stop(self):
+        """ Stops processing after the chunks in progress. If running in a
+        thread, waits for it to finish.
+        """
+        self._stop_event.set()
+        if self.thread is not None and self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+    def is_finished(self):
+        """ Returns True once the engine, started using start(), has
+        finished and closed the output.
+        """
+        return self.thread is not None and not self.thread.is_alive()
+
+
+    def get_progress(self):
+        """ Returns the fraction of the images which have been processed.
+        """
+        return self.numDone / self.numImages if self.numImages > 0 else 0
+
+
+    def use_workers(self):
+        """ Returns True if images will be processed by a pool of workers.
+        """
+        return (self.numWorkers > 1 and self.parallelMode != ImageProcessorClass.STATEFUL
+                and self.processorHash is not None)
+
+
+    def process_in_order(self):
+        """ Processes the images in this process.
+        """
+        for start in range(self.numDone, self.numImages, self.chunkSize):
+            if self._stop_event.is_set():
+                break
+            images = self.source.get_images(start, start + self.chunkSize)
+            self.write_images([self.processor.process(image) for image in images])
+
+
+    def process_with_workers(self):
+        """ Processes the images using a pool of workers, writing the
+        processed images in order as each chunk is finished.
+        """
+        mapOnly = self.parallelMode == ImageProcessorClass.MAP_REDUCE
+        maxPending = 2 * self.numWorkers
+        pending = {}
+        attempts = {}
+        nextStart = self.numDone
+        executor = self.create_pool(mapOnly)
+
+        try:
+            while self.numDone < self.numImages and not self._stop_event.is_set():
+
+                try:
+                    while nextStart < self.numImages and len(pending) < maxPending:
+                        pending[nextStart] = self.submit_chunk(executor, nextStart)
+                        nextStart = nextStart + self.chunkSize
+
+                    future = pending[self.numDone]
+                    done, notDone = concurrent.futures.wait([future], timeout = self.waitTimeout)
+                    if not done:
+                        continue
+                    results = future.result()
+
+                except Exception as e:
+                    attempts[self.numDone] = attempts.get(self.numDone, 0) + 1
+                    if attempts[self.numDone] > self.maxRetries:
+                        raise
+                    self.numRetries = self.numRetries + 1
+                    logging.warning(f"Processing images from {self.numDone} failed, retrying: {e}")
+
+                    # If a worker has died, all the chunks in progress are lost
+                    if isinstance(e, BrokenProcessPool):
+                        executor.shutdown(wait = False, cancel_futures = True)
+                        executor = self.create_pool(mapOnly)
+                        for start in pending:
+                            pending[start] = self.submit_chunk(executor, start)
+                    else:
+                        pending[self.numDone] = self.submit_chunk(executor, self.numDone)
+                    continue
+
+                del pending[self.numDone]
+                if mapOnly:
+                    results = [self.processor.process_reduce(result) for result in results]
+                self.write_images(results)
+
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+
+
+    def create_pool(self, mapOnly):
+        """ Returns a new pool of workers, each with a copy of the processor
+        and the source.
+        """
+        source = self.source if self.source.workerReadable else None
+        return ProcessPoolExecutor(max_workers = self.numWorkers, initializer = init_worker,
+                                   initargs = (self.processor, source, mapOnly))
+
+
+    def submit_chunk(self, executor, start):
+        """ Submits the chunk of images starting at start to the pool,
+        returns a Future for the list of processed images.
+        """
+        stop = min(start + self.chunkSize, self.numImages)
+        images = None if self.source.workerReadable else self.source.get_images(start, stop)
+        return executor.submit(process_chunk, start, stop, images)
+
+
+    def write_images(self, images):
+        """ Writes a chunk of processed images, reports progress and, if
+        checkpointInterval has elapsed, updates the progress file.
+        """
+        for idx, image in enumerate(images):
+            if image is None:
+                raise ValueError(f"Processor returned no image for image {self.numDone + idx}.")
+            self.recorder.write(image)
+        self.numDone = self.numDone + len(images)
+
+        if self.progressCallback is not None:
+            self.progressCallback(self.numDone, self.numImages)
+        if time.perf_counter() - self.lastCheckpointTime > self.checkpointInterval:
+            self.save_progress()
+
+
+    def finish(self):
+        """ Closes the output. If not all the images were processed the
+        progress is saved so that processing can be resumed, otherwise the
+        progress file is removed.
+        """
+        self.isRunning = False
+        try:
+            if self.recorder is not None:
+                if self.numDone < self.numImages:
+                    try:
+                        self.save_progress()
+                    except Exception as e:
+                        logging.error(f"Could not save progress of {self.outputFilename}: {e}")
+                self.recorder.close()
+                if self.numDone >= self.numImages:
+                    self.remove_progress()
+        finally:
+            self.source.close()
+
+
+    def can_resume(self):
+        """ Returns True if processing can be resumed from a progress file.
+        """
+        return (self.recorder.resumable and self.processorHash is not None
+                and self.parallelMode == ImageProcessorClass.STATELESS)
+
+
+    def get_progress_filename(self):
+        """ Returns the name of the progress file.
+        """
+        return self.outputFilename.rstrip('/\\') + self.progressExtension
+
+
+    def get_progress_key(self):
+        """ Returns a dictionary describing the source and processor, used to
+        check that a progress file is for the same processing.
+        """
+        return {'source': str(self.source),
+                'numImages': self.numImages,
+                'processor': self.processorHash}
+
+
+    def save_progress(self):
+        """ Writes the progress file, if processing can be resumed.
+        """
+        self.lastCheckpointTime = time.perf_counter()
+        if not self.can_resume():
+            return
+        progress = self.get_progress_key()
+        progress['recorder'] = self.recorder.checkpoint()
+
+        # Replace the file in one step so that it is never incomplete
+        tempFilename = self.get_progress_filename() + '.tmp'
+        with open(tempFilename, 'w') as progressFile:
+            json.dump(progress, progressFile, indent = 2)
+        os.replace(tempFilename, self.get_progress_filename())
+
+
+    def resume_progress(self):
+        """ If there is a progress file for this processing, resumes the
+        output from it, otherwise removes any old progress file. Returns the
+        number of images already processed.
+        """
+        progress = None
+        if self.resume and self.can_resume() and os.path.exists(self.outputFilename):
+            try:
+                with open(self.get_progress_filename()) as progressFile:
+                    progress = json.load(progressFile)
+            except (OSError, ValueError):
+                progress = None
+
+        if progress is None or progress.get('recorder') is None or any(progress.get(key) != value for key, value in self.get_progress_key().items()):
+            self.remove_progress()
+            return 0
+
+        self.recorder.resume(progress['recorder'])
+        logging.info(f"Resuming processing of {self.source} from image {progress['recorder']['numFrames']}.")
+        return progress['recorder']['numFrames']
+
+
+    def remove_progress(self):
+        """ Removes the progress file, if there is one.
+        """
+        if os.path.exists(self.get_progress_filename()):
+            os.remove(self.get_progress_filename())
+
+
+def main(args = None):
+    """ Command line entry point. Run with --help for options.
+    """
+
+    parser = argparse.ArgumentParser(description = "Process every image of a file or folder and write the processed images to a file.")
+    parser.add_argument('source', help = "file or folder of images to process")
+    parser.add_argument('processor', help = "Image Processor Class, as module.ClassName")
+    parser.add_argument('output', help = "file to write to (.tif, .avi, .mkv, .raw or .chunks)")
+    parser.add_argument('--set', action = 'append', default = [], metavar = 'NAME=VALUE',
+                        help = "set an attribute of, or call a function of, the processor (repeatable)")
+    parser.add_argument('--workers', type = int, default = 0, help = "number of processes, default is one per CPU")
+    parser.add_argument('--chunk-size', type = int, default = 16, help = "number of images processed by a worker at a time")
+    parser.add_argument('--retries', type = int, default = 2, help = "number of times to retry a chunk which fails")
+    parser.add_argument('--restart', action = 'store_true', help = "start from the first image even if there is a progress file")
+    options = parser.parse_args(args)
+
+    processor = import_class(options.processor)()
+    for setting in options.set:
+        name, value = setting.split('=', 1)
+        processor.message(name, parse_value(value))
+
+    def print_progress(numDone, numImages):
+        print(f"\rProcessed {numDone} of {numImages} images.", end = '', flush = True)
+
+    engine = BatchEngine(options.source, processor, options.output, numWorkers = options.workers,
+                         chunkSize = options.chunk_size, resume = not options.restart,
+                         maxRetries = options.retries, progressCallback = print_progress)
+
+    startTime = time.perf_counter()
+    try:
+        numProcessed = engine.run()
+    except KeyboardInterrupt:
+        numProcessed = engine.numDone - engine.numResumed
+    print()
+
+    elapsed = time.perf_counter() - startTime
+    if engine.numResumed > 0:
+        print(f"Resumed from image {engine.numResumed}.")
+    print(f"Processed {numProcessed} images in {elapsed:.1f} s ({numProcessed / max(elapsed, 1e-9):.1f} fps).")
+    if engine.numDone < engine.numImages:
+        print(f"Stopped after {engine.numDone} of {engine.numImages} images, run again to resume.")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
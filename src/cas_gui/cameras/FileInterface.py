@@ -5,6 +5,15 @@ CAS: Camera Acquisition System
 A camera interface for CAS which instead of using a camera, loads images 
 from a file (single or stack).
 
+.npy files are memory-mapped. Uncompressed TIFF files, including those 
+recorded by CAS, are also memory-mapped using a TiffPageIndex, so any image
+can be obtained without decoding it or loading the rest of the file. Other
+files are read using PIL, seeking to each image as it is requested. These
+images are kept in a FrameCache of up to cacheBytes bytes, and a 
+PrefetchThread decodes the next prefetchNum images in the direction the 
+index is moving, so that moving through the file does not wait for images to
+be decoded. Both can be set using keyword arguments of the same names.
+
 """
 import time
 import os
@@ -12,6 +21,9 @@ from PIL import Image, ImageSequence
 import numpy as np
 
 from cas_gui.cameras.GenericCamera import GenericCameraInterface
+from cas_gui.utils.tiff_index import TiffPageIndex
+from cas_gui.utils.frame_cache import FrameCache
+from cas_gui.threads.prefetch_thread import PrefetchThread
 
 
 class FileInterface(GenericCameraInterface):
@@ -23,10 +35,19 @@ class FileInterface(GenericCameraInterface):
     fileOpen = False
     dataset = None
     stack = None
+    pageIndex = None
+    cache = None
+    prefetchThread = None
+    prefetchDataset = None
+    
+    cacheBytes = 256 * 1024**2     # Maximum size of decoded images cached
+    prefetchNum = 8                # Number of images to decode ahead
     
     def __init__(self, **kwargs): 
         
         self.filename = kwargs.get('filename', None)
+        self.cacheBytes = kwargs.get('cacheBytes', self.cacheBytes)
+        self.prefetchNum = kwargs.get('prefetchNum', self.prefetchNum)
         self.lastImageTime = time.perf_counter()
         self.fps = 30
         self.frameRateEnabled = False
@@ -34,14 +55,20 @@ class FileInterface(GenericCameraInterface):
             try:
                 if os.path.splitext(self.filename)[1] == '.npy': 
                     self.is_array = True
-                    data = np.load(self.filename)
+                    data = np.load(self.filename, mmap_mode = 'r')
                     self.stack = data
                     self.fileOpen = True
+                elif (pageIndex := self.open_page_index(self.filename)) is not None:
+                    self.is_array = True
+                    self.pageIndex = pageIndex
+                    self.stack = pageIndex.stack
+                    self.fileOpen = True
                 else:
                     self.is_array = False
                     self.dataset = Image.open(self.filename)
                     self.fileOpen = True
                     self.stack = None
+                    self.start_prefetch()
             except:
                 self.fileOpen = False
                 return None
@@ -69,8 +96,58 @@ class FileInterface(GenericCameraInterface):
         pass
     
         
+    def open_page_index(self, filename):
+        """ Returns a TiffPageIndex for the file if it is a TIFF file in which
+        every image can be memory-mapped, otherwise returns None.
+        """
+        try:
+            pageIndex = TiffPageIndex(filename)
+        except ValueError:
+            return None
+        if pageIndex.isMappable:
+            return pageIndex
+        pageIndex.close()
+        return None
+    
+    
+    def start_prefetch(self):
+        """ Creates the cache of decoded images and, if the file has more 
+        than one image, starts the thread which decodes images ahead.
+        """
+        self.cache = FrameCache(self.cacheBytes)
+        numImages = getattr(self.dataset, 'n_frames', 1)
+        if self.prefetchNum > 0 and numImages > 1:
+            self.prefetchThread = PrefetchThread(self.decode_prefetch_image, self.cache, numImages,
+                                                 numAhead = self.prefetchNum)
+            self.prefetchThread.start()
+            
+            
+    def decode_image(self, dataset, idx):
+        """ Returns image idx of a PIL image.
+        """
+        dataset.seek(idx)
+        return np.asarray(dataset)
+    
+    
+    def decode_prefetch_image(self, idx):
+        """ Returns image idx, used by the prefetch thread, which has its own 
+        handle to the file.
+        """
+        if self.prefetchDataset is None:
+            self.prefetchDataset = Image.open(self.filename)
+        return self.decode_image(self.prefetchDataset, idx)
+    
+    
     def dispose(self):
-        self.dataset.close()       
+        if self.prefetchThread is not None:
+            self.prefetchThread.stop()
+            self.prefetchThread = None
+        if self.prefetchDataset is not None:
+            self.prefetchDataset.close()
+        if self.dataset is not None:
+            self.dataset.close()       
+        if self.pageIndex is not None:
+            self.pageIndex.close()
       
                
     def get_image(self):
@@ -82,13 +159,22 @@ class FileInterface(GenericCameraInterface):
         if self.currentImageIdx == self.lastImageIdx:
             return self.lastImage
         
-        if self.is_array:
+        if self.pageIndex is not None:
+           imData = self.pageIndex.get_page(self.currentImageIdx)
+           if not imData.dtype.isnative:
+               imData = imData.astype(imData.dtype.newbyteorder('='))
+        elif self.is_array:
            imData = self.stack[self.currentImageIdx]     
             
         else:
-            # Otherwise jump to desired image (if it is a stack)
-            self.dataset.seek(self.currentImageIdx)
-            imData = np.asarray(self.dataset)
+            # Otherwise jump to desired image (if it is a stack), unless it
+            # has already been decoded
+            imData = self.cache.get(self.currentImageIdx)
+            if imData is None:
+                imData = self.decode_image(self.dataset, self.currentImageIdx)
+                self.cache.put(self.currentImageIdx, imData)
+            if self.prefetchThread is not None:
+                self.prefetchThread.request(self.currentImageIdx)
 
        
         # Store this image in lastImage
@@ -99,6 +185,14 @@ class FileInterface(GenericCameraInterface):
     
     
     def get_all_images(self):
+        """ Returns all the images as an array of shape (number of images, h, 
+        w), or a single image if the file has only one. For memory-mapped 
+        files this is a view of the file.
+        """
+        
+        if self.pageIndex is not None:
+            stack = self.pageIndex.get_stack()
+            return stack if self.pageIndex.numPages > 1 else stack[0]
         
         if self.stack is None:
         
@@ -128,7 +222,9 @@ class FileInterface(GenericCameraInterface):
         """ If the file contains multiple frames, returns the number of frames.
         Will return 1 if a singe image.
         """
-        if self.is_array:
+        if self.pageIndex is not None:
+            return self.pageIndex.numPages
+        elif self.is_array:
             return np.shape(self.stack)[0]
         else:
             if self.dataset is not None:
@@ -22,6 +22,8 @@ class FleaCameraInterface(GenericCameraInterface):
         PySpin.WO: "write only",
         PySpin.NA: "not available"
     }
+    
+    lastTimestamp = None
 
     _attr_types = {
         PySpin.intfIFloat: PySpin.CFloatPtr,
@@ -193,7 +195,20 @@ class FleaCameraInterface(GenericCameraInterface):
             return None
         else:
             imageData = image.GetNDArray()
+            self.lastTimestamp = image.GetTimeStamp() / 1e9
             return imageData
+        
+        
+    def get_image_wait(self, timeout = 0.1):
+        """ Waits up to timeout seconds for the next image.
+        """
+        return self.get_image(timeout = int(timeout * 1000))
+    
+    
+    def get_hardware_timestamp(self):
+        """ Returns the camera timestamp of the last image in seconds.
+        """
+        return self.lastTimestamp
     
     
     
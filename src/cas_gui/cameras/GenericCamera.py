@@ -6,12 +6,39 @@ Generic camera interface for Camera Acquisition Based GUIs. Other
 cameras should inherit from this and implement whatever methods
 are required.
 
+get_image should return an image if one is available, or None otherwise. 
+If the camera provides a timestamp for each image, get_hardware_timestamp 
+should return the timestamp (in seconds) of the last image returned.
+get_image_wait should wait up to a timeout for an image to become available.
+By default this polls get_image, cameras which can block until an image
+is available should override it.
+
+get_image_into and get_image_wait_into do the same, but write the image into
+a preallocated array, out, to avoid allocating memory for every image. This
+is used by ImageAcquisitionThread with a FramePool. By default the image
+is obtained using get_image and copied into out, cameras which can write
+directly into out should override them and set supportsGetImageInto to True.
+If the image does not have the shape and dtype of out, or out is None, a new
+array is returned instead.
+
+get_images and get_images_wait return all the images which are ready, up to
+a maximum number, as a single stack of shape (number of images, h, w), so
+that the acquisition thread does not have to handle images one at a time.
+By default these call get_image_into repeatedly until there are no more 
+images, cameras whose SDK can return several images at once should override
+them.
+
 """
+
+import time
+
+import numpy as np
                 
         
 class GenericCameraInterface:
     
     camera_open = False
+    supportsGetImageInto = False
     
     def __init__(self):        
         pass            
@@ -30,6 +57,75 @@ class GenericCameraInterface:
                
     def get_image(self):
         pass
+    
+    def get_image_wait(self, timeout = 0.1):
+        """ Returns the next image, waiting up to timeout seconds for it to
+        become available. Returns None if there is still no image.
+        """
+        endTime = time.perf_counter() + timeout
+        while True:
+            image = self.get_image()
+            if image is not None or time.perf_counter() >= endTime:
+                return image
+            time.sleep(0.001)
+            
+    def get_image_into(self, out):
+        """ Writes the next image into out and returns out, or returns None 
+        if no image is available. If out is None, or the image does not 
+        match the shape and dtype of out, a new array is returned.
+        """
+        return copy_into(self.get_image(), out)
+    
+    def get_image_wait_into(self, out, timeout = 0.1):
+        """ As get_image_into, but waits up to timeout seconds for an image.
+        """
+        return copy_into(self.get_image_wait(timeout), out)
+            
+    def get_images(self, maxNum, out = None):
+        """ Returns all the images which are ready, up to maxNum, as a stack
+        of shape (number of images, h, w), or None if there are no images.
+        If out is an array of shape (maxNum, h, w) of the correct dtype, 
+        the images are written into it and a view of the first part of out 
+        is returned.
+        """
+        return self.collect_images(maxNum, out)
+    
+    def get_images_wait(self, maxNum, timeout = 0.1, out = None):
+        """ As get_images, but waits up to timeout seconds for the first 
+        image.
+        """
+        return self.collect_images(maxNum, out, timeout)
+    
+    def collect_images(self, maxNum, out = None, timeout = None):
+        """ Calls get_image_into until there are no more images or there are
+        maxNum images, and returns them as a stack. If timeout is not None,
+        waits up to timeout seconds for the first image.
+        """
+        images = []
+        allInOut = True
+        for idx in range(maxNum):
+            target = None if out is None else out[idx]
+            if idx == 0 and timeout is not None:
+                image = self.get_image_wait_into(target, timeout)
+            else:
+                image = self.get_image_into(target)
+            if image is None:
+                break
+            allInOut = allInOut and image is target
+            images.append(image)
+            
+        if len(images) == 0:
+            return None
+        elif out is not None and allInOut:
+            return out[:len(images)]
+        else:
+            return np.stack(images)
+            
+    def get_hardware_timestamp(self):
+        """ Returns the camera's timestamp, in seconds, of the last image
+        returned, or None if the camera does not provide timestamps.
+        """
+        return None
         
     def is_camera_open(self):
         return self.camera_open
@@ -121,5 +217,16 @@ class GenericCameraInterface:
     def get_number_images(self):
         return 1
 
+
+def copy_into(image, out):
+    """ Copies image into out and returns out, if out is not None and has
+    the same shape and dtype as image. Otherwise returns image.
+    """
+    if image is not None and out is not None and image.shape == out.shape and image.dtype == out.dtype:
+        np.copyto(out, image)
+        return out
+    return image
+
+
 if __name__ == "__main__":
     print("Test mode not implemented")
\ No newline at end of file
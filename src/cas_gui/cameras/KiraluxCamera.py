@@ -26,6 +26,10 @@ from cas_gui.cameras.GenericCamera import GenericCameraInterface
         
 class KiraluxCamera(GenericCameraInterface):
     
+    pollTimeoutMs = None
+    lastTimestamp = None
+    supportsGetImageInto = True
+    
     def __init__(self):
         
         self.sdk = TLCameraSDK()
@@ -56,9 +60,55 @@ class KiraluxCamera(GenericCameraInterface):
         
     def get_image(self):
         
+        return self.get_image_into(None)
+    
+    
+    def get_image_into(self, out):
+        
+        self.set_poll_timeout(0)
+        return self.get_pending_image(out)
+    
+    
+    def get_image_wait(self, timeout = 0.1):
+        """ Waits up to timeout seconds for the next image.
+        """
+        return self.get_image_wait_into(None, timeout)
+    
+    
+    def get_image_wait_into(self, out, timeout = 0.1):
+        """ Waits up to timeout seconds for the next image, and writes it
+        into out if it is an array of the correct shape and dtype.
+        """
+        self.set_poll_timeout(int(timeout * 1000))
+        return self.get_pending_image(out)
+    
+    
+    def get_hardware_timestamp(self):
+        """ Returns the camera timestamp of the last image in seconds, 
+        relative to when the camera was armed.
+        """
+        return self.lastTimestamp
+    
+    
+    def set_poll_timeout(self, timeoutMs):
+        """ Sets how long get_pending_frame_or_null waits for a frame. The
+        current value is stored to avoid setting it for every frame.
+        """
+        if self.pollTimeoutMs != timeoutMs:
+            self.camera.image_poll_timeout_ms = timeoutMs
+            self.pollTimeoutMs = timeoutMs
+    
+    
+    def get_pending_image(self, out = None):
+        
         self.frame = self.camera.get_pending_frame_or_null()
         if self.frame is not None:
-            imageData = self.frame.image_buffer >> (self.camera.bit_depth - 8)
+            imageBuffer = self.frame.image_buffer
+            if out is None or out.shape != imageBuffer.shape or out.dtype != imageBuffer.dtype:
+                out = None
+            imageData = np.right_shift(imageBuffer, self.camera.bit_depth - 8, out = out)
+            timestampNs = self.frame.time_stamp_relative_ns_or_null
+            self.lastTimestamp = None if timestampNs is None else timestampNs / 1e9
         else:
             imageData = None
         return imageData
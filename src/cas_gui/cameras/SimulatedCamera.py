@@ -7,7 +7,7 @@ from a file (image or video).
 
 """
 
-from cas_gui.cameras.GenericCamera import GenericCameraInterface
+from cas_gui.cameras.GenericCamera import GenericCameraInterface, copy_into
 from PIL import Image, ImageSequence
 import numpy as np
 import time
@@ -15,8 +15,10 @@ import time
 class SimulatedCamera(GenericCameraInterface):    
     
     preLoaded = False
+    dataset = None
     currentFrame = 0
     dtype = 'uint16'   
+    supportsGetImageInto = True
     
     def __init__(self, **kwargs):         
         
@@ -71,11 +73,11 @@ class SimulatedCamera(GenericCameraInterface):
                 framesToLoad = min(nImages, self.dataset.n_frames)
             else:
                 framesToLoad = self.dataset.n_frames
-            self.imageBuffer = np.zeros((h,w,framesToLoad), dtype = self.dtype)
+            self.imageBuffer = np.zeros((framesToLoad,h,w), dtype = self.dtype)
     
             for i in range(framesToLoad):
                 self.dataset.seek(i)
-                self.imageBuffer[:,:,i] = np.array(self.dataset).astype(self.dtype)
+                self.imageBuffer[i] = np.array(self.dataset).astype(self.dtype)
             self.preLoaded = True
 
 
@@ -87,6 +89,12 @@ class SimulatedCamera(GenericCameraInterface):
     def get_image(self):
        # Either loads the next image from the file or, if we have pre-loaded,
        # copies the image from memory. Returns the image.
+       return self.get_image_into(None)
+   
+    
+    def get_image_into(self, out):
+       # As get_image, but copies the image into out if it is an array of
+       # the correct shape and dtype
        
        imData = None
        
@@ -116,9 +124,11 @@ class SimulatedCamera(GenericCameraInterface):
                    
                if self.preLoaded:
                 
-                   if self.currentFrame >= np.shape(self.imageBuffer)[2]:
+                   if self.currentFrame >= np.shape(self.imageBuffer)[0]:
                        self.currentFrame = 0
-                   imData = self.imageBuffer[:,:,self.currentFrame].astype(self.dtype)
+                   imData = copy_into(self.imageBuffer[self.currentFrame], out)
+                   if imData is not out:
+                       imData = imData.copy()
                    
                else:
                        
@@ -126,7 +136,7 @@ class SimulatedCamera(GenericCameraInterface):
                        self.currentFrame = 0
                    
                    self.dataset.seek(self.currentFrame)
-                   imData = np.array(self.dataset.getdata()).reshape(self.dataset.size[1], self.dataset.size[0]).astype(self.dtype)
+                   imData = copy_into(np.asarray(self.dataset).astype(self.dtype), out)
     
                self.currentFrame = self.currentFrame + 1
                self.actualFrameRate = 1/(time.perf_counter() - self.lastImageTime)     
@@ -135,6 +145,35 @@ class SimulatedCamera(GenericCameraInterface):
        return imData
     
     
+    def get_image_wait(self, timeout = 0.1):
+        """ Sleeps until the next image is due, provided this is within 
+        timeout seconds, and then returns it. Otherwise returns None after
+        timeout seconds.
+        """
+        return self.get_image_wait_into(None, timeout)
+    
+    
+    def get_image_wait_into(self, out, timeout = 0.1):
+        """ As get_image_wait, but copies the image into out if it is an
+        array of the correct shape and dtype.
+        """
+        
+        # No image can be produced, so wait for the timeout rather than
+        # returning immediately
+        if self.dataset is None or self.fps <= 0:
+            time.sleep(timeout)
+            return None
+        
+        waitNeeded = 1/self.fps - (time.perf_counter() - self.lastImageTimeAdjusted)
+        if waitNeeded > timeout:
+            time.sleep(timeout)
+            return None
+        elif waitNeeded > 0:
+            time.sleep(waitNeeded)
+        
+        return self.get_image_into(out)
+            
+    
     
     # The following are implmented to better simulate a real camera:
     
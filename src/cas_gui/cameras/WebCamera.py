@@ -15,6 +15,9 @@ from cas_gui.cameras.GenericCamera import GenericCameraInterface
         
 class WebCamera(GenericCameraInterface):    
   
+    supportsGetImageInto = True
+    frameBuffer = None
+    sumBuffer = None
     
     def __init__(self):
         
@@ -42,6 +45,10 @@ class WebCamera(GenericCameraInterface):
            
 
     def get_image(self):
+       return self.get_image_into(None)
+   
+    
+    def get_image_into(self, out):
     
        # Calculate delay needed to achieve desired frame rate
        if self.fps > 0:
@@ -63,7 +70,7 @@ class WebCamera(GenericCameraInterface):
            # wait needed shorter. This lead to a more accurate frame rate.
            self.lastImageTimeAdjusted = self.lastImageTime - waitNeeded
 
-           imageData = self.grab_image()
+           imageData = self.grab_image(out)
 
            self.actualFrameRate = 1/(time.perf_counter() - self.lastImageTime)     
        
@@ -73,14 +80,50 @@ class WebCamera(GenericCameraInterface):
       
        return imageData
    
+    
+    def get_image_wait(self, timeout = 0.1):
+        """ Sleeps until the next image is due, provided this is within 
+        timeout seconds, and then returns it. Otherwise returns None after
+        timeout seconds.
+        """
+        return self.get_image_wait_into(None, timeout)
+    
+    
+    def get_image_wait_into(self, out, timeout = 0.1):
+        """ As get_image_wait, but writes the image into out if it is an
+        array of the correct shape and dtype.
+        """
+        
+        if self.fps > 0:
+            waitNeeded = 1/self.fps - (time.perf_counter() - self.lastImageTimeAdjusted)
+            if waitNeeded > timeout:
+                time.sleep(timeout)
+                return None
+            elif waitNeeded > 0:
+                time.sleep(waitNeeded)
+        
+        return self.get_image_into(out)
+    
 
-    def grab_image(self):
-        """ Pull image from camera
+    def grab_image(self, out = None):
+        """ Pull image from camera. The image is written into out if it is
+        an array of the correct shape and dtype, otherwise a new array is
+        returned. The colour frame read from the camera is reused.
         """        
-        rval, imageData = self.vc.read()
-        imageData = np.mean(imageData, 2).astype('uint8')
+        rval, self.frameBuffer = self.vc.read(self.frameBuffer)
+        if not rval:
+            return None
+        
+        # Mean of the colour channels, rounded down as for astype('uint8')
+        shape = self.frameBuffer.shape[:2]
+        if self.sumBuffer is None or self.sumBuffer.shape != shape:
+            self.sumBuffer = np.empty(shape, dtype = 'uint16')
+        np.sum(self.frameBuffer, 2, dtype = 'uint16', out = self.sumBuffer)
+        if out is None or out.shape != shape or out.dtype != np.uint8:
+            out = np.empty(shape, dtype = 'uint8')
+        np.floor_divide(self.sumBuffer, 3, out = out, casting = 'unsafe')
         
-        return imageData
+        return out
         
    
     def set_frame_rate_on(self):
@@ -16,12 +16,16 @@ from cas_gui.cameras.WebCamera import WebCamera
 class WebCameraColour(WebCamera):
 
           
-    def grab_image(self):
+    def grab_image(self, out = None):
         
-        rval, imageData = self.vc.read()
-        imageData = cv.cvtColor(imageData, cv.COLOR_BGR2RGB)
+        rval, self.frameBuffer = self.vc.read(self.frameBuffer)
+        if not rval:
+            return None
         
-        return imageData.astype('uint8')
+        if out is not None and out.shape == self.frameBuffer.shape and out.dtype == np.uint8:
+            return cv.cvtColor(self.frameBuffer, cv.COLOR_BGR2RGB, dst = out)
+        else:
+            return cv.cvtColor(self.frameBuffer, cv.COLOR_BGR2RGB)
 
 
     def is_colour(self):
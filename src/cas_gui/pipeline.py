@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Runs image acquisition, processing and recording without the GUI, for
+example for unattended acquisitions on machines with no display. The same
+camera classes and Image Processor Classes are used as by CAS_GUI, and
+images are handled as soon as they are available rather than on a timer.
+
+Example:
+
+    pipeline = Pipeline('SimulatedCamera', processor = MyProcessor,
+                        recordFilename = 'record.tif', filename = 'vid.tif')
+    pipeline.start()
+    pipeline.run(numFrames = 1000)
+    pipeline.stop()
+
+The pipeline can also be run from the command line, using the cas-pipeline
+command (or python -m cas_gui.pipeline), see main().
+
+"""
+
+import sys
+import time
+import argparse
+import importlib
+import multiprocessing
+
+from cas_gui.threads.image_acquisition_thread import ImageAcquisitionThread
+from cas_gui.threads.image_processor_thread import ImageProcessorThread
+from cas_gui.utils.pipeline_metrics import PipelineMetrics
+from cas_gui.utils.recorders import create_recorder
+
+
+class Pipeline:
+    """ Acquires images from a camera, optionally processes and records them.
+
+    Arguments:
+        camName          : str
+                           name of camera class, as for ImageAcquisitionThread
+
+    Keyword Arguments:
+        processor        : class or None
+                           Image Processor Class (not an instance) to process
+                           images with, default is None (no processing)
+        recordFilename   : str or None
+                           file to record to, the type of file is determined
+                           from the extension (see create_recorder). Default
+                           is None (no recording)
+        recordRaw        : boolean
+                           if True, raw images are recorded even if there is
+                           a processor. Default is False
+        multiCore        : boolean
+                           if True, processing is performed in a different
+                           process (default is False)
+        numWorkers       : int
+                           number of processes to use if multiCore is True
+                           (default is 1)
+        sharedMemory     : boolean
+                           if True, and multiCore is True, processed images
+                           are returned via shared memory (default is False)
+        bufferSize       : int
+                           size of raw and processed image queues (default
+                           is 10)
+        cameraID         : int
+                           ID of camera (default is 0)
+        metrics          : PipelineMetrics or None
+                           metrics object to record timings in, default is to
+                           create one
+        camArgs          : any other keyword arguments are passed to the
+                           camera class
+    """
+
+    waitTimeout = 0.1
+    framePoolSize = 16      # Number of reusable raw image buffers, see ImageAcquisitionThread
+
+    imageThread = None
+    imageProcessor = None
+    recorder = None
+
+    def __init__(self, camName, processor = None, recordFilename = None, recordRaw = False,
+                 multiCore = False, numWorkers = 1, sharedMemory = False, bufferSize = 10,
+                 cameraID = 0, metrics = None, **camArgs):
+
+        self.camName = camName
+        self.processor = processor
+        self.recordFilename = recordFilename
+        self.recordRaw = recordRaw or processor is None
+        self.multiCore = multiCore
+        self.numWorkers = numWorkers
+        self.sharedMemory = sharedMemory
+        self.bufferSize = bufferSize
+        self.cameraID = cameraID
+        self.camArgs = camArgs
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = PipelineMetrics()
+
+        self.numFramesHandled = 0
+        self.isRunning = False
+        self.currentFrame = None
+
+
+    def start(self):
+        """ Creates the recorder and starts the acquisition and processing
+        threads.
+        """
+
+        if self.recordFilename is not None:
+            self.recorder = create_recorder(self.recordFilename)
+
+        self.inputQueue = multiprocessing.Queue(maxsize = self.bufferSize)
+
+        if self.processor is not None:
+            self.imageProcessor = ImageProcessorThread(self.processor, self.bufferSize, self.bufferSize,
+                                                       inputQueue = self.inputQueue,
+                                                       multiCore = self.multiCore,
+                                                       numWorkers = self.numWorkers,
+                                                       sharedMemory = self.sharedMemory,
+                                                       metrics = self.metrics)
+
+        self.imageThread = ImageAcquisitionThread(self.camName, self.bufferSize, imageQueue = self.inputQueue,
+                                                  cameraID = self.cameraID, metrics = self.metrics,
+                                                  framePoolSize = self.framePoolSize, **self.camArgs)
+
+        # Raw images to record are taken from the auxillary queue so that
+        # they can also be processed
+        if self.recorder is not None and self.recordRaw and self.imageProcessor is not None:
+            self.imageThread.set_use_auxillary_queue(True)
+
+        if self.imageProcessor is not None:
+            self.imageProcessor.start()
+        self.imageThread.start()
+        self.isRunning = True
+
+
+    def get_processor(self):
+        """ Returns the local copy of the processor, or None if there is no
+        processor.
+        """
+        if self.imageProcessor is not None:
+            return self.imageProcessor.get_processor()
+        else:
+            return None
+
+
+    def pipe_message(self, command, parameter):
+        """ Sends a message to update an attribute or call a function in the
+        processor, see ImageProcessorThread.pipe_message.
+        """
+        if self.imageProcessor is not None:
+            self.imageProcessor.pipe_message(command, parameter)
+
+
+    def get_next_frame(self, timeout = None):
+        """ Waits for the next image and returns its FrameRecord, or None if
+        there is no image within timeout seconds. If there is a processor
+        this is the processed image, otherwise the raw image.
+        """
+        if self.imageProcessor is not None:
+            return self.imageProcessor.get_next_frame_wait(timeout)
+        else:
+            return self.imageThread.get_next_frame_wait(timeout)
+
+
+    def handle_frame(self):
+        """ Waits up to waitTimeout seconds for the next image and records
+        it, and any raw images waiting to be recorded. Returns the FrameRecord
+        of the image, or None if there was no image.
+        """
+        frame = self.get_next_frame(self.waitTimeout)
+
+        if self.recorder is not None:
+            if self.recordRaw and self.imageProcessor is not None:
+                while (rawFrame := self.imageThread.get_next_auxillary_frame()) is not None:
+                    self.record_frame(rawFrame)
+            elif frame is not None:
+                self.record_frame(frame)
+
+        if frame is not None:
+            self.currentFrame = frame
+            self.numFramesHandled = self.numFramesHandled + 1
+
+        return frame
+
+
+    def record_frame(self, frame):
+        """ Writes a FrameRecord to the recorder.
+        """
+        with self.metrics.timer(PipelineMetrics.RECORD):
+            self.recorder.write_frame(frame)
+
+
+    def run(self, numFrames = None, duration = None, callback = None):
+        """ Handles images until numFrames images have been handled, duration
+        seconds have elapsed or stop() is called. If neither numFrames or
+        duration is specified this runs until stop() is called from another
+        thread.
+
+        Keyword Arguments:
+            numFrames : int or None
+                        number of images to handle (default is None)
+            duration  : float or None
+                        time to run for in seconds (default is None)
+            callback  : function or None
+                        function called with the FrameRecord of each image
+
+        Returns:
+            int       : number of images handled
+        """
+        startTime = time.perf_counter()
+        numFrames = None if numFrames is None else self.numFramesHandled + numFrames
+        numHandled = self.numFramesHandled
+
+        while self.isRunning:
+            if numFrames is not None and self.numFramesHandled >= numFrames:
+                break
+            if duration is not None and time.perf_counter() - startTime >= duration:
+                break
+
+            frame = self.handle_frame()
+            if frame is not None and callback is not None:
+                callback(frame)
+
+        return self.numFramesHandled - numHandled
+
+
+    def stop(self):
+        """ Stops the threads and finishes the recording.
+        """
+        self.isRunning = False
+        if self.imageThread is not None:
+            self.imageThread.stop()
+        if self.imageProcessor is not None:
+            self.imageProcessor.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+        return False
+
+
+def import_class(name):
+    """ Imports a class from a name of the form module.ClassName or
+    module:ClassName. If there is no module, the class is assumed to be in a
+    module of the same name.
+    """
+    if ':' in name:
+        moduleName, className = name.split(':', 1)
+    elif '.' in name:
+        moduleName, className = name.rsplit('.', 1)
+    else:
+        moduleName, className = name, name
+    return getattr(importlib.import_module(moduleName), className)
+
+
+def parse_value(value):
+    """ Converts a command line value to an int, float or boolean if
+    possible, otherwise returns the string.
+    """
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    for valueType in (int, float):
+        try:
+            return valueType(value)
+        except ValueError:
+            pass
+    return value
+
+
+def main(args = None):
+    """ Command line entry point. Run with --help for options.
+    """
+
+    parser = argparse.ArgumentParser(description = "Acquire, process and record images without the CAS GUI.")
+    parser.add_argument('camera', help = "name of camera class, e.g. SimulatedCamera")
+    parser.add_argument('--processor', help = "Image Processor Class, as module.ClassName")
+    parser.add_argument('--set', action = 'append', default = [], metavar = 'NAME=VALUE',
+                        help = "set an attribute of, or call a function of, the processor (repeatable)")
+    parser.add_argument('--record', metavar = 'FILENAME', help = "file to record to (.tif, .avi, .mkv, .raw or .chunks)")
+    parser.add_argument('--record-raw', action = 'store_true', help = "record raw rather than processed images")
+    parser.add_argument('--frames', type = int, help = "number of images to acquire")
+    parser.add_argument('--duration', type = float, help = "time to acquire for in seconds")
+    parser.add_argument('--multicore', action = 'store_true', help = "process images in another process")
+    parser.add_argument('--workers', type = int, default = 1, help = "number of processes when using --multicore")
+    parser.add_argument('--shared-memory', action = 'store_true', help = "return processed images via shared memory")
+    parser.add_argument('--buffer-size', type = int, default = 10, help = "size of image queues")
+    parser.add_argument('--camera-id', type = int, default = 0, help = "ID of camera")
+    parser.add_argument('--camera-arg', action = 'append', default = [], metavar = 'NAME=VALUE',
+                        help = "keyword argument for camera class, e.g. filename=vid.tif (repeatable)")
+    parser.add_argument('--metrics', action = 'store_true', help = "print pipeline metrics at the end")
+    options = parser.parse_args(args)
+
+    camArgs = dict(arg.split('=', 1) for arg in options.camera_arg)
+    processor = import_class(options.processor) if options.processor is not None else None
+
+    pipeline = Pipeline(options.camera, processor = processor, recordFilename = options.record,
+                        recordRaw = options.record_raw, multiCore = options.multicore,
+                        numWorkers = options.workers, sharedMemory = options.shared_memory,
+                        bufferSize = options.buffer_size, cameraID = options.camera_id, **camArgs)
+
+    pipeline.start()
+    for setting in options.set:
+        name, value = setting.split('=', 1)
+        pipeline.pipe_message(name, parse_value(value))
+
+    startTime = time.perf_counter()
+    try:
+        numFrames = pipeline.run(numFrames = options.frames, duration = options.duration)
+    except KeyboardInterrupt:
+        numFrames = pipeline.numFramesHandled
+    finally:
+        pipeline.stop()
+
+    elapsed = time.perf_counter() - startTime
+    print(f"Handled {numFrames} frames in {elapsed:.1f} s ({numFrames / max(elapsed, 1e-9):.1f} fps).")
+    if options.metrics:
+        print(pipeline.metrics.format_summary())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+BatchBuffer
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A reusable buffer in which an ImageProcessorThread or ImageProcessorProcess
+assembles batches of images when batchProcessNum is greater than 1.
+
+The buffer is frame-major, of shape (batchProcessNum, h, w), so that each
+image is copied into a contiguous block of memory. It is allocated for the
+first batch and reused for every following batch of the same size, shape
+and dtype. If a stack of images of the size of the batch is received (see
+ImageAcquisitionThread.set_stack_size), it is used as the batch without
+copying, unless it has to be converted to a different dtype.
+
+The batch is passed to the processor in the layout and dtype that the
+processor declares (see batchLayout and batchDtype in ImageProcessorClass).
+The dtype of the images is kept if batchDtype is None. FRAMES_LAST batches,
+of shape (h, w, batchProcessNum), are a view of the buffer and so are not
+contiguous.
+
+Because the buffer is reused, a batch is only valid until the next batch is
+assembled. detach() should be called on anything the processor returns, so
+that an output which shares memory with the batch (for example one image
+of the batch) is copied before the batch is overwritten.
+
+"""
+
+import numpy as np
+
+from cas_gui.threads.image_processor_class import ImageProcessorClass
+
+
+class BatchBuffer:
+    """ Reusable buffer for assembling batches of images.
+    """
+
+    def __init__(self):
+
+        self.buffer = None
+        self.batch = None
+
+
+    def allocate(self, num, shape, dtype):
+        """ Returns the buffer for num images of a particular shape and dtype,
+        reallocating it if it is not already this size and dtype.
+        """
+        shape = (num,) + tuple(shape)
+        if self.buffer is None or self.buffer.shape != shape or self.buffer.dtype != dtype:
+            self.buffer = np.empty(shape, dtype = dtype)
+        return self.buffer
+
+
+    def assemble(self, frame, get_next_image, num, layout = ImageProcessorClass.FRAMES_LAST, dtype = 'float64'):
+        """ Returns a batch of num images starting with the image of a
+        FrameRecord.
+
+        Arguments:
+            frame          : FrameRecord
+                             first image of batch, or a stack of num images
+            get_next_image : function
+                             called with no arguments to obtain each of the
+                             remaining images of the batch
+            num            : int
+                             number of images in batch
+
+        Keyword Arguments:
+            layout         : int
+                             ImageProcessorClass.FRAMES_FIRST for a batch of
+                             shape (num, h, w) or FRAMES_LAST (default) for
+                             (h, w, num)
+            dtype          : str, numpy.dtype or None
+                             dtype of batch, None to keep the dtype of the
+                             images (default is 'float64')
+
+        Returns:
+            numpy.ndarray  : batch of images
+        """
+
+        image = np.asarray(frame.image)
+        dtype = image.dtype if dtype is None else np.dtype(dtype)
+
+        if frame.numImages == num:
+            if image.dtype == dtype:
+                batch = image
+            else:
+                batch = self.allocate(num, image.shape[1:], dtype)
+                batch[:] = image
+        else:
+            batch = self.allocate(num, image.shape, dtype)
+            batch[0] = image
+            for idx in range(1, num):
+                batch[idx] = get_next_image()
+
+        self.batch = batch
+        if layout == ImageProcessorClass.FRAMES_LAST:
+            return np.moveaxis(batch, 0, -1)
+        else:
+            return batch
+
+
+    def detach(self, output):
+        """ Returns output, or a copy of it if it is an array which shares
+        memory with the last batch. If output is a tuple of (image, id) the
+        image is copied if necessary.
+        """
+        if isinstance(output, tuple):
+            return (self.detach(output[0]),) + output[1:]
+        if self.batch is not None and isinstance(output, np.ndarray) and np.may_share_memory(output, self.batch):
+            return output.copy()
+        return output
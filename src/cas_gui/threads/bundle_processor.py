@@ -51,6 +51,13 @@ class BundleProcessor(ImageProcessorClass):
 
                 
     def process(self, inputFrame):
+        
+        return self.process_reduce(self.process_map(inputFrame))
+    
+    
+    def process_map(self, inputFrame):
+        """ Background subtraction (in dual mode) and bundle processing.
+        """
         outputFrame = inputFrame
 
         if self.dualMode:
@@ -66,6 +73,13 @@ class BundleProcessor(ImageProcessorClass):
         outputFrame = self.pyb.process(outputFrame)
         #print("Proc:" + str(time.perf_counter() - t1))
         #self.preProcessFrame = outputFrame
+        
+        return outputFrame
+    
+    
+    def process_reduce(self, outputFrame):
+        """ Adds the processed frame to the mosaic, if mosaicing.
+        """
         #print(self.mosaicing)
         if self.mosaicing and outputFrame is not None:
             self.mosaic.add(outputFrame)
@@ -73,6 +87,19 @@ class BundleProcessor(ImageProcessorClass):
         return outputFrame
 
 
+    def get_parallel_mode(self):
+        """ In dual mode each frame depends on the previous frame. Otherwise,
+        frames can be processed in parallel, but must be added to the mosaic
+        in order.
+        """
+        if self.dualMode:
+            return self.STATEFUL
+        elif self.mosaicing:
+            return self.MAP_REDUCE
+        else:
+            return self.STATELESS
+    
+    
     def get_mosaic(self):
         if self.mosaicing: 
             return self.mosaic.get_mosaic()
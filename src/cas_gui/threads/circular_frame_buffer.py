@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+CircularFrameBuffer
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A fixed-size circular buffer of the most recent frames from an
+ImageAcquisitionThread, used to record the frames from before an event
+(pre-trigger recording).
+
+The frames are copied into a single preallocated numpy array of shape
+(numFrames, height, width), so that the memory used does not change while
+acquiring and no memory is allocated per frame. The array is allocated when
+the first frame is added, using the size and type of that frame, and is
+reallocated (discarding the frames held) if the size or type of the frames
+changes. The frame number, timestamps and camera ID of each frame are
+stored in separate arrays.
+
+Each frame added is given an index, starting at 0 and increasing by 1 for
+each frame. The frame with a particular index can be retrieved using
+get_frame() until it is overwritten, which happens numFrames frames later.
+
+To record the frames around an event, use a TriggeredRecorderThread (in
+cas_gui.threads.recorder_thread), which writes the frames from the buffer
+to a recorder in the background, starting before the event and continuing
+as new frames are added.
+
+"""
+
+import time
+import threading
+
+import numpy as np
+
+from cas_gui.threads.frame_record import FrameRecord
+
+
+class CircularFrameBuffer:
+    """ Circular buffer of recent frames.
+
+    Keyword Arguments:
+        numFrames : int
+                    maximum number of frames to hold (default is 1000)
+        maxBytes  : int or None
+                    if specified, the number of frames is reduced if
+                    necessary so that the buffer uses no more than this
+                    many bytes (default is None)
+    """
+
+    def __init__(self, numFrames = 1000, maxBytes = None):
+
+        self.maxFrames = numFrames
+        self.maxBytes = maxBytes
+        self.numFrames = numFrames
+
+        self.frames = None
+        self.numAdded = 0
+        self.firstIndex = 0
+
+        self.condition = threading.Condition()
+
+
+    def allocate(self, shape, dtype):
+        """ Allocates the buffer for frames of a particular shape and dtype,
+        discarding any frames held.
+        """
+
+        dtype = np.dtype(dtype)
+        frameBytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        numFrames = self.maxFrames
+        if self.maxBytes is not None:
+            numFrames = max(min(numFrames, int(self.maxBytes // frameBytes)), 1)
+
+        with self.condition:
+            self.frames = np.empty((numFrames,) + tuple(shape), dtype = dtype)
+            self.numFrames = numFrames
+            self.frameNumbers = np.full(numFrames, -1, dtype = np.int64)
+            self.timestamps = np.full(numFrames, np.nan)
+            self.hardwareTimestamps = np.full(numFrames, np.nan)
+            self.cameraIDs = np.zeros(numFrames, dtype = np.int64)
+            self.firstIndex = self.numAdded
+
+
+    def add_frame(self, frame):
+        """ Copies a frame, either a FrameRecord or an image, into the
+        buffer, overwriting the oldest frame if the buffer is full.
+        """
+
+        record = frame if isinstance(frame, FrameRecord) else None
+        image = np.asarray(frame.image if record is not None else frame)
+
+        if self.frames is None or image.shape != self.frames.shape[1:] or image.dtype != self.frames.dtype:
+            self.allocate(image.shape, image.dtype)
+
+        with self.condition:
+            slot = self.numAdded % self.numFrames
+            self.frames[slot] = image
+            if record is not None:
+                self.frameNumbers[slot] = record.frameNumber
+                self.timestamps[slot] = record.timestamp
+                self.hardwareTimestamps[slot] = np.nan if record.hardwareTimestamp is None else record.hardwareTimestamp
+                self.cameraIDs[slot] = record.cameraID
+            else:
+                self.frameNumbers[slot] = self.numAdded
+                self.timestamps[slot] = time.perf_counter()
+                self.hardwareTimestamps[slot] = np.nan
+                self.cameraIDs[slot] = 0
+            self.numAdded = self.numAdded + 1
+            self.condition.notify_all()
+
+
+    def get_oldest_index(self):
+        """ Returns the index of the oldest frame in the buffer.
+        """
+        with self.condition:
+            return max(self.firstIndex, self.numAdded - self.numFrames)
+
+
+    def get_next_index(self):
+        """ Returns the index that the next frame added will have.
+        """
+        return self.numAdded
+
+
+    def get_num_frames_held(self):
+        """ Returns the number of frames in the buffer.
+        """
+        with self.condition:
+            return self.numAdded - max(self.firstIndex, self.numAdded - self.numFrames)
+
+
+    def get_frame(self, index, timeout = None):
+        """ Returns a copy of the frame with a particular index as a
+        FrameRecord. If the frame has not been added yet, this waits for up
+        to timeout seconds for it.
+
+        Arguments:
+            index   : int
+                      index of frame
+
+        Keyword Arguments:
+            timeout : float or None
+                      maximum time to wait in seconds, default is not to wait
+
+        Returns:
+            FrameRecord : frame, or None if the frame has been overwritten,
+                          or has not been added before the timeout
+        """
+
+        with self.condition:
+            if timeout is not None:
+                self.condition.wait_for(lambda: self.numAdded > index, timeout)
+            if index >= self.numAdded or index < max(self.firstIndex, self.numAdded - self.numFrames):
+                return None
+            slot = index % self.numFrames
+            hardwareTimestamp = self.hardwareTimestamps[slot]
+            return FrameRecord(self.frames[slot].copy(), int(self.frameNumbers[slot]),
+                               float(self.timestamps[slot]),
+                               None if np.isnan(hardwareTimestamp) else float(hardwareTimestamp),
+                               int(self.cameraIDs[slot]))
+
+
+    def find_index(self, timestamp):
+        """ Returns the index of the oldest frame in the buffer acquired at
+        or after timestamp (a time.perf_counter() value). If there is no
+        such frame, the index the next frame will have is returned.
+        """
+
+        with self.condition:
+            indices = np.arange(max(self.firstIndex, self.numAdded - self.numFrames), self.numAdded)
+            if len(indices) == 0:
+                return self.numAdded
+            timestamps = self.timestamps[indices % self.numFrames]
+            return int(indices[0] + np.searchsorted(timestamps, timestamp))
+
+
+    def clear(self):
+        """ Discards all frames held. The memory is not released.
+        """
+        with self.condition:
+            self.firstIndex = self.numAdded
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+DisplayRenderThread
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Thread which prepares images for display away from the GUI thread, used by
+ImageDisplay when its render thread is enabled (see
+ImageDisplay.set_render_thread_enabled).
+
+Each job submitted is rendered by calling a render function with the job,
+which should return the image ready to be shown (for ImageDisplay a
+screen-sized QImage). Only the newest job is kept: if a job is submitted
+while another is waiting to be rendered, the waiting job is dropped.
+Similarly, only the newest rendered image is kept until it is collected
+using get_latest(). The display rate is therefore limited by the rate at
+which images can be rendered and shown, and not by the rate at which they
+are submitted, and stale images are never shown.
+
+After each image is rendered the callback is called, from this thread. For
+a Qt widget this should emit a signal connected to a slot which calls
+get_latest() and shows the image, so that the image is shown in the GUI
+thread.
+
+The time taken to render each image is recorded in the display stage of a
+PipelineMetrics object, together with the number of images dropped.
+
+"""
+
+import threading
+import logging
+
+from cas_gui.utils.pipeline_metrics import PipelineMetrics
+
+
+class DisplayRenderThread(threading.Thread):
+    """ Renders images for display in a separate thread.
+
+    Arguments:
+        render_function : function
+                          called with each job, returns the rendered image
+
+    Keyword Arguments:
+        callback        : function or None
+                          called with no arguments after each image is
+                          rendered (default is None)
+        metrics         : PipelineMetrics or None
+                          metrics object to record render times and dropped
+                          images in, default is to create one
+    """
+
+    waitTimeout = 0.1
+
+    def __init__(self, render_function, callback = None, metrics = None):
+
+        super().__init__()
+        self.daemon = True
+        self.render_function = render_function
+        self.callback = callback
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = PipelineMetrics()
+
+        self.pendingJob = None
+        self.latest = None
+        self.numRendered = 0
+        self.numDropped = 0
+        self.isRunning = True
+        self.condition = threading.Condition()
+
+
+    def run(self):
+
+        while self.isRunning:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pendingJob is not None or not self.isRunning, self.waitTimeout)
+                job = self.pendingJob
+                self.pendingJob = None
+            if job is None:
+                continue
+
+            try:
+                with self.metrics.timer(PipelineMetrics.DISPLAY):
+                    rendered = self.render_function(job)
+            except Exception as e:
+                logging.exception(e)
+                continue
+
+            with self.condition:
+                if self.latest is not None:
+                    self.numDropped = self.numDropped + 1
+                    self.metrics.add_drop(PipelineMetrics.DISPLAY)
+                self.latest = rendered
+                self.numRendered = self.numRendered + 1
+
+            if self.callback is not None:
+                self.callback()
+
+
+    def submit(self, job):
+        """ Adds a job to be rendered, replacing any job still waiting.
+        """
+        with self.condition:
+            if self.pendingJob is not None:
+                self.numDropped = self.numDropped + 1
+                self.metrics.add_drop(PipelineMetrics.DISPLAY)
+            self.pendingJob = job
+            self.condition.notify()
+
+
+    def get_latest(self):
+        """ Returns the most recently rendered image, or None if there is no
+        image which has not already been returned.
+        """
+        with self.condition:
+            rendered = self.latest
+            self.latest = None
+        return rendered
+
+
+    def stop(self):
+        """ Stops the thread, waiting for any image being rendered.
+        """
+        with self.condition:
+            self.isRunning = False
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
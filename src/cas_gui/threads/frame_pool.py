@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+FramePool
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A pool of preallocated image buffers which an ImageAcquisitionThread reuses
+for images from the camera, so that a new array is not allocated for every
+image. Cameras which support it (see GenericCameraInterface.get_image_into)
+write each image directly into a buffer from the pool.
+
+The buffers are views of a single contiguous block of memory, allocated
+when the size and type of the images is known. A buffer is in use as long
+as any array refers to it, including views of it such as crops, and
+returns to the pool automatically once every consumer (the image queues,
+the GUI, recorders etc.) has released its references. Consumers therefore
+do not need to do anything to release buffers, but must not keep an image
+once they are finished with it if the pool is to be reused efficiently. If
+all the buffers are in use, acquire() returns None and the caller should
+allocate a new array instead.
+
+"""
+
+import sys
+import threading
+
+import numpy as np
+
+
+class FramePool:
+    """ Pool of reusable image buffers.
+
+    Keyword Arguments:
+        numBuffers : int
+                     number of buffers (default is 16)
+    """
+
+    def __init__(self, numBuffers = 16):
+
+        self.numBuffers = numBuffers
+        self.shape = None
+        self.dtype = None
+        self.block = None
+        self.owners = []
+        self.nextBuffer = 0
+        self.numAcquired = 0
+        self.numMisses = 0
+        self.lock = threading.Lock()
+
+
+    def allocate(self, shape, dtype):
+        """ Allocates the buffers for images of a particular shape and dtype.
+        Any buffers still in use from a previous allocation remain valid
+        until released but are not reused.
+        """
+
+        dtype = np.dtype(dtype)
+        bufferBytes = int(np.prod(shape)) * dtype.itemsize
+
+        with self.lock:
+            self.block = np.empty(self.numBuffers * bufferBytes, dtype = np.uint8)
+            blockView = memoryview(self.block)
+
+            # Each buffer is a separate array viewing part of the block. All
+            # arrays derived from a buffer refer to this array, so its
+            # reference count tells us whether the buffer is in use.
+            self.owners = [np.frombuffer(blockView[idx * bufferBytes:(idx + 1) * bufferBytes], dtype = np.uint8)
+                           for idx in range(self.numBuffers)]
+            self.shape = tuple(shape)
+            self.dtype = dtype
+            self.nextBuffer = 0
+
+
+    def is_allocated(self):
+        """ Returns True if the buffers have been allocated.
+        """
+        return self.block is not None
+
+
+    def matches(self, shape, dtype):
+        """ Returns True if the buffers are allocated for images of this
+        shape and dtype.
+        """
+        return self.block is not None and tuple(shape) == self.shape and np.dtype(dtype) == self.dtype
+
+
+    def _is_free(self, idx):
+        # One reference is held by the list of owners and one by the
+        # argument to getrefcount
+        return sys.getrefcount(self.owners[idx]) <= 2
+
+
+    def acquire(self):
+        """ Returns a free buffer, as an array of the allocated shape and
+        dtype, or None if all buffers are in use or the buffers have not
+        been allocated. The buffer returns to the pool once it, and any
+        views of it, are no longer referenced.
+        """
+
+        with self.lock:
+            if self.block is None:
+                return None
+            for step in range(self.numBuffers):
+                idx = (self.nextBuffer + step) % self.numBuffers
+                if self._is_free(idx):
+                    self.nextBuffer = (idx + 1) % self.numBuffers
+                    self.numAcquired = self.numAcquired + 1
+                    return self.owners[idx].view(self.dtype).reshape(self.shape)
+            self.numMisses = self.numMisses + 1
+            return None
+
+
+    def get_num_free(self):
+        """ Returns the number of buffers not in use.
+        """
+        with self.lock:
+            return sum(self._is_free(idx) for idx in range(len(self.owners)))
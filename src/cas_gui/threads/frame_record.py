@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+FrameRecord
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A compact record which carries an image through the acquisition and
+processing pipeline together with its metadata:
+
+    frameNumber       - sequence number assigned by the ImageAcquisitionThread,
+                        gaps in this show exactly which frames were dropped
+    timestamp         - time.perf_counter() when the image was acquired
+    hardwareTimestamp - timestamp from the camera, in seconds, if the camera
+                        provides one, otherwise None
+    cameraID          - ID of the camera the image came from
+    imageId           - ID number returned by the processor (if it returns a
+                        tuple of (image, id)), otherwise None
+    stageTimes        - dictionary of time.perf_counter() values at which the
+                        image reached each stage of the pipeline
+    numImages         - number of images, 1 unless the image is a stack of
+                        images acquired together, of shape (numImages, h, w),
+                        in which case the metadata is that of the first image
+
+time.perf_counter() uses a system-wide clock, so stage times recorded in
+different processes can be compared. The stages recorded by CAS are
+'acquired', 'processStart', 'processEnd' and 'output' (when the processed
+image is placed in the output queue or shared memory). Other stages can be
+added using mark(), but only the stages in STAGES are carried through
+shared memory.
+
+ImageAcquisitionThread places FrameRecords in its queues, and
+ImageProcessorThread and ImageProcessorProcess accept either FrameRecords
+or bare images, which are wrapped using as_frame_record(). as_image() 
+returns the image from either.
+
+"""
+
+import time
+
+import numpy as np
+
+
+class FrameRecord:
+
+    __slots__ = ('image', 'frameNumber', 'timestamp', 'hardwareTimestamp',
+                 'cameraID', 'imageId', 'stageTimes', 'numImages')
+
+    STAGES = ('acquired', 'processStart', 'processEnd', 'output')
+
+    def __init__(self, image, frameNumber = -1, timestamp = None, hardwareTimestamp = None,
+                 cameraID = 0, imageId = None, stageTimes = None, numImages = 1):
+        """ Creates a record for an image.
+
+        Arguments:
+            image             : numpy.ndarray
+                                the image
+
+        Keyword Arguments:
+            frameNumber       : int
+                                sequence number of frame, -1 (default) if not
+                                known
+            timestamp         : float or None
+                                time.perf_counter() at acquisition, default
+                                is None, in which case the current time is
+                                used
+            hardwareTimestamp : float or None
+                                timestamp from camera in seconds, default is
+                                None (not available)
+            cameraID          : int
+                                ID of camera (default is 0)
+            imageId           : int or None
+                                ID number from the processor (default is None)
+            stageTimes        : dict or None
+                                times at which each stage was reached, default
+                                is to record the 'acquired' stage as timestamp
+            numImages         : int
+                                number of images if image is a stack of images
+                                along the first axis, default is 1
+        """
+
+        self.image = image
+        self.frameNumber = frameNumber
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        self.timestamp = timestamp
+        self.hardwareTimestamp = hardwareTimestamp
+        self.cameraID = cameraID
+        self.imageId = imageId
+        if stageTimes is None:
+            stageTimes = {'acquired': timestamp}
+        self.stageTimes = stageTimes
+        self.numImages = numImages
+
+
+    def __repr__(self):
+        return f"FrameRecord(frameNumber = {self.frameNumber}, shape = {np.shape(self.image)}, imageId = {self.imageId})"
+
+
+    def mark(self, stage, t = None):
+        """ Records the time that the frame reached a stage of the pipeline.
+
+        Arguments:
+            stage : str
+                    name of stage
+
+        Keyword Arguments:
+            t     : float or None
+                    time.perf_counter() value, default is the current time
+        """
+        if t is None:
+            t = time.perf_counter()
+        self.stageTimes[stage] = t
+
+
+    def get_stage_time(self, fromStage, toStage):
+        """ Returns the time in seconds taken between two stages, or None if
+        either stage was not recorded.
+        """
+        if fromStage in self.stageTimes and toStage in self.stageTimes:
+            return self.stageTimes[toStage] - self.stageTimes[fromStage]
+        else:
+            return None
+
+
+    def get_latency(self, stage = 'output'):
+        """ Returns the time in seconds from acquisition until the frame
+        reached stage, or None if stage was not recorded.
+        """
+        if stage in self.stageTimes:
+            return self.stageTimes[stage] - self.timestamp
+        else:
+            return None
+
+
+    def with_image(self, image, imageId = None):
+        """ Returns a new FrameRecord for image with a copy of the metadata
+        of this record, for example for a processed image. The new record
+        is for a single image, even if this record is for a stack.
+        """
+        return FrameRecord(image, self.frameNumber, self.timestamp, self.hardwareTimestamp,
+                           self.cameraID, imageId, dict(self.stageTimes))
+
+
+    def split(self):
+        """ Returns a list of FrameRecords, one for each image of a stack,
+        with consecutive frame numbers. The images are views of the stack.
+        For a single image, returns a list containing this record.
+        """
+        if self.numImages == 1:
+            return [self]
+        return [FrameRecord(self.image[idx], self.frameNumber + idx, self.timestamp, 
+                            self.hardwareTimestamp if idx == 0 else None, self.cameraID,
+                            stageTimes = dict(self.stageTimes))
+                for idx in range(self.numImages)]
+
+
+    def stage_times_to_array(self, out):
+        """ Stores the times of the stages in STAGES in out, an array of
+        floats of the same length, using NaN for stages not recorded. Used
+        to store records in shared memory.
+        """
+        for idx, stage in enumerate(self.STAGES):
+            out[idx] = self.stageTimes.get(stage, np.nan)
+
+
+    @classmethod
+    def stage_times_from_array(cls, times):
+        """ Returns a dictionary of stage times from an array created by
+        stage_times_to_array.
+        """
+        return {stage: float(t) for stage, t in zip(cls.STAGES, times) if not np.isnan(t)}
+
+
+def as_frame_record(item):
+    """ Returns item if it is a FrameRecord, otherwise wraps it in a new
+    FrameRecord with unknown frame number and the current time as the
+    timestamp.
+    """
+    if isinstance(item, FrameRecord):
+        return item
+    else:
+        return FrameRecord(item)
+
+
+def as_image(item):
+    """ Returns the image of item if it is a FrameRecord, otherwise returns
+    item.
+    """
+    if isinstance(item, FrameRecord):
+        return item.image
+    else:
+        return item
@@ -14,6 +14,12 @@ import threading
 import time
 import importlib
 
+import numpy as np
+
+from cas_gui.threads.frame_record import FrameRecord, as_image
+from cas_gui.threads.frame_pool import FramePool
+from cas_gui.utils.pipeline_metrics import PipelineMetrics
+
 class ImageAcquisitionThread(threading.Thread):
     """ Threading class to acquire images from camera.
     
@@ -27,22 +33,58 @@ class ImageAcquisitionThread(threading.Thread):
         bufferSize : int
                      size of queue to store acquired images, default is 10
         aquisitionLock : 
-        imageQueue : Queue or None
+        imageQueue : Queue, SharedFrameBuffer or None
                      Provide a queue here if direct access is required, 
-                     otherwise one will be created and used internally
+                     otherwise one will be created and used internally. A
+                     SharedFrameBuffer can be used to pass images to 
+                     another process without pickling them
         auxillaryQueue : Queue or None
                          Provide a queue here if direct access is required, 
                          otherwise one will be created and used internally
         cameraID   : int 
                      If using an acquirer that has numbered camera IDs,
                      provide this ID here for the desired camera (default = 0)
+        metrics    : PipelineMetrics or None
+                     metrics object to record grab times, queue depths and
+                     dropped frames in. If None (default) one is created,
+                     accessible as the metrics attribute
+        framePoolSize : int
+                        number of preallocated image buffers to reuse for
+                        images from the camera, if the camera supports 
+                        get_image_into. 0 (default) to allocate a new array
+                        for each image
         camArgs    : tuple
                      Provide any additional arguments required by the 
                      acquirer
+                     
+    Images are obtained using the get_image_wait method of the camera, which
+    waits for up to cameraTimeout seconds for an image, so that images are
+    passed on as soon as the camera provides them.
+    
+    Each image is placed in the queues as a FrameRecord, which also stores
+    the frame number, acquisition time, camera timestamp (if available) and
+    camera ID. get_next_image and get_next_auxillary_image return just the
+    image, get_next_frame and get_next_auxillary_frame return the FrameRecord.
+    
+    If framePoolSize is greater than 0, images are written into buffers from 
+    a FramePool, which are reused once the images are no longer referenced
+    anywhere. If all the buffers are in use, a new array is allocated.
+    
+    If set_stack_size is used to set a stack size greater than 1, images are
+    obtained from the camera in batches using get_images_wait, and each item
+    placed in the image queue is a stack of that many images, of shape 
+    (stackSize, h, w), as a FrameRecord with numImages = stackSize. This 
+    reduces the overhead per image at high frame rates, and an 
+    ImageProcessorThread with the same batchProcessNum uses the stack 
+    directly as the batch. Images are placed in the auxillary queue and the
+    circular buffer individually.
     """                 
     
+    cameraTimeout = 0.1
+    
     def __init__(self, camName, bufferSize = 10, acquisitionLock = None, 
-                 imageQueue = None, auxillaryQueue = None, cameraID = 0, **camArgs):
+                 imageQueue = None, auxillaryQueue = None, cameraID = 0, 
+                 metrics = None, framePoolSize = 0, **camArgs):
         
         # Caller passes the name of the camera class (which should be in a
         # module of the same name) in the variable camName. This is dynamically
@@ -63,11 +105,20 @@ class ImageAcquisitionThread(threading.Thread):
             
         self.acquisitionLock = acquisitionLock
         
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = PipelineMetrics()
+        
         super().__init__()
                 
         self.cam.open_camera(cameraID)
+        self.cameraID = cameraID
         self._stop_event = threading.Event()
         
+        # Set when not paused
+        self._resume_event = threading.Event()
+        self._resume_event.set()
+        
         self.bufferSize = bufferSize
                 
         # Main queue for images for display and processing
@@ -84,14 +135,31 @@ class ImageAcquisitionThread(threading.Thread):
         self.numAuxillaryDroppedFrames = 0
         self.useAuxillaryQueue = False
         
+        # Circular buffer of recent images for pre-trigger recording
+        self.circularBuffer = None
+        
+        # Reusable image buffers, only used if the camera can write into them
+        if framePoolSize > 0 and getattr(self.cam, 'supportsGetImageInto', False):
+            self.framePool = FramePool(framePoolSize)
+        else:
+            self.framePool = None
+        
         self.lastFrameTime = 0
         self.frameStepTime = 0
         self.currentFrame = None
+        self.currentFrameRecord = None
         self.currentFrameNumber = 0
         self.isPaused = False
         self.isOpen = True
         self.numRemoveWhenFull = 1
         
+        # Images are placed in the image queue in stacks of stackSize images,
+        # stack is the stack being filled, which has stackCount images so far
+        self.stackSize = 1
+        self.stack = None
+        self.stackCount = 0
+        self.stackTime = None
+        
         
     def run(self):
         """ The main loop. As long as the camera is open and we are not paused, we 
@@ -110,34 +178,172 @@ class ImageAcquisitionThread(threading.Thread):
                     # Check for full queue
                     for idx in range(self.numRemoveWhenFull):
                         if self.imageQueue.qsize() > 0:
-                            self.numDroppedFrames += 1
                             temp = self.imageQueue.get()
+                            numImages = getattr(temp, 'numImages', 1)
+                            self.numDroppedFrames += numImages
+                            self.metrics.add_drop(PipelineMetrics.QUEUE, numImages)
                             
                     if self.acquisitionLock is not None: self.acquisitionLock.release()
         
-                # Try to get an image. If there is no image ready, this should
+                # Try to get an image, waiting for the camera if there is no
+                # image ready yet. If there is still no image, this should
                 # return None.
-                frame = self.cam.get_image()
-
-                if frame is not None:
+                grabStart = time.perf_counter()
+                if self.stackSize > 1:
+                    record = self.get_camera_stack()
+                else:
+                    frame = self.get_camera_image()
+                    if frame is not None:
+                        record = FrameRecord(frame, self.currentFrameNumber, 
+                                             hardwareTimestamp = self.get_hardware_timestamp(),
+                                             cameraID = self.cameraID)
+                    else:
+                        record = None
 
-                    self.currentFrameNumber = self.currentFrameNumber + 1
+                if record is not None:
+                    
+                    self.metrics.add_time(PipelineMetrics.GRAB, time.perf_counter() - grabStart)
+                    self.currentFrameNumber = self.currentFrameNumber + record.numImages
+                    
+                    # Images of a stack are passed individually to the
+                    # auxillary queue and circular buffer
+                    records = record.split()
         
                     # If we have a new frame, place is in main queue. If we are
                     # using an auxillary queue at the moment, we also put a copy
                     # in there
-                    self.imageQueue.put(frame)
-                    if self.useAuxillaryQueue and (not self.auxillaryQueue.full()):
-                        self.auxillaryQueue.put(frame) 
+                    self.imageQueue.put(record)
+                    self.metrics.add_queue_depth(PipelineMetrics.QUEUE, self.imageQueue.qsize())
+                    if self.useAuxillaryQueue:
+                        for auxRecord in records:
+                            if not self.auxillaryQueue.full():
+                                self.auxillaryQueue.put(auxRecord) 
+                            else:
+                                self.numAuxillaryDroppedFrames += 1
+                                self.metrics.add_drop(PipelineMetrics.RECORD)
+                        self.metrics.add_queue_depth(PipelineMetrics.RECORD, self.auxillaryQueue.qsize())
+                    if self.circularBuffer is not None:
+                        for bufferRecord in records:
+                            self.circularBuffer.add_frame(bufferRecord)
                     
-                    self.currentFrame = frame
-                    self.currentFrameTime = time.perf_counter()
-                    self.frameStepTime = self.currentFrameTime - self.lastFrameTime
+                    self.currentFrame = records[-1].image
+                    self.currentFrameRecord = records[-1]
+                    self.currentFrameTime = record.timestamp
+                    self.frameStepTime = (self.currentFrameTime - self.lastFrameTime) / record.numImages
                     self.lastFrameTime = self.currentFrameTime
-                else:
-                    time.sleep(0.002)
             else:
+                self._resume_event.wait(self.cameraTimeout)
+        
+        
+    def get_camera_image(self):
+        """ Returns the next image from the camera, waiting up to 
+        cameraTimeout seconds if there is not one ready. Cameras which do not
+        inherit from GenericCameraInterface, and so may not have a 
+        get_image_wait method, are polled instead.
+        """
+        if self.framePool is not None:
+            return self.get_camera_image_pooled()
+        elif hasattr(self.cam, 'get_image_wait'):
+            return self.cam.get_image_wait(self.cameraTimeout)
+        else:
+            frame = self.cam.get_image()
+            if frame is None:
                 time.sleep(0.002)
+            return frame
+    
+    
+    def get_camera_images(self, maxNum, out = None):
+        """ Returns up to maxNum images from the camera as a stack, waiting
+        up to cameraTimeout seconds for the first image, or None if there
+        are no images. Cameras which do not have get_images_wait return one
+        image at a time.
+        """
+        if hasattr(self.cam, 'get_images_wait'):
+            return self.cam.get_images_wait(maxNum, self.cameraTimeout, out = out)
+        else:
+            frame = self.get_camera_image()
+            return None if frame is None else frame[None]
+        
+        
+    def get_camera_stack(self):
+        """ Adds the images available from the camera to the stack being
+        filled, waiting up to cameraTimeout seconds for them. Returns a 
+        FrameRecord for the stack once it has stackSize images, otherwise
+        returns None.
+        """
+        
+        if self.stack is None:
+            images = self.get_camera_images(self.stackSize)
+            if images is None:
+                return None
+            self.start_stack(images)
+        else:
+            target = self.stack[self.stackCount:]
+            images = self.get_camera_images(self.stackSize - self.stackCount, out = target)
+            if images is None:
+                return None
+            if images.shape[1:] != self.stack.shape[1:] or images.dtype != self.stack.dtype:
+                # The image size or type has changed, so start a new stack
+                self.start_stack(images)
+            else:
+                if not np.shares_memory(images, target):
+                    target[:len(images)] = images
+                self.stackCount = self.stackCount + len(images)
+            
+        if self.stackCount < self.stackSize:
+            return None
+        
+        record = FrameRecord(self.stack, self.currentFrameNumber, self.stackTime,
+                             cameraID = self.cameraID, numImages = self.stackSize)
+        self.stack = None
+        return record
+    
+    
+    def start_stack(self, images):
+        """ Starts a new stack with the first images, images.
+        """
+        self.stack = np.empty((self.stackSize,) + images.shape[1:], dtype = images.dtype)
+        self.stack[:len(images)] = images
+        self.stackCount = len(images)
+        self.stackTime = time.perf_counter()
+        
+        
+    def set_stack_size(self, num):
+        """ Sets the number of images placed in the image queue together as 
+        a stack. 1 (the default) for single images. If the image queue is a
+        SharedFrameBuffer its slots must be large enough for a whole stack.
+        """
+        self.stackSize = max(int(num), 1)
+        self.stack = None
+        
+        
+    def get_camera_image_pooled(self):
+        """ Returns the next image from the camera, written into a buffer
+        from the frame pool if one is free. The pool is (re)allocated if 
+        the size or type of the images from the camera changes.
+        """
+        out = self.framePool.acquire()
+        frame = self.cam.get_image_wait_into(out, self.cameraTimeout)
+        if frame is not None and frame is not out and not self.framePool.matches(frame.shape, frame.dtype):
+            self.framePool.allocate(frame.shape, frame.dtype)
+        return frame
+    
+    
+    def get_frame_pool(self):
+        """ Returns the FramePool, or None if not using one.
+        """
+        return self.framePool
+    
+    
+    def get_hardware_timestamp(self):
+        """ Returns the camera timestamp of the last image, or None if the
+        camera does not provide one.
+        """
+        if hasattr(self.cam, 'get_hardware_timestamp'):
+            return self.cam.get_hardware_timestamp()
+        else:
+            return None
+        
         
     def get_camera(self):
         """ Returns a reference to the camera object.
@@ -186,6 +392,12 @@ class ImageAcquisitionThread(threading.Thread):
     def get_next_image(self):
         """ Removes the next image from the queue and returns it.
         """
+        return as_image(self.get_next_frame())
+    
+    
+    def get_next_frame(self):
+        """ Removes the next FrameRecord from the queue and returns it.
+        """
         if self.is_image_ready():
             try:
                 im = self.imageQueue.get()
@@ -201,6 +413,13 @@ class ImageAcquisitionThread(threading.Thread):
     def get_next_auxillary_image(self):
         """ Removes the next image from the auxillary queue and returns it.
         """
+        return as_image(self.get_next_auxillary_frame())
+    
+    
+    def get_next_auxillary_frame(self):
+        """ Removes the next FrameRecord from the auxillary queue and 
+        returns it.
+        """
         if self.is_auxillary_image_ready():
             try:
                 im = self.auxillaryQueue.get()
@@ -212,21 +431,37 @@ class ImageAcquisitionThread(threading.Thread):
         else:
             return None    
     
-    def get_next_image_wait(self):
+    def get_next_image_wait(self, timeout = None):
         """ Wait until there is an image available in the queue and then return 
-        it.
+        it. 
+        
+        Keyword Arguments:
+            timeout : float or None
+                      maximum time to wait in seconds, after which None is
+                      returned. Default is to wait indefinitely.
         """
+        return as_image(self.get_next_frame_wait(timeout))
+    
+    
+    def get_next_frame_wait(self, timeout = None):
+        """ Wait until there is an image available in the queue and then return 
+        its FrameRecord. 
         
-        while self.is_image_ready() is False:
-            pass
+        Keyword Arguments:
+            timeout : float or None
+                      maximum time to wait in seconds, after which None is
+                      returned. Default is to wait indefinitely.
+        """
         
         try:
             if self.acquisitionLock is not None: self.acquisitionLock.acquire()
-            im = self.imageQueue.get()
-            if self.acquisitionLock is not None: self.acquisitionLock.release()
+            im = self.imageQueue.get(timeout = timeout)
 
         except queue.Empty:
-            return None
+            im = None
+        
+        finally:
+            if self.acquisitionLock is not None: self.acquisitionLock.release()
         
         return im
         
@@ -268,6 +503,19 @@ class ImageAcquisitionThread(threading.Thread):
         self.useAuxillaryQueue = use
     
     
+    def set_circular_buffer(self, circularBuffer):
+        """ Sets a CircularFrameBuffer to copy each image into, or None to
+        stop doing so.
+        """
+        self.circularBuffer = circularBuffer
+        
+        
+    def get_circular_buffer(self):
+        """ Returns the CircularFrameBuffer, or None if not using one.
+        """
+        return self.circularBuffer
+    
+    
     def flush_buffer(self):
         """ Removes all images from output queue.
         """
@@ -292,6 +540,7 @@ class ImageAcquisitionThread(threading.Thread):
         """ Pauses image acquisition.
         """
         self.isPaused = True
+        self._resume_event.clear()
         self.flush_buffer()
         return
     
@@ -300,6 +549,7 @@ class ImageAcquisitionThread(threading.Thread):
         """ Resumes a paused image acquisition.
         """
         self.isPaused = False
+        self._resume_event.set()
         return    
         
               
@@ -314,6 +564,3 @@ class ImageAcquisitionThread(threading.Thread):
 
             self.cam.dispose()
             del(self.cam)
-            
-
-            
\ No newline at end of file
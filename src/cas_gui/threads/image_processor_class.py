@@ -5,6 +5,33 @@ Kent-CAS: Camera Acquisition System
 Base class for image processor classes. Image processor classes should
 aways inherit from this class to maintain future compatibility.
 
+When processing with a pool of workers (multiCore with numWorkers > 1), the
+processor declares how it can be parallelised by setting parallelMode, or by
+overriding get_parallel_mode() if this depends on the settings:
+    
+    STATELESS  - each frame is processed independently using process(), 
+                 frames are shared between all the workers. This is the 
+                 default.
+    STATEFUL   - process() depends on previous frames, all frames are
+                 processed in order by a single worker.
+    MAP_REDUCE - process_map() is independent for each frame and is run by
+                 all the workers, process_reduce() depends on previous
+                 frames and is run in order in the ImageProcessorThread, 
+                 using the local copy of the processor. process() should
+                 be equivalent to process_reduce(process_map(inputFrame)).
+
+When images are processed in batches (see set_batch_process_num in 
+ImageProcessorThread), the processor declares the layout and dtype of the
+batch passed to process() by setting batchLayout and batchDtype, or by
+overriding get_batch_layout() and get_batch_dtype():
+
+    FRAMES_LAST  - the batch has shape (h, w, n). This is the default.
+    FRAMES_FIRST - the batch has shape (n, h, w), each image is contiguous.
+    
+batchDtype is the dtype of the batch, 'float64' by default, or None to keep
+the dtype of the raw images, which avoids converting them. The batch is 
+assembled in a buffer which is reused for the next batch, so process() 
+should not keep a reference to it.
 
 """
 
@@ -12,6 +39,16 @@ import magicattr
 
 class ImageProcessorClass:    
   
+    STATELESS = 0
+    STATEFUL = 1
+    MAP_REDUCE = 2
+    
+    FRAMES_FIRST = 0
+    FRAMES_LAST = 1
+    
+    parallelMode = STATELESS
+    batchLayout = FRAMES_LAST
+    batchDtype = 'float64'
     
     def __init__(self, **kwargs):
         pass
@@ -19,6 +56,42 @@ class ImageProcessorClass:
                 
     def process(self, inputFrame):
         pass
+    
+    
+    def process_map(self, inputFrame):
+        """ Parallel stage of processing for MAP_REDUCE processors. Returns
+        the result to be passed to process_reduce().
+        """
+        return self.process(inputFrame)
+    
+    
+    def process_reduce(self, mappedFrame):
+        """ Sequential stage of processing for MAP_REDUCE processors, called 
+        in frame order with the result of process_map(). Returns the 
+        processed frame.
+        """
+        return mappedFrame
+    
+    
+    def get_parallel_mode(self):
+        """ Returns STATELESS, STATEFUL or MAP_REDUCE to determine how frames
+        are scheduled when using a pool of workers.
+        """
+        return self.parallelMode
+    
+    
+    def get_batch_layout(self):
+        """ Returns FRAMES_FIRST or FRAMES_LAST, the layout of batches of
+        images passed to process().
+        """
+        return self.batchLayout
+    
+    
+    def get_batch_dtype(self):
+        """ Returns the dtype of batches of images passed to process(), or
+        None if the dtype of the images is kept.
+        """
+        return self.batchDtype
            
                 
     def message(self, message, parameter):  
@@ -35,4 +108,4 @@ class ImageProcessorClass:
                 f(parameter)
         else:
             magicattr.set(self, message, parameter)
-             
\ No newline at end of file
+             
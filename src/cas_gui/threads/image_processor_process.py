@@ -8,7 +8,9 @@ Class to assist with real-time image processing in a dedicated process (i.e.
 for multiprocessor applications). At initialisation, four multiprocessing
 queues must be provided. 
     
-    inQueue  - Provides images to be processed
+    inQueue  - Provides images to be processed. This may also be a 
+               SharedFrameBuffer, in which case images are read from shared
+               memory rather than unpickled.
     outQueue - Class places processed images in this queue
     updateQueue - An object which implements the process method must be provided
                   here at least once.
@@ -18,34 +20,79 @@ queues must be provided.
 This class must be supplied with an object which implements a process method accepting
 a single argument, img.
 
+Images in the inQueue may be numpy arrays or FrameRecords. If batchProcessNum
+is greater than 1 and a FrameRecord holds a stack of that many images (see
+ImageAcquisitionThread.set_stack_size), the stack is used as the batch. Stacks
+of other sizes are split into single images. Otherwise batches are assembled
+in a reusable BatchBuffer, in the layout and dtype declared by the processor. The processed 
+images are placed in the outQueue (or resultQueue) as FrameRecords, carrying
+the metadata of the raw image together with the times at which processing
+started and finished. When using shared memory, this metadata is stored in 
+the slot header.
+
 When an image is found in the inQueue, this will be passed to the process method
 of the supplied processor object. Whatever is returned from the process method will then 
-be placed in outQueue or in shared memory (if useSharedMemory is True)
+be placed in outQueue or in shared memory (if useSharedMemory is True). In the
+latter case, images are written to a SharedImageSlots object, which is either
+passed in as sharedSlots or created when the ImageProcessorProcess is created
+(i.e. in the parent process) with numSharedSlots slots. The memory for the
+images is allocated when the first image is processed, using the dtype, 
+shape and number of channels of that image, and is reallocated if these change. 
+sharedMemoryArraySize is therefore no longer needed and is ignored.
 
 This allows a controller or GUI running in a different process to change
 parameters of the processing by updating the processor object and passing
 it to the process that ImageProcessorProcess is running in via the updateQueue.
 
+Several ImageProcessorProcess instances can share the same inQueue as a pool
+of workers. In this case a resultQueue, an inputLock and a frameCounter 
+(a multiprocessing.Value) shared by all the workers must be provided. Each 
+image (or batch of images) is numbered using frameCounter as it is taken from 
+the inQueue, and processed images are placed in resultQueue as a tuple of 
+(frame number, FrameRecord, parallel mode), the FrameRecord carrying the
+processed image and its id, so that they can be put back in order. When a
+worker splits a stack, it reserves consecutive numbers for all the images of
+the stack as it is taken, and processes them all itself. With batches, the 
+images of a split stack are only batched with each other, so the last batch
+from a stack may be smaller than batchProcessNum. The outQueue and shared 
+memory are not used in this case. Each worker is given a workerIndex. If the
+processor's get_parallel_mode() returns STATEFUL, only the worker with workerIndex 0 takes images, so that they are
+processed in order. If it returns MAP_REDUCE, only process_map() is called 
+and the ImageProcessorThread calls process_reduce().
+
+The process waits on the inQueue for up to waitTimeout seconds for each 
+image, rather than polling, so images are processed as soon as they arrive.
+Updates and messages are checked between images, or after the timeout.
+
 """
 
+import math
 import queue
 import multiprocessing
 import time
+from collections import deque
+
 import numpy as np
 
+from cas_gui.threads.shared_frame_buffer import SharedFrameBuffer
+from cas_gui.threads.shared_image_slots import SharedImageSlots
+from cas_gui.threads.image_processor_class import ImageProcessorClass
+from cas_gui.threads.batch_buffer import BatchBuffer
+from cas_gui.threads.frame_record import as_frame_record, as_image
+
 class ImageProcessorProcess(multiprocessing.Process):
     
     processor = None
     currentFrameNumber = 0
     lastFrameTime = 0
     frameStepTime = 0
-    sharedMemoryArray = None
-    sharedMemorySize = 0
-    sharedMemory = None
-    imSize = (0,0)
+    sharedSlots = None
     imCounter = 0
+    waitTimeout = 0.02
     
-    def __init__(self, inQueue, outQueue, updateQueue, messageQueue, useSharedMemory = False, sharedMemoryArraySize = (2048,2048), statusQueue = None, shareName = "CASShare"):
+    def __init__(self, inQueue, outQueue, updateQueue, messageQueue, useSharedMemory = False, sharedMemoryArraySize = (2048,2048), 
+                 statusQueue = None, shareName = None, sharedSlots = None, numSharedSlots = 3,
+                 resultQueue = None, inputLock = None, frameCounter = None, workerIndex = 0):
         
         super().__init__()          
                       
@@ -57,7 +104,16 @@ class ImageProcessorProcess(multiprocessing.Process):
         self.useSharedMemory = useSharedMemory
         self.sharedMemoryArraySize = sharedMemoryArraySize
         self.shareName = shareName
-
+        self.resultQueue = resultQueue
+        self.inputLock = inputLock
+        self.frameCounter = frameCounter
+        self.workerIndex = workerIndex
+        
+        # The shared memory is created here, in the parent process, so that
+        # the reader has a reference to it before the process starts
+        self.sharedSlots = sharedSlots
+        if self.useSharedMemory and self.sharedSlots is None and self.resultQueue is None:
+            self.sharedSlots = SharedImageSlots(numSharedSlots, name = shareName)
         
         self.lastFrameTime = 0
         self.frameStepTime = 0
@@ -67,6 +123,10 @@ class ImageProcessorProcess(multiprocessing.Process):
         self.isStarted = True
         self.imCounter = 0
         self.batchProcessNum = 1
+        self.pendingFrames = deque()
+        self.pendingNumbers = deque()
+        self.pendingBatchNum = 1
+        self.batchBuffer = BatchBuffer()
    
         
     def run(self):                
@@ -76,8 +136,14 @@ class ImageProcessorProcess(multiprocessing.Process):
             
             t0 = time.perf_counter()    
             
-            # Receive an updated instance of the processor object            
-            if self.updateQueue.qsize() > 0:
+            # Receive an updated instance of the processor object, waiting
+            # for the first one if we don't have one yet
+            if self.processor is None:
+                try:
+                    self.processor = self.updateQueue.get(timeout = self.waitTimeout)
+                except queue.Empty:
+                    pass
+            elif self.updateQueue.qsize() > 0:
                 self.processor = self.updateQueue.get()
             
             if self.processor is not None:            
@@ -95,77 +161,82 @@ class ImageProcessorProcess(multiprocessing.Process):
                             except:
                                 pass
                 
-                # We attempt to pull an image off the queue 
-                if self.get_num_images_in_input_queue() >= self.batchProcessNum:
-
-                    try:
-                        if self.batchProcessNum > 1:
-                            img = self.inputQueue.get_nowait()
-                            im = np.zeros((np.shape(img)[0], np.shape(img)[1], self.batchProcessNum))
-                            im[:,:,0] = img
-                            for i in range(1, self.batchProcessNum):
-                                im[:,:,i] = self.inputQueue.get()
-                         
-                        else:
-                            im = self.inputQueue.get_nowait()
-    
-                    except:
-                        im = None
-                        time.sleep(0.001)
+                # We attempt to pull an image off the queue. If we are one of
+                # a pool of workers, the image is numbered while holding the
+                # lock so that the numbers follow the order of the queue.
+                # If a stack was split, numbers are reserved at the same time
+                # for the images (or batches) still to come from it.
+                # Stateful processors only run on the first worker.
+                parallelMode = self.get_parallel_mode()
+                if self.inputLock is not None:
+                    if len(self.pendingNumbers) > 0 and len(self.pendingFrames) > 0:
+                        frame = self.get_input_batch()
+                        frameNumber = self.pendingNumbers.popleft()
+                    elif parallelMode == ImageProcessorClass.STATEFUL and self.workerIndex > 0:
+                        frame = None
+                        time.sleep(self.waitTimeout)
+                    else:
+                        self.pendingNumbers.clear()
+                        with self.inputLock:
+                            frame = self.get_input_batch()
+                            if frame is not None:
+                                self.pendingBatchNum = self.batchProcessNum
+                                numPending = math.ceil(len(self.pendingFrames) / self.pendingBatchNum)
+                                frameNumber = self.frameCounter.value
+                                self.frameCounter.value = frameNumber + 1 + numPending
+                                self.pendingNumbers.extend(range(frameNumber + 1, frameNumber + 1 + numPending))
                 else:
-                    time.sleep(0.001)
-                    im = None
+                    frame = self.get_input_batch()
                     
-                if im is not None:  
-    
-                    ret = self.processor.process(im) 
+                if frame is not None:  
+                    
+                    processStart = time.perf_counter()
+                    if self.resultQueue is not None and parallelMode == ImageProcessorClass.MAP_REDUCE:
+                        ret = self.processor.process_map(frame.image)
+                    else:
+                        ret = self.processor.process(frame.image) 
+                    ret = self.batchBuffer.detach(ret)
                     
                     if isinstance(ret, tuple):                        
                         self.imageId = ret[1]
                         outImage = ret[0]
+                        outFrame = frame.with_image(outImage, self.imageId)
                     else:
                         self.imageId = 0
                         outImage = ret
+                        outFrame = frame.with_image(outImage)
+                    outFrame.mark('processStart', processStart)
+                    outFrame.mark('processEnd')
                     #print(f"process: out size {np.shape(outImage)}")    
                     
                     
-                    if not self.useSharedMemory:                   
+                    if self.resultQueue is not None:
+                        
+                        # Results are put back in order by the ImageProcessorThread,
+                        # so we always return something, even if it is None
+                        self.resultQueue.put((frameNumber, outFrame, parallelMode))
+                        
+                    elif not self.useSharedMemory:                   
                         
                         # If the output queue is full we remove an item to make space
                         if self.outputQueue.full():
                             temp = self.outputQueue.get()
-                            
-                        self.outputQueue.put(outImage)
+                        
+                        outFrame.mark('output')
+                        self.outputQueue.put(outFrame)
                     
                     
                     elif self.useSharedMemory:
-                        #print("using shared memory")
                         if outImage is not None:
-  
-                            # Create the shared memory if we haven't already done so
-                            if self.sharedMemory is None:
-
-                                temp = np.ndarray(self.sharedMemoryArraySize, dtype = 'float32')
-                                try:
-                                    self.sharedMemory = multiprocessing.shared_memory.SharedMemory(create=True, size=temp.nbytes, name = self.shareName)
-                                except:
-                                    self.sharedMemory = multiprocessing.shared_memory.SharedMemory(size=temp.nbytes, name = self.shareName)
-                                self.sharedMemoryArray = np.ndarray(self.sharedMemoryArraySize, dtype = 'float32', buffer = self.sharedMemory.buf)
-                                self.sharedMemorySize = outImage.nbytes
-                                
-                            # The output from the processor is copied into the top left corner of the array in shared memory
-                            self.sharedMemoryArray[1: 1 + np.shape(outImage)[0], :np.shape(outImage)[1]] = outImage
                             
-                            # Store the image size in the shared memory so that receiver know which parts
-                            # of memory to use
-                            self.imSize = np.shape(outImage)
-                            self.sharedMemoryArray[0,0] = self.imSize[0]
-                            self.sharedMemoryArray[0,1] = self.imSize[1]
-                            self.sharedMemoryArray[0,2] = self.frameStepTime
-                            self.sharedMemoryArray[0,3] = self.imCounter
-                            self.sharedMemoryArray[0,4] = self.imageId
+                            # If there is no free slot the image is dropped, the
+                            # reader will see a gap in the counter
+                            outFrame.mark('output')
+                            self.sharedSlots.write(outImage, self.imCounter, 
+                                                   imageId = self.imageId, 
+                                                   frameStepTime = self.frameStepTime,
+                                                   frame = outFrame)
                             self.imCounter = self.imCounter + 1
-                            #print(f"processed {self.imCounter}")
                     
                     # Timing
                     self.currentFrameNumber = self.currentFrameNumber + 1
@@ -174,6 +245,101 @@ class ImageProcessorProcess(multiprocessing.Process):
                     self.lastFrameTime = self.currentFrameTime
                     #print(self.frameStepTime, time.perf_counter() - t0)
 
+    def get_parallel_mode(self):
+        """ Returns the parallel mode of the processor, processors which do
+        not inherit from ImageProcessorClass are assumed to be STATELESS.
+        """
+        if isinstance(self.processor, ImageProcessorClass):
+            return self.processor.get_parallel_mode()
+        else:
+            return ImageProcessorClass.STATELESS
+        
+        
+    def get_batch_format(self):
+        """ Returns a tuple of the layout and dtype of batches accepted by the
+        processor. Processors which do not inherit from ImageProcessorClass
+        are given the default layout and dtype.
+        """
+        if isinstance(self.processor, ImageProcessorClass):
+            return self.processor.get_batch_layout(), self.processor.get_batch_dtype()
+        else:
+            return ImageProcessorClass.batchLayout, ImageProcessorClass.batchDtype
+        
+        
+    def get_input_batch(self):
+        """ Removes the next image, or the next batch of images if 
+        batchProcessNum > 1, from the input queue and returns it as a 
+        FrameRecord. For a batch, the metadata is that of the first image. 
+        Waits up to waitTimeout seconds for the first image, returning None 
+        if there is no image. Once the first image of a batch has arrived, 
+        waits for the rest of the batch.
+        """
+        
+        try:
+            # In a pool of workers, the rest of a split stack is batched as 
+            # it was when the stack was taken, even if batchProcessNum has
+            # since changed, so that it uses the numbers reserved for it
+            batchNum = self.batchProcessNum
+            if self.inputLock is not None and len(self.pendingFrames) > 0:
+                batchNum = self.pendingBatchNum
+                
+            if batchNum > 1:
+                
+                # Each frame is copied straight into the batch, so if
+                # frames are in shared memory we can read them in place
+                wasPending = len(self.pendingFrames) > 0
+                frame = self.get_input_frame(timeout = self.waitTimeout, inPlace = True)
+                
+                # In a pool of workers, the images of a split stack are only
+                # batched with each other, so that the number of batches
+                # from the stack is known when it is taken (see run)
+                num = batchNum
+                if self.inputLock is not None and (wasPending or len(self.pendingFrames) > 0):
+                    num = min(num, 1 + len(self.pendingFrames))
+                layout, dtype = self.get_batch_format()
+                frame.image = self.batchBuffer.assemble(frame, lambda: self.get_input_frame(inPlace = True).image,
+                                                        num, layout = layout, dtype = dtype)
+             
+            else:
+                frame = self.get_input_frame(timeout = self.waitTimeout)
+
+        except queue.Empty:
+            frame = None
+        
+        return frame
+    
+    
+    def get_input_frame(self, block = True, inPlace = False, timeout = None):
+        """ Returns the next raw image from the input queue as a FrameRecord,
+        see get_input_image. Stacks of images which are not the size of the 
+        batch are split, and the images returned one at a time.
+        """
+        if len(self.pendingFrames) > 0:
+            return self.pendingFrames.popleft()
+        
+        frame = as_frame_record(self.get_input_image(block = block, inPlace = inPlace, timeout = timeout))
+        if frame.numImages > 1 and frame.numImages != self.batchProcessNum:
+            if inPlace and isinstance(self.inputQueue, SharedFrameBuffer):
+                frame.image = frame.image.copy()
+            frames = frame.split()
+            self.pendingFrames.extend(frames[1:])
+            frame = frames[0]
+        return frame
+    
+    
+    def get_input_image(self, block = True, inPlace = False, timeout = None):
+        """ Removes the next raw image from the input queue and returns it,
+        waiting up to timeout seconds if block is True. If inPlace is True and
+        the input queue is a SharedFrameBuffer, a view of the shared memory is
+        returned rather than a copy, this is only valid until the next image 
+        is requested.
+        """
+        if inPlace and isinstance(self.inputQueue, SharedFrameBuffer):
+            return self.inputQueue.get(block = block, timeout = timeout, copy = False)
+        else:
+            return self.inputQueue.get(block = block, timeout = timeout)
+        
+        
     def get_num_images_in_input_queue(self):
         """ Returns number of images in raw image queue"""
         return self.inputQueue.qsize()
@@ -7,6 +7,40 @@ Threading class for image processing for use in GUIs or or
 multi-threading applications. Sub-class and implement process_frame
 to make a custom image processor.
 
+If multiCore is True, processing is performed by an ImageProcessorProcess. If
+numWorkers is greater than 1, a pool of numWorkers ImageProcessorProcess is 
+started instead, each with its own copy of the processor. The processed images
+are put back in the order the raw images were taken from the input queue 
+before being placed in the output queue. How frames are shared between the 
+workers depends on the parallel mode of the processor (see 
+ImageProcessorClass), for MAP_REDUCE processors process_reduce() is called
+here, in frame order, using the local copy of the processor.
+
+Raw images may be numpy arrays or FrameRecords (as provided by the
+ImageAcquisitionThread). If batchProcessNum is greater than 1 and a 
+FrameRecord holds a stack of that many images (see 
+ImageAcquisitionThread.set_stack_size), the stack is used as the batch. 
+Stacks of other sizes are split into single images. Otherwise batches are
+assembled in a reusable BatchBuffer, in the layout and dtype declared by 
+the processor (see ImageProcessorClass). Processed images are stored in the output queue
+as FrameRecords which carry the metadata of the raw image and the times
+at which it reached each stage of processing. get_next_frame returns the
+FrameRecord, get_next_image returns the image, or a tuple of (image, id) if 
+the processor returns an id or if images are returned in shared memory.
+
+The loops wait on the queues (or shared memory) for up to waitTimeout seconds
+rather than polling, so that images are processed as soon as they arrive. The
+timeout only determines how quickly the thread notices that it has been 
+stopped.
+
+settingsVersion is incremented whenever the processor may have changed, by 
+update_settings, pipe_message and set_batch_process_num, so that results
+from the processor can be cached until it changes.
+
+Processing times, queue depths and dropped images are recorded in a
+PipelineMetrics object, which can be passed using the metrics keyword 
+argument so that it can be shared with the ImageAcquisitionThread.
+
 """
 
 import queue
@@ -14,21 +48,31 @@ import threading
 import time
 import logging
 import multiprocessing
+from collections import deque
+
 import numpy as np
 
 from cas_gui.threads.image_processor_process import ImageProcessorProcess
+from cas_gui.threads.image_processor_class import ImageProcessorClass
+from cas_gui.threads.batch_buffer import BatchBuffer
+from cas_gui.threads.frame_record import as_frame_record, as_image
+from cas_gui.utils.pipeline_metrics import PipelineMetrics
 
 
 class ImageProcessorThread(threading.Thread):
     
     process = None
+    processes = []
     updateQueue = None
-    sharedMemory = None
-    sharedMemoryArray = None
-    inputSharedMemory = None
-    imSize = (0,0)
+    updateQueues = []
+    messageQueues = []
+    resultQueue = None
+    sharedSlots = None
+    heldSlot = None
     lastImNum = -1  
     numDropped = 0
+    settingsVersion = 0
+    waitTimeout = 0.05
     
     def __init__(self, processor, inBufferSize, outBufferSize, **kwargs):
         
@@ -46,8 +90,12 @@ class ImageProcessorThread(threading.Thread):
         self.multiCore = kwargs.get('multiCore', False)
         self.useSharedMemory = kwargs.get('sharedMemory', False)        
         self.sharedMemoryArraySize = kwargs.get('sharedMemoryArraySize', (2048, 2048))
+        self.numWorkers = max(kwargs.get('numWorkers', 1), 1) if self.multiCore else 1
+        self.metrics = kwargs.get('metrics', None)
+        if self.metrics is None:
+            self.metrics = PipelineMetrics()
 
-        if self.multiCore and not self.useSharedMemory:                
+        if self.multiCore and not self.useSharedMemory and self.numWorkers == 1:                
             self.outputQueue = multiprocessing.Queue(maxsize=self.outBufferSize)
         else:
             self.outputQueue = queue.Queue(maxsize=self.outBufferSize)
@@ -64,89 +112,134 @@ class ImageProcessorThread(threading.Thread):
         self.isPaused = False
         self.isStarted = True
         self.batchProcessNum = 1
+        self.pendingFrames = deque()
+        self.batchBuffer = BatchBuffer()
+        
+        self._stop_event = threading.Event()
+        
+        # Set when not paused
+        self._resume_event = threading.Event()
+        self._resume_event.set()
         
         # If we are going to use a different core to do processing, then we need
         # to start a process on that core.
         
-        if self.multiCore:
+        if self.multiCore and self.numWorkers > 1:
+            self.start_worker_pool()
+        
+        elif self.multiCore:
             
             # Queue for sending updates on how to do the processing
             self.updateQueue = multiprocessing.Queue()
             self.messageQueue = multiprocessing.Queue()
+            self.updateQueues = [self.updateQueue]
+            self.messageQueues = [self.messageQueue]
             
             if self.useSharedMemory:
                 outQueue = None
             else:
                 outQueue = self.outputQueue
                 
-            self.shareName = str(np.random.randint(6400000, size = 1)[0])
+            # When using shared memory, processed images are returned as views of
+            # slots in shared memory. The slots of images waiting in the output
+            # queue, and of the last image returned, are pinned so that they
+            # are not overwritten. The handle of the slot is stored in the
+            # output queue with the image, and is released when the image is
+            # removed from the queue. There must therefore be enough slots for a full
+            # output queue, plus one held and two for the process to write to.
             
             # Create the process and set it running
             self.process = ImageProcessorProcess(self.inputQueue, outQueue, self.updateQueue, 
                                                  self.messageQueue, sharedMemoryArraySize = self.sharedMemoryArraySize, 
-                                                 useSharedMemory = self.useSharedMemory, statusQueue = self.statusQueue, shareName = self.shareName)
+                                                 useSharedMemory = self.useSharedMemory, statusQueue = self.statusQueue,
+                                                 numSharedSlots = self.outBufferSize + 3)
+            self.sharedSlots = self.process.sharedSlots
             self.process.start()
+            self.processes = [self.process]
             time.sleep(0.1)
             self.updateQueue.put(self.processor)
            
         
-    
+    def start_worker_pool(self):
+        """ Starts numWorkers ImageProcessorProcess which all take raw 
+        images from the input queue and return processed images via
+        resultQueue, each tagged with a frame number.
+        """
+        
+        self.resultQueue = multiprocessing.Queue()
+        self.inputLock = multiprocessing.Lock()
+        self.frameCounter = multiprocessing.Value('q', 0, lock = False)
+        
+        # Processed images waiting for an earlier image to be returned, keyed 
+        # by frame number. If more than maxReorder are waiting, we assume the
+        # earlier image has been lost and skip it.
+        self.reorderBuffer = {}
+        self.nextFrameNumber = 0
+        self.maxReorder = self.outBufferSize + 2 * self.numWorkers
+        
+        self.processes = []
+        self.updateQueues = []
+        self.messageQueues = []
+        for idx in range(self.numWorkers):
+            updateQueue = multiprocessing.Queue()
+            messageQueue = multiprocessing.Queue()
+            process = ImageProcessorProcess(self.inputQueue, None, updateQueue, messageQueue,
+                                            statusQueue = self.statusQueue, resultQueue = self.resultQueue,
+                                            inputLock = self.inputLock, frameCounter = self.frameCounter,
+                                            workerIndex = idx)
+            process.start()
+            self.processes.append(process)
+            self.updateQueues.append(updateQueue)
+            self.messageQueues.append(messageQueue)
+
+        self.process = self.processes[0]
+        self.updateQueue = self.updateQueues[0]
+        self.messageQueue = self.messageQueues[0]
+        
+        time.sleep(0.1)
+        self.update_settings()
+        
         
     # This loop is run once the thread starts
     def run(self):
 
          while self.isStarted:                 
 
-            
-             if self.multiCore:
+             if self.multiCore and self.numWorkers > 1:
+                 
+                 self.handle_worker_results()
+                 
+             elif self.multiCore:
                                    
                  if self.useSharedMemory:
                  
-                     # If we have not yet got a reference to the shared memory, get it now
-                     if self.sharedMemory is None:
-                         temp = np.ndarray(self.sharedMemoryArraySize, dtype = 'float32')
-                         try:
-                             self.sharedMemory = multiprocessing.shared_memory.SharedMemory(create=True, size=temp.nbytes, name = self.shareName)
-                         except:
-                             self.sharedMemory = multiprocessing.shared_memory.SharedMemory(size=temp.nbytes, name = self.shareName)
-
-                         #try:
-                             #self.sharedMemory = multiprocessing.shared_memory.SharedMemory(name="CASShare")
-                         self.sharedMemoryArray = np.ndarray(self.sharedMemoryArraySize, dtype = 'float32', buffer = self.sharedMemory.buf)  
-                         #except:
-                          #   pass
-                     else:
-                         # The image width, height, processing step time, and frame number are
-                         # stored in a corner of the shared memory
-                         imW = int(self.sharedMemoryArray[0,1])
-                         imH = int(self.sharedMemoryArray[0,0])                       
-                        
-                         imNum = int(self.sharedMemoryArray[0,3])
-                         imIndex = int(self.sharedMemoryArray[0,4])
+                     # Pin the latest image in shared memory, if we haven't already
+                     # returned it, and add a view of it to the output queue
+                     latest = self.sharedSlots.acquire_latest(self.lastImNum, timeout = self.waitTimeout)
+                     
+                     if latest is not None:
+                         slot, frame, imNum = latest
 
-                         if imNum > self.lastImNum + 1:
-                             self.numDropped += 1
-                             
-                             
-                         # Only pull off and return an image if we haven't already returned this
-                         if imNum > self.lastImNum  and imW > 0 and imH > 0:
-                             im = self.sharedMemoryArray[1:1+imH, :imW] #.copy()
-                             #m = np.zeros((10,10))
-                             self.lastImNum = imNum           
+                         if imNum > self.lastImNum + 1 and self.lastImNum >= 0:
+                             self.numDropped += imNum - self.lastImNum - 1
+                             self.metrics.add_drop(PipelineMetrics.DISPLAY, imNum - self.lastImNum - 1)
+                         self.lastImNum = imNum           
                          
-                             if self.outputQueue.full():
-                                 temp = self.outputQueue.get()
-                             
-                             self.outputQueue.put_nowait((im, imIndex)) 
-                             #print("got out image")
-                         else:
-                              time.sleep(0.01)
+                         if self.outputQueue.full():
+                             try:
+                                 temp, tempSlot = self.outputQueue.get_nowait()
+                                 self.sharedSlots.release(tempSlot)
+                                 self.metrics.add_drop(PipelineMetrics.DISPLAY)
+                             except queue.Empty:
+                                 pass
+                         
+                         self.outputQueue.put_nowait((frame, slot)) 
 
                               
                  else:  # self.useSharedMemory = False
                       # If we are not using shared memory we don't need to do anything here because
                       # the processed images will be put straight in the output queue by the ImageProcessorProcess
-                      time.sleep(0.01)
+                      self._stop_event.wait(self.waitTimeout)
              
              else:    
                  
@@ -158,35 +251,31 @@ class ImageProcessorThread(threading.Thread):
                      if self.outputQueue.full():
                          for i in range(self.batchProcessNum):
                              temp = self.outputQueue.get()
+                             self.metrics.add_drop(PipelineMetrics.DISPLAY)
                    
-                     if self.get_num_images_in_input_queue() >= self.batchProcessNum:                         
+                     # Wait for the first image to arrive
+                     try:
+                         frame = self.get_input_frame(timeout = self.waitTimeout)
+                     except queue.Empty:
+                         frame = None
+                         
+                     if frame is not None:                         
     
                          if self.acquisitionLock is not None: self.acquisitionLock.acquire()
                          
                          try:
                              if self.batchProcessNum > 1:
+                                 frame = self.make_batch(frame)
+                             self.currentInputImage = frame.image
                                  
-                                 img = self.inputQueue.get()
-                                 
-                                 self.currentInputImage = np.zeros((np.shape(img)[0], np.shape(img)[1], self.batchProcessNum))
-                                 self.currentInputImage[:,:,0] = img
-                                 
-                                 for i in range(1, self.batchProcessNum):
-                                     self.currentInputImage[:,:,i] = self.inputQueue.get()
-                                 out = self.process_frame(self.currentInputImage)
-                                 
-                                 if isinstance(out, tuple):
-                                     self.currentOutputImage = out[0]
-                                 else:
-                                     self.currentOutputImage = out
-                                 
-                                 self.outputQueue.put(self.currentOutputImage)
-    
-    
-                             else:
-                                 self.currentInputImage = self.inputQueue.get()
-                                 self.currentOutputImage = self.process_frame(self.currentInputImage)
-                                 self.outputQueue.put(self.currentOutputImage)
+                             processStart = time.perf_counter()
+                             out = self.process_frame(self.currentInputImage)
+                             outFrame = self.output_frame_record(frame, out, processStart)
+                             self.currentOutputImage = outFrame.image
+                             
+                             if outFrame.image is not None:
+                                 outFrame.mark('output')
+                                 self.outputQueue.put(outFrame)
     
                              # Timing
                              self.currentFrameNumber = self.currentFrameNumber + 1
@@ -199,20 +288,118 @@ class ImageProcessorThread(threading.Thread):
                          
                          if self.acquisitionLock is not None: self.acquisitionLock.release()
     
-                     else:
-                         time.sleep(0.01)
+                 else:
+                     self._resume_event.wait(self.waitTimeout)
                          
-    def acquire_set(self):
-    
-        img = self.inputQueue.get()
+    def handle_worker_results(self):
+        """ Collects processed images from the worker pool and places them in
+        the output queue in the order of their frame numbers.
+        """
+        
+        try:
+            frameNumber, outFrame, parallelMode = self.resultQueue.get(timeout = self.waitTimeout)
+        except queue.Empty:
+            return
+        
+        # Too late, this image has already been skipped
+        if frameNumber < self.nextFrameNumber:
+            return
+        
+        self.reorderBuffer[frameNumber] = (outFrame, parallelMode)
+        
+        if len(self.reorderBuffer) > self.maxReorder:
+            self.metrics.add_drop(PipelineMetrics.PROCESS, min(self.reorderBuffer) - self.nextFrameNumber)
+            self.nextFrameNumber = min(self.reorderBuffer)
+            
+        while self.nextFrameNumber in self.reorderBuffer:
+            outFrame, parallelMode = self.reorderBuffer.pop(self.nextFrameNumber)
+            self.nextFrameNumber = self.nextFrameNumber + 1
+            
+            if parallelMode == ImageProcessorClass.MAP_REDUCE:
+                outImage = self.processor.process_reduce(outFrame.image)
+                if isinstance(outImage, tuple):
+                    outFrame.image, outFrame.imageId = outImage
+                else:
+                    outFrame.image = outImage
 
-        self.currentInputImage = np.zeros((np.shape(img)[0], np.shape(img)[1], self.batchProcessNum))
-        self.currentInputImage[:,:,0] = img
+            if outFrame.image is not None:
+                
+                # Stop output queue overfilling
+                if self.outputQueue.full():
+                    temp = self.outputQueue.get()
+                    self.metrics.add_drop(PipelineMetrics.DISPLAY)
+                
+                outFrame.mark('output')
+                self.outputQueue.put(outFrame)
+                self.currentOutputImage = outFrame.image
+                
+                # Timing
+                self.currentFrameNumber = self.currentFrameNumber + 1
+                self.currentFrameTime = time.perf_counter()
+                self.frameStepTime = self.currentFrameTime - self.lastFrameTime
+                self.lastFrameTime = self.currentFrameTime
+            
+            
+    def output_frame_record(self, frame, out, processStart):
+        """ Returns a FrameRecord for the output of the processor, out, with
+        the metadata of the raw image's FrameRecord, frame.
+        """
+        out = self.batchBuffer.detach(out)
+        if isinstance(out, tuple):
+            outFrame = frame.with_image(out[0], out[1])
+        else:
+            outFrame = frame.with_image(out)
+        outFrame.mark('processStart', processStart)
+        outFrame.mark('processEnd')
+        return outFrame
+    
+    
+    def get_input_frame(self, timeout = None):
+        """ Removes the next raw image from the input queue and returns it as
+        a FrameRecord, waiting up to timeout seconds. Raises queue.Empty if
+        there is no image. Stacks of images which are not the size of the
+        batch are split, and the images returned one at a time.
+        """
+        if len(self.pendingFrames) > 0:
+            return self.pendingFrames.popleft()
+        
+        frame = as_frame_record(self.inputQueue.get(timeout = timeout))
+        if frame.numImages > 1 and frame.numImages != self.batchProcessNum:
+            frames = frame.split()
+            self.pendingFrames.extend(frames[1:])
+            frame = frames[0]
+        return frame
+    
+    
+    def get_batch_format(self):
+        """ Returns a tuple of the layout and dtype of batches accepted by the
+        processor. Processors which do not inherit from ImageProcessorClass
+        are given the default layout and dtype.
+        """
+        if isinstance(self.processor, ImageProcessorClass):
+            return self.processor.get_batch_layout(), self.processor.get_batch_dtype()
+        else:
+            return ImageProcessorClass.batchLayout, ImageProcessorClass.batchDtype
         
-        for i in range(1, self.batchProcessNum):
-            self.currentInputImage[:,:,i] = self.inputQueue.get()                 
         
-        return self.currentInputImage[:,:,:]    
+    def make_batch(self, frame):
+        """ Returns a FrameRecord for a batch of batchProcessNum images, 
+        starting with frame, in the layout and dtype accepted by the 
+        processor. If frame is a stack of batchProcessNum images it is used 
+        directly, otherwise the rest of the batch is taken from the input 
+        queue. The batch is only valid until the next batch is made.
+        """
+        layout, dtype = self.get_batch_format()
+        frame.image = self.batchBuffer.assemble(frame, lambda: self.get_input_frame().image,
+                                                self.batchProcessNum, layout = layout, dtype = dtype)
+        return frame
+    
+    
+    def acquire_set(self):
+    
+        self.currentInputImage = self.make_batch(self.get_input_frame()).image
+        
+        return self.currentInputImage    
          
                    
     def pipe_message(self, command, parameter):
@@ -227,8 +414,10 @@ class ImageProcessorThread(threading.Thread):
                         the arguments to be passed to the function. If setting
                         an attribute, this is the value to set
         """
+        self.settingsVersion = self.settingsVersion + 1
         if self.multiCore:
-            self.messageQueue.put((command, parameter))
+            for messageQueue in self.messageQueues:
+                messageQueue.put((command, parameter))
         else:
             if self.processor is not None:
                 self.processor.message(command, parameter)
@@ -293,14 +482,66 @@ class ImageProcessorThread(threading.Thread):
     
     
     def get_next_image(self):
-        """ Returns the next available processed image.
+        """ Returns the next available processed image. If the processor 
+        returned an id, or if images are returned in shared memory (only when 
+        multiCore is True with a single worker), this is a tuple of 
+        (image, id). In shared memory, image is a view of the shared memory 
+        which remains valid until the following image is obtained.
+        """        
+        frame = self.get_next_frame()
+        if frame is None:
+            return None
+        elif self.sharedSlots is not None or frame.imageId is not None:
+            return frame.image, (frame.imageId or 0)
+        else:
+            return frame.image
+            
+        
+    def get_next_frame(self):
+        """ Returns the FrameRecord of the next available processed image, or
+        None if there is no image. If using shared memory, the image is a view 
+        of the shared memory which remains valid until the following image is
+        obtained.
+        
+        The queue, processing and total times of the image are recorded in 
+        metrics.
         """        
-        im = None         
         if self.is_image_ready() is True:   
-            try:
-                im = self.outputQueue.get_nowait()   
-            except:
-                im = None
+            return self.take_output_frame(block = False)
+        else:
+            return None
+        
+        
+    def get_next_frame_wait(self, timeout = None):
+        """ Waits until there is a processed image available and returns its
+        FrameRecord, as for get_next_frame().
+        
+        Keyword Arguments:
+            timeout : float or None
+                      maximum time to wait in seconds, after which None is
+                      returned. Default is to wait indefinitely.
+        """
+        return self.take_output_frame(block = True, timeout = timeout)
+    
+    
+    def take_output_frame(self, block, timeout = None):
+        """ Removes the next FrameRecord from the output queue and returns 
+        it, or None if there is none. If using shared memory, the slot of the
+        previous image is released and the slot of this image is held.
+        """
+        try:
+            im = self.outputQueue.get(block = block, timeout = timeout)
+        except queue.Empty:
+            return None
+        
+        if self.sharedSlots is not None:
+            im, slot = im
+            if self.heldSlot is not None:
+                self.sharedSlots.release(self.heldSlot)
+            self.heldSlot = slot
+                    
+        self.metrics.add_frame(im, self.batchProcessNum)
+        self.metrics.add_queue_depth(PipelineMetrics.DISPLAY, self.outputQueue.qsize())
         
         return im
             
@@ -309,15 +550,17 @@ class ImageProcessorThread(threading.Thread):
         """ Returns the processing frame rate.
         """
         
-        # If using single core, we have already stored the frame step time
-        if not self.multiCore and self.frameStepTime > 0:
+        # If using single core or a worker pool, we have already stored the 
+        # frame step time
+        if (not self.multiCore or self.numWorkers > 1) and self.frameStepTime > 0:
             return (1 / self.frameStepTime)
         
         # If using shared memory we can pull this from the shared memory as the processor
         # stores it there
-        elif self.multiCore and self.useSharedMemory and self.sharedMemoryArray is not None:
-            if self.sharedMemoryArray[0,2] > 0:
-                return (1 / self.sharedMemoryArray[0,2])
+        elif self.multiCore and self.useSharedMemory and self.sharedSlots is not None:
+            frameStepTime = self.sharedSlots.get_frame_step_time()
+            if frameStepTime > 0:
+                return (1 / frameStepTime)
             else:
                 return 0
         
@@ -345,8 +588,11 @@ class ImageProcessorThread(threading.Thread):
     def flush_input_buffer(self):
         """ Removes all raw images from queue.
         """
-        with self.inputQueue.mutex:
-            self.inputQueue.queue.clear()
+        while True:
+            try:
+                self.inputQueue.get_nowait()
+            except queue.Empty:
+                break
             
     def flush_status_buffer(self):
         """ Removes all messages from status queue
@@ -365,6 +611,8 @@ class ImageProcessorThread(threading.Thread):
         self.batchProcessNum = num
         if self.multiCore:
             self.pipe_message("set_batch_process_num", num)
+        else:
+            self.settingsVersion = self.settingsVersion + 1
         
     
     def flush_output_buffer(self):
@@ -379,6 +627,7 @@ class ImageProcessorThread(threading.Thread):
         """ Pauses the processing.
         """
         self.isPaused = True
+        self._resume_event.clear()
         return
     
 
@@ -386,6 +635,7 @@ class ImageProcessorThread(threading.Thread):
         """ Resumes paused processing.
         """
         self.isPaused = False
+        self._resume_event.set()
         return            
     
           
@@ -393,14 +643,23 @@ class ImageProcessorThread(threading.Thread):
         """ Stops the process. 
         """
         self.isStarted = False
-        if self.process is not None:
+        self._stop_event.set()
+        
+        # Let the loop finish waiting before closing anything it is using
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout = 1)
+            
+        for process in self.processes:
             print("Terminating process")
-            self.process.terminate()
-            self.process.join()
+            process.terminate()
+            process.join()
+        if self.sharedSlots is not None:
+            self.sharedSlots.close()
 
   
     def update_settings(self):
         """ Sends a copy of the processor class to the process running on
-        another core. """
-        if self.updateQueue is not None:
-            self.updateQueue.put(self.processor)
\ No newline at end of file
+        another core, or to all processes if using a worker pool. """
+        self.settingsVersion = self.settingsVersion + 1
+        for updateQueue in self.updateQueues:
+            updateQueue.put(self.processor)
\ No newline at end of file
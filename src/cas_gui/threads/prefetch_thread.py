@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+PrefetchThread
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Thread which loads images from a file into a FrameCache ahead of them being
+requested, used by FileInterface so that moving through a file one image
+at a time does not have to wait for images to be decoded.
+
+Each time an image is requested, request() is called with its index. The
+thread then loads the next numAhead images in the direction the index last
+moved, followed by the image one step back, skipping any already in the
+cache. If another request is made before this is finished, the thread
+starts again from the new index.
+
+The load function is only ever called from this thread, so it can use its
+own handle to the file without locking.
+
+"""
+
+import threading
+import logging
+
+
+class PrefetchThread(threading.Thread):
+    """ Loads images into a cache in the background.
+
+    Arguments:
+        load_function : function
+                        called with the index of an image, returns the image
+        cache         : FrameCache
+                        cache to store images in, using the index as key
+        numImages     : int
+                        number of images in the file
+
+    Keyword Arguments:
+        numAhead      : int
+                        number of images to load ahead (default is 8)
+    """
+
+    waitTimeout = 0.1
+
+    def __init__(self, load_function, cache, numImages, numAhead = 8):
+
+        super().__init__()
+        self.daemon = True
+        self.load_function = load_function
+        self.cache = cache
+        self.numImages = numImages
+        self.numAhead = numAhead
+
+        self.targetIdx = None
+        self.lastIdx = None
+        self.direction = 1
+        self.isChanged = False
+        self.isRunning = True
+        self.numLoaded = 0
+        self.condition = threading.Condition()
+
+
+    def run(self):
+
+        while self.isRunning:
+            with self.condition:
+                self.condition.wait_for(lambda: self.isChanged or not self.isRunning, self.waitTimeout)
+                if not self.isChanged:
+                    continue
+                self.isChanged = False
+                order = self.get_prefetch_order(self.targetIdx, self.direction)
+
+            for idx in order:
+                if self.isChanged or not self.isRunning:
+                    break
+                if idx in self.cache:
+                    continue
+                try:
+                    self.cache.put(idx, self.load_function(idx))
+                    self.numLoaded = self.numLoaded + 1
+                except Exception as e:
+                    logging.exception(e)
+                    break
+
+
+    def get_prefetch_order(self, idx, direction):
+        """ Returns a list of the indices of the images to load, in order,
+        after image idx has been requested.
+        """
+        ahead = [idx + direction * step for step in range(1, self.numAhead + 1)]
+        order = ahead + [idx - direction]
+        return [i for i in order if 0 <= i < self.numImages]
+
+
+    def request(self, idx):
+        """ Informs the thread that image idx has been requested.
+        """
+        with self.condition:
+            if self.lastIdx is not None and idx != self.lastIdx:
+                self.direction = 1 if idx > self.lastIdx else -1
+            self.lastIdx = idx
+            self.targetIdx = idx
+            self.isChanged = True
+            self.condition.notify()
+
+
+    def stop(self):
+        """ Stops the thread, waiting for any image being loaded.
+        """
+        with self.condition:
+            self.isRunning = False
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
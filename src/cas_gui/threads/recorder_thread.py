@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+RecorderThread
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Threading class which writes images to file using a recorder (see
+cas_gui.utils.recorders), so that slow writes do not hold up the GUI or the
+acquisition.
+
+Images are taken from a bounded queue. This can be an existing queue, such
+as the auxillary queue of an ImageAcquisitionThread, passed as inputQueue,
+or a queue created by the thread, in which case images are added using
+add_frame(). If the queue is full, add_frame() does not wait, the image is
+dropped and counted in numDroppedFrames. get_back_pressure() returns how full
+the queue is, so that a caller can tell if the recorder is falling behind.
+
+finish() tells the thread to write the remaining images in the queue and
+then close the file, stop() does the same but waits for this to complete.
+
+TriggeredRecorderThread instead writes images from a CircularFrameBuffer,
+starting with images acquired before the thread was created (the trigger),
+and continuing for a set time or number of images after it.
+
+"""
+
+import time
+import queue
+import threading
+import logging
+
+from cas_gui.utils.pipeline_metrics import PipelineMetrics
+
+
+class RecorderThread(threading.Thread):
+    """ Thread to write images to file.
+
+    Arguments:
+        recorder   : Recorder
+                     recorder to write images with
+
+    Keyword Arguments:
+        inputQueue : Queue or None
+                     queue to take images (or FrameRecords) from, default is
+                     to create one of size bufferSize
+        bufferSize : int
+                     size of queue created if inputQueue is None (default
+                     is 100)
+        metrics    : PipelineMetrics or None
+                     metrics object to record write times, queue depths and
+                     dropped frames in, default is to create one
+    """
+
+    waitTimeout = 0.05
+
+    def __init__(self, recorder, inputQueue = None, bufferSize = 100, metrics = None):
+
+        super().__init__()
+
+        self.recorder = recorder
+        self.inputQueue = inputQueue
+        if self.inputQueue is None:
+            self.inputQueue = queue.Queue(maxsize = bufferSize)
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = PipelineMetrics()
+
+        self.numFramesRecorded = 0
+        self.numDroppedFrames = 0
+        self.error = None
+
+        self._stop_event = threading.Event()
+        self._finish_event = threading.Event()
+
+
+    def run(self):
+        """ Writes images from the queue until stopped, or until the queue is
+        empty once finish() has been called, and then closes the file.
+        """
+        while not self._stop_event.is_set():
+
+            try:
+                frame = self.inputQueue.get(timeout = self.waitTimeout)
+            except queue.Empty:
+                if self._finish_event.is_set():
+                    break
+                continue
+
+            try:
+                with self.metrics.timer(PipelineMetrics.RECORD):
+                    self.recorder.write_frame(frame)
+                self.numFramesRecorded = self.numFramesRecorded + 1
+                self.metrics.add_queue_depth(PipelineMetrics.RECORD, self.inputQueue.qsize())
+            except Exception as e:
+                logging.error(f"Error writing to {self.recorder.filename}: {e}")
+                self.error = e
+                break
+
+        try:
+            self.recorder.close()
+        except Exception as e:
+            logging.error(f"Error closing {self.recorder.filename}: {e}")
+            self.error = e
+
+
+    def add_frame(self, frame):
+        """ Adds an image or FrameRecord to the queue to be written. If the
+        queue is full the image is dropped.
+
+        Returns:
+            boolean : True if the image was added, False if it was dropped
+        """
+        try:
+            self.inputQueue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.numDroppedFrames = self.numDroppedFrames + 1
+            self.metrics.add_drop(PipelineMetrics.RECORD)
+            return False
+
+
+    def get_num_frames_waiting(self):
+        """ Returns the number of images in the queue waiting to be written.
+        """
+        return self.inputQueue.qsize()
+
+
+    def get_back_pressure(self):
+        """ Returns the fraction of the queue which is full, from 0 to 1. If
+        this approaches 1 the recorder is not keeping up.
+        """
+        if self.inputQueue.maxsize > 0:
+            return self.inputQueue.qsize() / self.inputQueue.maxsize
+        else:
+            return 0
+
+
+    def is_finished(self):
+        """ Returns True once the file has been closed.
+        """
+        return self.ident is not None and not self.is_alive()
+
+
+    def finish(self):
+        """ Tells the thread to write the images remaining in the queue and
+        then close the file. Returns immediately.
+        """
+        self._finish_event.set()
+
+
+    def stop(self, flush = True):
+        """ Stops the thread and waits for the file to be closed.
+
+        Keyword Arguments:
+            flush : boolean
+                    if True (default), images remaining in the queue are
+                    written first, otherwise they are discarded
+        """
+        if flush:
+            self.finish()
+        else:
+            self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+class TriggeredRecorderThread(RecorderThread):
+    """ Thread to write the images in a CircularFrameBuffer from before and
+    after a trigger to file. The trigger is the time the thread is created.
+    Images are read from the buffer as they are written, and so images added
+    after the trigger are written as they arrive. If the thread falls so far
+    behind that images are overwritten in the buffer before they are
+    written, they are counted in numDroppedFrames.
+
+    Arguments:
+        buffer     : CircularFrameBuffer
+                     buffer to take images from
+        recorder   : Recorder
+                     recorder to write images with
+
+    Keyword Arguments:
+        preTime    : float or None
+                     seconds of images before the trigger to write, default
+                     is all images in the buffer
+        postTime   : float or None
+                     seconds of images after the trigger to write, default
+                     is to write images until finish() or stop() is called
+        preFrames  : int or None
+                     number of images before the trigger to write, used
+                     instead of preTime if specified
+        postFrames : int or None
+                     number of images after the trigger to write, used
+                     instead of postTime if specified
+        metrics    : PipelineMetrics or None
+                     metrics object to record write times and dropped frames
+                     in, default is to create one
+    """
+
+    def __init__(self, buffer, recorder, preTime = None, postTime = None, preFrames = None,
+                 postFrames = None, metrics = None):
+
+        super().__init__(recorder, bufferSize = 1, metrics = metrics)
+
+        self.buffer = buffer
+        self.triggerTime = time.perf_counter()
+        self.triggerIndex = buffer.get_next_index()
+
+        if preFrames is not None:
+            self.startIndex = self.triggerIndex - preFrames
+        elif preTime is not None:
+            self.startIndex = buffer.find_index(self.triggerTime - preTime)
+        else:
+            self.startIndex = buffer.get_oldest_index()
+        self.startIndex = max(self.startIndex, buffer.get_oldest_index())
+
+        self.endIndex = None if postFrames is None else self.triggerIndex + postFrames
+        self.endTime = None if postTime is None else self.triggerTime + postTime
+        self.nextIndex = self.startIndex
+
+
+    def run(self):
+        """ Writes images from the buffer until the end of the post-trigger
+        period, or until stopped, and then closes the file.
+        """
+        while not self._stop_event.is_set():
+
+            if self.endIndex is not None and self.nextIndex >= self.endIndex:
+                break
+
+            frame = self.buffer.get_frame(self.nextIndex, timeout = self.waitTimeout)
+
+            if frame is None:
+                oldestIndex = self.buffer.get_oldest_index()
+                if self.nextIndex < oldestIndex:
+                    self.numDroppedFrames = self.numDroppedFrames + oldestIndex - self.nextIndex
+                    self.metrics.add_drop(PipelineMetrics.RECORD, oldestIndex - self.nextIndex)
+                    self.nextIndex = oldestIndex
+                elif self._finish_event.is_set():
+                    break
+                elif self.endTime is not None and time.perf_counter() > self.endTime + self.waitTimeout:
+                    break
+                continue
+
+            if self.endTime is not None and frame.timestamp >= self.endTime:
+                break
+
+            try:
+                with self.metrics.timer(PipelineMetrics.RECORD):
+                    self.recorder.write_frame(frame)
+                self.numFramesRecorded = self.numFramesRecorded + 1
+                self.nextIndex = self.nextIndex + 1
+                self.metrics.add_queue_depth(PipelineMetrics.RECORD, self.get_num_frames_waiting())
+            except Exception as e:
+                logging.error(f"Error writing to {self.recorder.filename}: {e}")
+                self.error = e
+                break
+
+        try:
+            self.recorder.close()
+        except Exception as e:
+            logging.error(f"Error closing {self.recorder.filename}: {e}")
+            self.error = e
+
+
+    def finish(self):
+        """ Tells the thread to write the images added to the buffer up to
+        now and then close the file. Returns immediately.
+        """
+        nextIndex = self.buffer.get_next_index()
+        if self.endIndex is None or nextIndex < self.endIndex:
+            self.endIndex = nextIndex
+        super().finish()
+
+
+    def add_frame(self, frame):
+        """ Images are taken from the buffer, so this does nothing and
+        returns False.
+        """
+        return False
+
+
+    def get_num_frames_waiting(self):
+        """ Returns the number of images in the buffer waiting to be written.
+        """
+        return max(self.buffer.get_next_index() - self.nextIndex, 0)
+
+
+    def get_back_pressure(self):
+        """ Returns the fraction of the buffer holding images waiting to be
+        written, from 0 to 1. If this reaches 1 images will be lost.
+        """
+        return min(self.get_num_frames_waiting() / self.buffer.numFrames, 1)
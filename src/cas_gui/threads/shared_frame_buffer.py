@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+SharedFrameBuffer
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A ring buffer of raw frames held in shared memory, for passing frames between
+an ImageAcquisitionThread and an ImageProcessorProcess running on another
+core without pickling them.
+
+The buffer consists of a fixed number of preallocated slots, each large
+enough to hold one frame of up to slotBytes bytes. Each slot has a small
+header storing a sequence number, the slot state and the dtype and shape
+of the frame held in it. A write cursor and a read cursor, also stored in
+shared memory, determine where the next frame will be written and read from.
+
+SharedFrameBuffer implements the parts of the Queue interface used by
+CAS (put, get, put_nowait, get_nowait, qsize, empty, full), and so can be
+passed in place of a multiprocessing.Queue as the imageQueue of an
+ImageAcquisitionThread and the inputQueue of an ImageProcessorThread or
+ImageProcessorProcess. The object can be passed to a child process when it
+is created, in which case the child attaches to the same shared memory.
+
+Frames are copied into a slot by put and copied out of a slot by get. If
+get is called with copy = False then a view of the slot is returned instead,
+and the slot will not be reused until the next call to get or to release.
+
+Frames can be either numpy arrays or FrameRecords. The metadata of a 
+FrameRecord is stored in the slot header and get returns a FrameRecord for
+these frames.
+
+"""
+
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from cas_gui.threads.frame_record import FrameRecord
+
+
+class SharedFrameBuffer:
+
+    # Slot states
+    FREE = 0
+    WRITING = 1
+    READY = 2
+    HELD = 3
+
+    # Positions of values in the global header
+    WRITE_CURSOR = 0
+    READ_CURSOR = 1
+
+    headerBytes = 64
+    maxDims = 4
+    slotHeaderDtype = np.dtype([('sequence', '<i8'),
+                                ('state', '<i8'),
+                                ('ndim', '<i8'),
+                                ('shape', '<i8', (4,)),
+                                ('dtype', 'S8'),
+                                ('isRecord', '<i8'),
+                                ('frameNumber', '<i8'),
+                                ('timestamp', '<f8'),
+                                ('hardwareTimestamp', '<f8'),
+                                ('cameraID', '<i8'),
+                                ('numImages', '<i8'),
+                                ('stageTimes', '<f8', (len(FrameRecord.STAGES),))])
+
+    sharedMemory = None
+    heldSlot = None
+
+    def __init__(self, numSlots = 10, slotBytes = 2048 * 2048 * 2, name = None):
+        """ Creates a new ring buffer in shared memory.
+
+        Keyword Arguments:
+            numSlots  : int
+                        number of frames the buffer can hold (default is 10)
+            slotBytes : int
+                        maximum size of each frame in bytes, default is
+                        enough for a 2048 x 2048 16 bit image
+            name      : str or None
+                        name of the shared memory block, a random name is
+                        used if not specified
+        """
+
+        self.numSlots = int(numSlots)
+        self.slotBytes = int(slotBytes)
+        self.isCreator = True
+        self.condition = multiprocessing.Condition()
+
+        self.sharedMemory = shared_memory.SharedMemory(create = True, size = self._total_bytes(), name = name)
+        self.name = self.sharedMemory.name
+        self._map()
+
+        self._header[:] = 0
+        self._slots[:] = np.zeros(1, dtype = self.slotHeaderDtype)
+
+
+    def __getstate__(self):
+        """ Only the name and size of the shared memory and the shared
+        condition are pickled when passing the buffer to another process.
+        """
+        return {'name': self.name, 'numSlots': self.numSlots,
+                'slotBytes': self.slotBytes, 'condition': self.condition}
+
+
+    def __setstate__(self, state):
+        """ Attaches to existing shared memory when unpickled in another
+        process.
+        """
+        self.name = state['name']
+        self.numSlots = state['numSlots']
+        self.slotBytes = state['slotBytes']
+        self.condition = state['condition']
+        self.isCreator = False
+        self.heldSlot = None
+        self.sharedMemory = _attach_shared_memory(self.name)
+        self._map()
+
+
+    def _total_bytes(self):
+        return self._data_offset() + self.numSlots * self.slotBytes
+
+
+    def _data_offset(self):
+        """ Offset of first slot in bytes, aligned to 64 bytes.
+        """
+        headerSize = self.headerBytes + self.numSlots * self.slotHeaderDtype.itemsize
+        return int(np.ceil(headerSize / 64) * 64)
+
+
+    def _map(self):
+        """ Creates numpy views of the headers in shared memory.
+        """
+        self._header = np.ndarray((self.headerBytes // 8,), dtype = '<i8',
+                                  buffer = self.sharedMemory.buf)
+        self._slots = np.ndarray((self.numSlots,), dtype = self.slotHeaderDtype,
+                                 buffer = self.sharedMemory.buf, offset = self.headerBytes)
+
+
+    def _slot_array(self, slot):
+        """ Returns a view of the frame currently stored in a slot.
+        """
+        header = self._slots[slot]
+        shape = tuple(header['shape'][:header['ndim']])
+        dtype = np.dtype(header['dtype'].decode())
+        return np.ndarray(shape, dtype = dtype, buffer = self.sharedMemory.buf,
+                          offset = self._data_offset() + slot * self.slotBytes)
+
+
+    def _next_slot_free(self):
+        return self._slots[self._header[self.WRITE_CURSOR] % self.numSlots]['state'] == self.FREE
+
+
+    def _frame_ready(self):
+        return self._header[self.READ_CURSOR] < self._header[self.WRITE_CURSOR]
+
+
+    def put(self, frame, block = True, timeout = None):
+        """ Copies a frame into the next slot of the buffer. If the buffer
+        is full and block is True this waits for a slot to become
+        free, otherwise queue.Full is raised.
+
+        Arguments:
+            frame   : numpy.ndarray or FrameRecord
+                      frame to add to buffer
+
+        Keyword Arguments:
+            block   : boolean
+                      if True (default) wait for a free slot if buffer is full
+            timeout : float or None
+                      maximum time to wait in seconds, default is to wait
+                      indefinitely
+        """
+
+        record = frame if isinstance(frame, FrameRecord) else None
+        frame = np.asarray(frame.image if record is not None else frame)
+        if frame.nbytes > self.slotBytes:
+            raise ValueError(f"Frame of {frame.nbytes} bytes is larger than buffer slot size of {self.slotBytes} bytes.")
+        if frame.ndim > self.maxDims:
+            raise ValueError(f"Frames can have at most {self.maxDims} dimensions.")
+
+        with self.condition:
+            if not self.condition.wait_for(self._next_slot_free, timeout if block else 0):
+                raise queue.Full
+            sequence = int(self._header[self.WRITE_CURSOR])
+            slot = sequence % self.numSlots
+            self._slots[slot]['state'] = self.WRITING
+
+        # The copy is done without holding the lock, the slot cannot be
+        # read until the write cursor has been advanced
+        header = self._slots[slot]
+        header['ndim'] = frame.ndim
+        header['shape'][:] = 0
+        header['shape'][:frame.ndim] = frame.shape
+        header['dtype'] = frame.dtype.str.encode()
+        self._write_record(header, record)
+        self._slot_array(slot)[...] = frame
+
+        with self.condition:
+            self._slots[slot]['sequence'] = sequence
+            self._slots[slot]['state'] = self.READY
+            self._header[self.WRITE_CURSOR] = sequence + 1
+            self.condition.notify_all()
+
+
+    def put_nowait(self, frame):
+        """ Adds a frame to the buffer, raising queue.Full if there is no
+        free slot.
+        """
+        self.put(frame, block = False)
+
+
+    def get(self, block = True, timeout = None, copy = True):
+        """ Removes the oldest frame from the buffer and returns it. If the
+        buffer is empty and block is True this waits for a frame to be
+        added, otherwise queue.Empty is raised.
+
+        Keyword Arguments:
+            block   : boolean
+                      if True (default) wait for a frame if buffer is empty
+            timeout : float or None
+                      maximum time to wait in seconds, default is to wait
+                      indefinitely
+            copy    : boolean
+                      if True (default) a copy of the frame is returned. If
+                      False, a view of the shared memory is returned
+                      which remains valid until the next call of get or
+                      release.
+
+        Returns:
+            numpy.ndarray or FrameRecord : frame
+        """
+
+        self.release()
+
+        with self.condition:
+            if not self.condition.wait_for(self._frame_ready, timeout if block else 0):
+                raise queue.Empty
+            sequence = int(self._header[self.READ_CURSOR])
+            slot = sequence % self.numSlots
+            self._slots[slot]['state'] = self.HELD
+            self._header[self.READ_CURSOR] = sequence + 1
+
+        frame = self._slot_array(slot)
+
+        if copy:
+            frame = frame.copy()
+        record = self._read_record(self._slots[slot], frame)
+        if copy:
+            self._free_slot(slot)
+        else:
+            self.heldSlot = slot
+
+        return frame if record is None else record
+
+
+    def get_nowait(self, copy = True):
+        """ Removes the oldest frame from the buffer and returns it, raising
+        queue.Empty if there is no frame.
+        """
+        return self.get(block = False, copy = copy)
+
+
+    def _write_record(self, header, record):
+        """ Stores the metadata of a FrameRecord in a slot header.
+        """
+        header['isRecord'] = record is not None
+        if record is not None:
+            header['frameNumber'] = record.frameNumber
+            header['timestamp'] = record.timestamp
+            header['hardwareTimestamp'] = np.nan if record.hardwareTimestamp is None else record.hardwareTimestamp
+            header['cameraID'] = record.cameraID
+            header['numImages'] = record.numImages
+            record.stage_times_to_array(header['stageTimes'])
+
+
+    def _read_record(self, header, frame):
+        """ Returns a FrameRecord for frame using the metadata in a slot 
+        header, or None if the frame was not put as a FrameRecord.
+        """
+        if not header['isRecord']:
+            return None
+        hardwareTimestamp = float(header['hardwareTimestamp'])
+        return FrameRecord(frame, int(header['frameNumber']), float(header['timestamp']),
+                           None if np.isnan(hardwareTimestamp) else hardwareTimestamp,
+                           int(header['cameraID']), 
+                           stageTimes = FrameRecord.stage_times_from_array(header['stageTimes']),
+                           numImages = int(header['numImages']))
+
+
+    def release(self):
+        """ Releases the slot of the last frame returned by get with
+        copy = False, allowing it to be overwritten.
+        """
+        if self.heldSlot is not None:
+            self._free_slot(self.heldSlot)
+            self.heldSlot = None
+
+
+    def _free_slot(self, slot):
+        with self.condition:
+            self._slots[slot]['state'] = self.FREE
+            self.condition.notify_all()
+
+
+    def qsize(self):
+        """ Returns the number of frames waiting to be read.
+        """
+        return int(self._header[self.WRITE_CURSOR] - self._header[self.READ_CURSOR])
+
+
+    def empty(self):
+        """ Returns True if there are no frames waiting to be read.
+        """
+        return self.qsize() == 0
+
+
+    def full(self):
+        """ Returns True if a frame cannot currently be added without waiting.
+        """
+        with self.condition:
+            return not self._next_slot_free()
+
+
+    def get_sequence_numbers(self):
+        """ Returns the sequence numbers of the next frame to be written and
+        the next frame to be read, as a tuple of (write, read).
+        """
+        return int(self._header[self.WRITE_CURSOR]), int(self._header[self.READ_CURSOR])
+
+
+    def close(self):
+        """ Detaches from the shared memory. If called on the instance which
+        created the buffer, the shared memory is also released.
+        """
+        if self.sharedMemory is None:
+            return
+        self.release()
+        self._header = None
+        self._slots = None
+        try:
+            self.sharedMemory.close()
+        except BufferError:
+            # A view returned by get(copy = False) is still in use
+            pass
+        if self.isCreator:
+            self.sharedMemory.unlink()
+        self.sharedMemory = None
+
+
+def _attach_shared_memory(name):
+    """ Attaches to an existing block of shared memory. Where possible this
+    is not registered with the resource tracker, since the block belongs
+    to the process that created it.
+    """
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        return shared_memory.SharedMemory(name = name)
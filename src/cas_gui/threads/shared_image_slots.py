@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+SharedImageSlots
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A set of image slots in shared memory, used by ImageProcessorProcess to
+return processed images to ImageProcessorThread when useSharedMemory is True.
+
+Each slot has its own header storing the frame counter, image id,
+processing frame step time, the dtype and shape of the image in the slot and
+the metadata of its FrameRecord.
+The writer always writes into a slot which is neither the most recently
+published slot nor pinned by a reader, and then publishes it as the latest
+slot, so a reader never sees a partly written image.
+
+A reader pins the latest slot using acquire_latest(), which can wait for a
+new image to be written, and returns a FrameRecord containing a view
+of the image in shared memory (i.e. no copy is made). The slot will not be
+overwritten until it has been released using release(). With at least three
+slots, the writer always has a slot available while the reader holds one. If
+a reader holds more slots than this, and there is no free slot, the writer
+drops the image.
+
+The slot headers are stored in one block of shared memory and the images
+in a second block. The image block is not allocated until the first image is
+written, and its size, and hence the dtype, number of channels and size of
+images, is taken from that image. If a later image does not fit, or is much
+smaller, the image block is reallocated under a new name. The generation
+number of the current image block is stored in the header block, and readers
+attach to the new block the next time they acquire an image. The reader
+keeps older blocks mapped until close() is called, so that views of images
+from an older block never point to unmapped memory, although their contents
+are only guaranteed until they are released.
+
+The object can be passed to a child process when it is created, in which
+case the child attaches to the same shared memory.
+
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from cas_gui.threads.shared_frame_buffer import _attach_shared_memory
+from cas_gui.threads.frame_record import FrameRecord
+
+
+class SharedImageSlots:
+
+    # Slot states
+    FREE = 0
+    WRITING = 1
+    READY = 2
+
+    # Positions of values in the global header
+    LATEST_SLOT = 0
+    GENERATION = 1
+    SLOT_BYTES = 2
+    
+    # The image block is reallocated if images shrink to less than
+    # 1/shrinkFactor of the slot size
+    shrinkFactor = 4
+
+    headerBytes = 64
+    maxDims = 4
+    slotHeaderDtype = np.dtype([('state', '<i8'),
+                                ('pins', '<i8'),
+                                ('counter', '<i8'),
+                                ('imageId', '<i8'),
+                                ('frameStepTime', '<f8'),
+                                ('ndim', '<i8'),
+                                ('shape', '<i8', (4,)),
+                                ('dtype', 'S8'),
+                                ('frameNumber', '<i8'),
+                                ('timestamp', '<f8'),
+                                ('hardwareTimestamp', '<f8'),
+                                ('cameraID', '<i8'),
+                                ('stageTimes', '<f8', (len(FrameRecord.STAGES),))])
+
+    sharedMemory = None
+    imageMemory = None
+
+    def __init__(self, numSlots = 3, name = None):
+        """ Creates a new set of image slots in shared memory.
+
+        Keyword Arguments:
+            numSlots  : int
+                        number of slots, at least 3 (default)
+            name      : str or None
+                        name of the shared memory block for the headers, a
+                        random name is used if not specified. Image blocks
+                        use this name with the generation number appended.
+        """
+
+        self.numSlots = max(int(numSlots), 3)
+        self.isCreator = True
+        self.condition = multiprocessing.Condition()
+
+        self.sharedMemory = shared_memory.SharedMemory(create = True, size = self._header_bytes(), name = name)
+        self.name = self.sharedMemory.name
+        self._map()
+
+        self._header[:] = 0
+        self._header[self.LATEST_SLOT] = -1
+        self._slots[:] = np.zeros(1, dtype = self.slotHeaderDtype)
+        self._slots['counter'] = -1
+        
+        self._init_image_memory()
+
+
+    def __getstate__(self):
+        """ Only the name and size of the shared memory and the shared
+        condition are pickled when passing the slots to another process.
+        """
+        return {'name': self.name, 'numSlots': self.numSlots, 'condition': self.condition}
+
+
+    def __setstate__(self, state):
+        """ Attaches to existing shared memory when unpickled in another
+        process.
+        """
+        self.name = state['name']
+        self.numSlots = state['numSlots']
+        self.condition = state['condition']
+        self.isCreator = False
+        self.sharedMemory = _attach_shared_memory(self.name)
+        self._map()
+        self._init_image_memory()
+
+
+    def _init_image_memory(self):
+        """ Local record of the image block this instance is attached to, 
+        plus any older blocks which have been replaced.
+        """
+        self.imageMemory = None
+        self.generation = 0
+        self.slotBytes = 0
+        self.isImageMemoryCreator = False
+        self.oldImageMemory = []
+
+
+    def _header_bytes(self):
+        return self.headerBytes + self.numSlots * self.slotHeaderDtype.itemsize
+
+
+    def _map(self):
+        """ Creates numpy views of the headers in shared memory.
+        """
+        self._header = np.ndarray((self.headerBytes // 8,), dtype = '<i8',
+                                  buffer = self.sharedMemory.buf)
+        self._slots = np.ndarray((self.numSlots,), dtype = self.slotHeaderDtype,
+                                 buffer = self.sharedMemory.buf, offset = self.headerBytes)
+
+
+    def _image_memory_name(self, generation):
+        return f"{self.name}_{generation}"
+
+
+    def _slot_array(self, slot):
+        """ Returns a view of the image currently stored in a slot of the
+        current image block.
+        """
+        header = self._slots[slot]
+        shape = tuple(header['shape'][:header['ndim']])
+        dtype = np.dtype(header['dtype'].decode())
+        return np.ndarray(shape, dtype = dtype, buffer = self.imageMemory.buf,
+                          offset = slot * self.slotBytes)
+
+
+    def _sync_image_memory(self):
+        """ Attaches to the current image block if the writer has 
+        reallocated it. Must be called while holding the lock.
+        """
+        generation = int(self._header[self.GENERATION])
+        if generation == self.generation:
+            return
+        
+        # Numpy does not prevent shared memory being closed while views of
+        # it exist, so the old block is kept open in case images from it are
+        # still in use
+        if self.imageMemory is not None:
+            self.oldImageMemory.append(self.imageMemory)
+            
+        self.imageMemory = _attach_shared_memory(self._image_memory_name(generation))
+        self.generation = generation
+        self.slotBytes = int(self._header[self.SLOT_BYTES])
+        self.isImageMemoryCreator = False
+        
+        
+    def _allocate_image_memory(self, slotBytes):
+        """ Creates a new image block with slots of slotBytes. Must be called
+        by the writer while holding the lock.
+        """
+        generation = int(self._header[self.GENERATION]) + 1
+        newMemory = shared_memory.SharedMemory(create = True, size = self.numSlots * slotBytes, 
+                                               name = self._image_memory_name(generation))
+        
+        # The old block is unlinked, any reader which has attached to it keeps
+        # it open until close() is called
+        if self.imageMemory is not None:
+            self._close_image_memory(self.imageMemory, unlink = True)
+            
+        self.imageMemory = newMemory
+        self.generation = generation
+        self.slotBytes = slotBytes
+        self.isImageMemoryCreator = True
+        
+        # Images in the previous block are no longer available
+        self._header[self.LATEST_SLOT] = -1
+        self._slots['state'] = self.FREE
+        self._slots['pins'] = 0
+        self._header[self.SLOT_BYTES] = slotBytes
+        self._header[self.GENERATION] = generation
+        
+        
+    def _close_image_memory(self, memory, unlink = False):
+        try:
+            memory.close()
+        except BufferError:
+            # An image view is still in use, it will be closed when released
+            pass
+        if unlink:
+            try:
+                memory.unlink()
+            except FileNotFoundError:
+                pass
+                
+    
+    def _needs_reallocation(self, nbytes):
+        return self.imageMemory is None or nbytes > self.slotBytes or nbytes * self.shrinkFactor < self.slotBytes
+
+
+    def _find_free_slot(self):
+        """ Returns the index of a slot which can be written to, or None if
+        all slots are in use. Must be called while holding the lock.
+        """
+        latest = self._header[self.LATEST_SLOT]
+        for slot in range(self.numSlots):
+            if slot != latest and self._slots['pins'][slot] == 0 and self._slots['state'][slot] != self.WRITING:
+                return slot
+        return None
+
+
+    def write(self, image, counter, imageId = 0, frameStepTime = 0, frame = None):
+        """ Copies an image into a free slot and publishes it as the latest
+        image.
+
+        Arguments:
+            image         : numpy.ndarray
+                            image to write
+            counter       : int
+                            frame counter, this should increase with
+                            each image written
+
+        Keyword Arguments:
+            imageId       : int
+                            id number for the image (default is 0)
+            frameStepTime : float
+                            time between processed images (default is 0)
+            frame         : FrameRecord or None
+                            record of the frame the image was processed
+                            from, its metadata is stored with the image. 
+                            Default is None.
+
+        Returns:
+            boolean       : True if image was written, False if there was no
+                            free slot and so the image was dropped
+        """
+
+        image = np.asarray(image)
+        if image.ndim > self.maxDims:
+            raise ValueError(f"Images can have at most {self.maxDims} dimensions.")
+
+        with self.condition:
+            if self._needs_reallocation(image.nbytes):
+                self._allocate_image_memory(max(image.nbytes, 1))
+            slot = self._find_free_slot()
+            if slot is None:
+                return False
+            self._slots['state'][slot] = self.WRITING
+
+        self._slots['ndim'][slot] = image.ndim
+        self._slots['shape'][slot] = 0
+        self._slots['shape'][slot, :image.ndim] = image.shape
+        self._slots['dtype'][slot] = image.dtype.str.encode()
+        self._write_record(self._slots[slot], frame)
+        self._slot_array(slot)[...] = image
+
+        with self.condition:
+            self._slots['counter'][slot] = counter
+            self._slots['imageId'][slot] = imageId
+            self._slots['frameStepTime'][slot] = frameStepTime
+            self._slots['state'][slot] = self.READY
+            self._header[self.LATEST_SLOT] = slot
+            self.condition.notify_all()
+
+        return True
+
+
+    def acquire_latest(self, lastCounter = -1, timeout = 0):
+        """ Pins the most recently written image, provided it is newer than
+        lastCounter, so that it cannot be overwritten. The slot must be
+        released using release() once the image is no longer needed.
+
+        Keyword Arguments:
+            lastCounter : int
+                          counter of the last image obtained, only an image
+                          with a larger counter will be returned
+            timeout     : float or None
+                          time to wait in seconds for a new image if there is
+                          not one already, default is 0 (do not wait). None
+                          waits indefinitely.
+
+        Returns:
+            tuple of (handle, frame, counter) or None if there is no new 
+            image. frame is a FrameRecord, the image of which is a view of 
+            the shared memory. handle must be passed to release().
+        """
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: self._is_new_image(lastCounter), timeout):
+                return None
+            slot = int(self._header[self.LATEST_SLOT])
+            self._sync_image_memory()
+            self._slots['pins'][slot] += 1
+            counter = int(self._slots['counter'][slot])
+            frame = self._read_record(self._slots[slot], self._slot_array(slot))
+
+        return (self.generation, slot), frame, counter
+
+
+    def _write_record(self, header, frame):
+        """ Stores the metadata of a FrameRecord in a slot header.
+        """
+        if frame is None:
+            frame = FrameRecord(None, stageTimes = {})
+        header['frameNumber'] = frame.frameNumber
+        header['timestamp'] = frame.timestamp
+        header['hardwareTimestamp'] = np.nan if frame.hardwareTimestamp is None else frame.hardwareTimestamp
+        header['cameraID'] = frame.cameraID
+        frame.stage_times_to_array(header['stageTimes'])
+
+
+    def _read_record(self, header, image):
+        """ Returns a FrameRecord for image using the metadata in a slot 
+        header.
+        """
+        hardwareTimestamp = float(header['hardwareTimestamp'])
+        return FrameRecord(image, int(header['frameNumber']), float(header['timestamp']),
+                           None if np.isnan(hardwareTimestamp) else hardwareTimestamp,
+                           int(header['cameraID']), int(header['imageId']),
+                           FrameRecord.stage_times_from_array(header['stageTimes']))
+
+
+    def _is_new_image(self, lastCounter):
+        slot = self._header[self.LATEST_SLOT]
+        return slot >= 0 and self._slots['counter'][slot] > lastCounter
+    
+    
+    def release(self, handle):
+        """ Releases a slot pinned by acquire_latest().
+        
+        Arguments:
+            handle : tuple
+                     handle returned by acquire_latest()
+        """
+        generation, slot = handle
+        with self.condition:
+            # Pins were cleared when the image block was reallocated
+            if generation == int(self._header[self.GENERATION]) and self._slots['pins'][slot] > 0:
+                self._slots['pins'][slot] -= 1
+                
+                
+    def get_image_format(self):
+        """ Returns the shape and dtype of the latest image as a tuple of
+        (shape, dtype), or None if no images have been written.
+        """
+        slot = int(self._header[self.LATEST_SLOT])
+        if slot < 0:
+            return None
+        header = self._slots[slot]
+        return tuple(header['shape'][:header['ndim']]), np.dtype(header['dtype'].decode())
+
+
+    def get_frame_step_time(self):
+        """ Returns the frame step time stored with the latest image, or 0
+        if no images have been written.
+        """
+        slot = int(self._header[self.LATEST_SLOT])
+        if slot < 0:
+            return 0
+        return float(self._slots['frameStepTime'][slot])
+
+
+    def close(self):
+        """ Detaches from the shared memory. If called on the instance which
+        created the slots, the shared memory is also released.
+        """
+        if self.sharedMemory is None:
+            return
+        
+        # The creator of the headers also removes the current image block, in
+        # case the writer was terminated without doing so
+        unlinkImages = self.isCreator or self.isImageMemoryCreator
+        if self.imageMemory is None and self.isCreator and self._header[self.GENERATION] > 0:
+            try:
+                self.imageMemory = _attach_shared_memory(self._image_memory_name(int(self._header[self.GENERATION])))
+            except FileNotFoundError:
+                pass
+        if self.imageMemory is not None:
+            self._close_image_memory(self.imageMemory, unlink = unlinkImages)
+            self.imageMemory = None
+        for memory in self.oldImageMemory:
+            self._close_image_memory(memory)
+        self.oldImageMemory = []
+            
+        self._header = None
+        self._slots = None
+        self._close_image_memory(self.sharedMemory, unlink = self.isCreator)
+        self.sharedMemory = None
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Compression
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Lossless compression of blocks of images, used by ChunkedRecorder and
+load_chunked_stack. The codecs available are:
+
+    zlib - always available
+    zstd - if the zstandard package is installed
+    lz4  - if the lz4 package is installed
+    none - no compression
+
+All of these release the GIL while compressing, so blocks can be compressed
+in parallel using threads. Before compressing, the bytes of the array can be
+shuffled (byte 0 of every element, then byte 1 etc.), which usually gives
+much better compression of 16 bit images.
+
+"""
+
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+def available_codecs():
+    """ Returns a list of the names of the codecs which can be used.
+    """
+    codecs = ['zlib']
+    if zstandard is not None:
+        codecs.append('zstd')
+    if lz4 is not None:
+        codecs.append('lz4')
+    codecs.append('none')
+    return codecs
+
+
+def compress(data, codec = 'zlib', level = 1, shuffle = True):
+    """ Compresses a numpy array and returns the compressed bytes.
+
+    Arguments:
+        data    : numpy.ndarray
+                  array to compress
+
+    Keyword Arguments:
+        codec   : str
+                  name of codec, see available_codecs() (default is 'zlib')
+        level   : int
+                  compression level, higher is smaller but slower (default
+                  is 1)
+        shuffle : boolean
+                  if True (default) shuffle the bytes before compressing
+
+    Returns:
+        bytes   : compressed data
+    """
+
+    data = np.ascontiguousarray(data)
+    if shuffle and data.itemsize > 1:
+        data = data.reshape(-1).view(np.uint8).reshape(-1, data.itemsize).T.copy()
+    raw = data.tobytes()
+
+    if codec == 'zlib':
+        return zlib.compress(raw, level)
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level = level).compress(raw)
+    elif codec == 'lz4' and lz4 is not None:
+        return lz4.frame.compress(raw, compression_level = level)
+    elif codec == 'none':
+        return raw
+    else:
+        raise ValueError(f"Codec '{codec}' is not available.")
+
+
+def decompress(compressed, dtype, shape, codec = 'zlib', shuffle = True):
+    """ Decompresses bytes created by compress() and returns the array.
+
+    Arguments:
+        compressed : bytes
+                     compressed data
+        dtype      : numpy.dtype or str
+                     dtype of array
+        shape      : tuple
+                     shape of array
+
+    Keyword Arguments:
+        codec      : str
+                     name of codec used to compress (default is 'zlib')
+        shuffle    : boolean
+                     must be the same as when compressed (default is True)
+
+    Returns:
+        numpy.ndarray : array
+    """
+
+    if codec == 'zlib':
+        raw = zlib.decompress(compressed)
+    elif codec == 'zstd' and zstandard is not None:
+        raw = zstandard.ZstdDecompressor().decompress(compressed)
+    elif codec == 'lz4' and lz4 is not None:
+        raw = lz4.frame.decompress(compressed)
+    elif codec == 'none':
+        raw = compressed
+    else:
+        raise ValueError(f"Codec '{codec}' is not available.")
+
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(raw, dtype = np.uint8)
+    if shuffle and dtype.itemsize > 1:
+        data = data.reshape(dtype.itemsize, -1).T.copy()
+    return data.view(dtype).reshape(shape)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+FrameCache
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+A least-recently-used cache of images, limited by the total number of bytes
+of the images held rather than by the number of images. Used by
+FileInterface to keep decoded images from a file so that returning to them
+does not require them to be decoded again.
+
+Images are stored by reference under any hashable key, so they should not be
+modified after being added. When adding an image would take the total size
+above maxBytes, the least recently used images are discarded. Images larger
+than maxBytes are not stored. The cache can be used from several threads.
+
+CAS_GUI also uses a FrameCache to keep processed images from a file, using
+keys which include a version number of the processing options, so that a 
+stored result is only used if the options have not changed since it was
+produced.
+
+"""
+
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class FrameCache:
+    """ Byte-limited LRU cache of images.
+
+    Keyword Arguments:
+        maxBytes : int
+                   maximum total size of images held, in bytes (default is
+                   256 MB)
+    """
+
+    def __init__(self, maxBytes = 256 * 1024**2):
+
+        self.maxBytes = maxBytes
+        self.numBytes = 0
+        self.numHits = 0
+        self.numMisses = 0
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """ Returns the image stored under key, or None if it is not held.
+        """
+        with self.lock:
+            image = self.frames.get(key)
+            if image is None:
+                self.numMisses = self.numMisses + 1
+            else:
+                self.frames.move_to_end(key)
+                self.numHits = self.numHits + 1
+            return image
+
+
+    def put(self, key, image):
+        """ Stores image under key, discarding the least recently used
+        images if necessary.
+        """
+        if image is None or image.nbytes > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.frames:
+                self.numBytes = self.numBytes - self.frames.pop(key).nbytes
+            self.frames[key] = image
+            self.numBytes = self.numBytes + image.nbytes
+            while self.numBytes > self.maxBytes:
+                oldKey, oldImage = self.frames.popitem(last = False)
+                self.numBytes = self.numBytes - oldImage.nbytes
+
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.frames
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.frames)
+
+
+    def clear(self):
+        """ Removes all images.
+        """
+        with self.lock:
+            self.frames.clear()
+            self.numBytes = 0
+
+
+def state_hash(obj):
+    """ Returns a hash of the complete state of an object, such as an Image
+    Processor Class, found by pickling it, or None if it cannot be pickled.
+    Objects with the same state have the same hash, and any change to the 
+    value of an attribute, including the contents of arrays, changes it.
+    """
+    try:
+        data = pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    return hashlib.blake2b(data, digest_size = 16).hexdigest()
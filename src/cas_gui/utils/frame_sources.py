@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Frame Sources
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Classes for reading ranges of images from recordings, used by BatchEngine
+to process whole files. Each source is created with a filename (or array),
+len() gives the number of images, and get_images(start, stop) returns the
+images from start up to stop as an array of shape (n, h, w) or a list.
+Files are not opened until images are first requested.
+
+    FileSource    - any file which FileInterface can load, i.e. TIFF and
+                    other image files, and .npy files. .npy and uncompressed
+                    TIFF files are memory-mapped.
+    FolderSource  - folder of image files, one image per file, in order of
+                    filename, as loaded by load_stack in im_tools.
+    RawSource     - raw stream file written by RawStreamRecorder.
+    ChunkedSource - folder written by ChunkedRecorder.
+    ArraySource   - numpy array of images, e.g. returned by load_stack.
+
+open_source() returns a source of the appropriate type.
+
+Sources can be sent to other processes, each of which then opens the file
+itself, so that images are read in parallel. The exception is ArraySource,
+for which workerReadable is False, and so images must be read from it by
+the process which created it.
+
+"""
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from cas_gui.cameras.FileInterface import FileInterface
+from cas_gui.utils.recorders import RawStreamRecorder, RawStreamReader, ChunkedRecorder
+from cas_gui.utils.im_tools import load_chunked_info, load_chunked_stack, list_stack_files
+
+
+class FrameSource:
+    """ Base class for sources. Sub-classes implement open_reader,
+    get_number_images and read_images.
+
+    Arguments:
+        filename : str or Path
+                   path to file or folder
+    """
+
+    workerReadable = True
+
+    def __init__(self, filename):
+
+        self.filename = str(filename)
+        self.reader = None
+
+
+    def __len__(self):
+        return self.get_number_images()
+
+
+    def __str__(self):
+        return self.filename
+
+
+    def __getstate__(self):
+        # Another process opens the file itself
+        state = self.__dict__.copy()
+        state['reader'] = None
+        return state
+
+
+    def get_reader(self):
+        """ Returns the object used to read images, opening the file if
+        necessary.
+        """
+        if self.reader is None:
+            self.reader = self.open_reader()
+        return self.reader
+
+
+    def get_images(self, start, stop):
+        """ Returns images start up to (not including) stop.
+        """
+        return self.read_images(self.get_reader(), start, min(stop, len(self)))
+
+
+    def close(self):
+        """ Closes the file. It will be opened again if more images are
+        requested.
+        """
+        self.reader = None
+
+
+    def open_reader(self):
+        pass
+
+
+    def get_number_images(self):
+        pass
+
+
+    def read_images(self, reader, start, stop):
+        pass
+
+
+class FileSource(FrameSource):
+    """ Images from a file, read using FileInterface.
+    """
+
+    def open_reader(self):
+        # Images are read in order, so there is no need to cache or prefetch
+        reader = FileInterface(filename = self.filename, cacheBytes = 0, prefetchNum = 0)
+        if not reader.is_file_open():
+            raise ValueError(f"Could not open {self.filename}.")
+        return reader
+
+
+    def get_number_images(self):
+        reader = self.get_reader()
+        if reader.stack is None and not hasattr(reader.dataset, 'n_frames'):
+            return 1
+        return reader.get_number_images()
+
+
+    def read_images(self, reader, start, stop):
+        if reader.stack is not None:
+            return reader.stack[start:stop]
+        images = []
+        for idx in range(start, stop):
+            reader.set_image_idx(idx)
+            images.append(reader.get_image())
+        return images
+
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.dispose()
+        self.reader = None
+
+
+class FolderSource(FrameSource):
+    """ Images from a folder of image files, one image per file, in order of
+    filename.
+    """
+
+    def open_reader(self):
+        return list_stack_files(self.filename)
+
+
+    def get_number_images(self):
+        return len(self.get_reader())
+
+
+    def read_images(self, reader, start, stop):
+        images = []
+        for file in reader[start:stop]:
+            with Image.open(file) as im:
+                images.append(np.array(im))
+        return images
+
+
+class RawSource(FrameSource):
+    """ Images from a raw stream file written by RawStreamRecorder.
+    """
+
+    def open_reader(self):
+        return RawStreamReader(self.filename)
+
+
+    def get_number_images(self):
+        return len(self.get_reader())
+
+
+    def read_images(self, reader, start, stop):
+        if reader.frames is not None:
+            return reader.frames[start:stop]
+        return [reader[idx] for idx in range(start, stop)]
+
+
+class ChunkedSource(FrameSource):
+    """ Images from a folder written by ChunkedRecorder.
+    """
+
+    def open_reader(self):
+        metadata, frames = load_chunked_info(self.filename)
+        return metadata
+
+
+    def get_number_images(self):
+        return self.get_reader()['numFrames']
+
+
+    def read_images(self, reader, start, stop):
+        return load_chunked_stack(self.filename, start, stop)
+
+
+class ArraySource(FrameSource):
+    """ Images from a numpy array of shape (n, h, w), or a list of images.
+
+    Arguments:
+        images : ndarray or list
+                 the images
+    """
+
+    workerReadable = False
+
+    def __init__(self, images):
+
+        super().__init__("")
+        self.images = images
+
+
+    def __str__(self):
+        return f"array of {len(self.images)} images"
+
+
+    def open_reader(self):
+        return self.images
+
+
+    def get_number_images(self):
+        return len(self.images)
+
+
+    def read_images(self, reader, start, stop):
+        return reader[start:stop]
+
+
+def open_source(source):
+    """ Returns a source for source, which can be a filename, a folder of
+    images or recorded with ChunkedRecorder, an array or list of images, or
+    an existing source.
+    """
+    if isinstance(source, FrameSource):
+        return source
+    if isinstance(source, (np.ndarray, list)):
+        return ArraySource(source)
+    if os.path.isdir(source):
+        if os.path.exists(os.path.join(source, ChunkedRecorder.metadataFilename)):
+            return ChunkedSource(source)
+        return FolderSource(source)
+    if os.path.splitext(str(source))[1].lower() in RawStreamRecorder.extensions:
+        return RawSource(source)
+    return FileSource(source)
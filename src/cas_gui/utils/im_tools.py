@@ -6,11 +6,14 @@
 
 import os
 import math
+import json
 
 import numpy as np
 import numpy.ma as ma
 
-from PIL import Image
+from PIL import Image, TiffImagePlugin
+
+from cas_gui.utils.compression import decompress
 
 
 
@@ -129,7 +132,8 @@ def to8bit(img, minVal = None, maxVal = None):
     else:
         maxVal = maxVal - minVal
         
-    img = img / maxVal * 255
+    if maxVal > 0:
+        img = img / maxVal * 255
     img = img.astype('uint8')
     
     return img
@@ -167,7 +171,8 @@ def to16bit(img, minVal = None, maxVal = None):
     else:
         maxVal = maxVal - minVal
         
-    img = img / maxVal * (2^16 - 1)
+    if maxVal > 0:
+        img = img / maxVal * (2**16 - 1)
     img = img.astype('uint16')
     
     return img
@@ -258,7 +263,7 @@ def save_image16_scaled(img, filename):
                     path to save to, folder must exist
     """
         
-    im = Image.fromarray(to16bit(img)[0])
+    im = Image.fromarray(to16bit(img))
     im.save(filename) 
 
 
@@ -302,40 +307,110 @@ def max_channels(img):
         
     
 
+def list_stack_files(folder):
+    """ Returns the paths of the image files in a folder, in order of
+    filename.
+    
+    Arguments:
+        folder      : str or Path
+                      path to folder
+                      
+    Returns:
+        list of str, paths of files
+    """
+    
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) 
+                  if os.path.isfile(os.path.join(folder, f)))
+    
+
 def load_stack(folder):
-    """ Loads a stack of images from a folder into a 3D numpy array
+    """ Loads a stack of images from a folder into a 3D numpy array, in
+    order of filename. For stacks too large to hold in memory use iter_stack.
     
     Arguments:
         folder      : str
                       path to folder
-        status      : boolean
-                      if True, updates status on console (default = True)              
                       
     Returns:
         ndarray, 3D numpy array (im, y, x)                     
     """    
 
-    image_files = [f for f in os.listdir(folder)]
+    image_files = list_stack_files(folder)
     
     nImages = len(image_files)    
     
-    testIm = np.array(Image.open(os.path.join(folder,image_files[0])))
+    testIm = np.array(Image.open(image_files[0]))
     
     h, w = np.shape(testIm)    
     
     data = np.zeros((nImages, h, w), dtype = testIm.dtype)
-   
-   
     
-    for idx, image_file in enumerate(image_files):            
-        data[idx,:,:] = np.array(Image.open(os.path.join(folder,image_file)))        
+    for idx, im in enumerate(iter_stack(folder)):            
+        data[idx,:,:] = im
         
     return data   
+
+
+def iter_stack(source, chunk_size = None):
+    """ Generator which reads a stack of images one image, or one chunk of
+    images, at a time, so that the whole stack is never held in memory.
+    
+    Arguments:
+        source      : str or Path
+                      path to a folder of images, one image per file, which
+                      are read in order of filename, or to a multi-page
+                      image file such as a TIF stack
+                      
+    Keyword Arguments:
+        chunk_size  : int or None
+                      if None (default) each image is yielded as a 2D array,
+                      otherwise chunks of chunk_size images (fewer for the
+                      last chunk) are yielded as 3D arrays (im, y, x)
+                      
+    Yields:
+        ndarray, image or chunk of images                     
+    """
+    
+    if os.path.isdir(source):
+        images = iter_folder_images(source)
+    else:
+        images = iter_file_images(source)
+        
+    if chunk_size is None:
+        yield from images
+    else:
+        chunk = []
+        for im in images:
+            chunk.append(im)
+            if len(chunk) == chunk_size:
+                yield np.array(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield np.array(chunk)
+        
+        
+def iter_folder_images(folder):
+    """ Generator which yields the images in a folder, one per file, in order
+    of filename.
+    """
+    for image_file in list_stack_files(folder):
+        with Image.open(image_file) as im:
+            yield np.array(im)
+            
+            
+def iter_file_images(filename):
+    """ Generator which yields each image of a multi-page image file.
+    """
+    with Image.open(filename) as im:
+        for idx in range(getattr(im, 'n_frames', 1)):
+            im.seek(idx)
+            yield np.array(im)
   
 
 def save_tif_stack(stack, filename, bit_depth = 8, auto_contrast = None, fixed_min = None):
     """ Writes stack of images from 3D numpy array to file. The array must 
-    be orders (frame, y, x).
+    be orders (frame, y, x). Images are converted and written one at a time
+    (see write_tif_stack).
     
     Arguments:
         stack         : ndarray
@@ -359,19 +434,58 @@ def save_tif_stack(stack, filename, bit_depth = 8, auto_contrast = None, fixed_m
     """
     if stack.ndim != 3:
        raise Exception("Stack must be 3D array.")
-
-    if auto_contrast == 'stack':
-       maxVal = np.max(stack)
-       if fixed_min is None:
-           minVal = np.min(stack)
-       else:
-           minVal = fixed_min
-    elif auto_contrast == 'image' or auto_contrast == 'none' or auto_contrast is None:
-        pass
-    else:
-        raise Exception("Keyword auto_contrast only accepts 'stack', 'image' or None.")
-
        
+    write_tif_stack(stack, filename, bit_depth = bit_depth, auto_contrast = auto_contrast, 
+                    fixed_min = fixed_min)
+    
+    
+def write_tif_stack(images, filename, bit_depth = 8, auto_contrast = None, fixed_min = None,
+                    compression = "tiff_lzw"):
+    """ Writes a stack of images to a multi-page TIF file, appending each
+    image to the file as it is converted, so that only one image at a time 
+    is held in memory. This allows stacks larger than memory to be
+    converted, for example:
+        
+        write_tif_stack(lambda: iter_stack(folder), 'stack.tif', 
+                        auto_contrast = 'stack')
+    
+    Arguments:
+        images        : ndarray, iterable or function
+                        the images, either a 3D numpy array (frame, y, x), 
+                        or an iterable of 2D images or chunks of images 
+                        (chunk, y, x), such as iter_stack. When 
+                        auto_contrast is 'stack' the images are read twice,
+                        first to find the range of the stack and then to 
+                        write it, so this must be an array, a list or a 
+                        function which returns a new iterable each time it
+                        is called.
+        filename      : str or Path
+                        path to file name. Folder must exist.            
+                       
+    Keyword Arguments:
+        bit_depth     : int
+                        8 (default) or 16
+        auto_contrast : str or None
+                        Whether or not to scale images to use full bit depth
+                        'image' to autoscale each image individually
+                        'stack' to autoscale entire stack
+                        None or 'none' for no autoscaling
+        fixed_min     : int or None
+                        if auto_contrast is 'image' or 'stack', setting this
+                        value fixed the lower range of the saved image pixel
+                        values rather than taking the minimum from the images.
+        compression   : str or None
+                        TIF compression used by PIL (default is 'tiff_lzw')
+                        
+    Returns:
+        int, number of images written
+    """
+    
+    if auto_contrast == 'none':
+        auto_contrast = None
+    if auto_contrast not in ('stack', 'image', None):
+        raise Exception("Keyword auto_contrast only accepts 'stack', 'image' or None.")
+        
     if bit_depth == 16:
         dt = 'uint16'
     elif bit_depth == 8:
@@ -379,31 +493,156 @@ def save_tif_stack(stack, filename, bit_depth = 8, auto_contrast = None, fixed_m
     else:
         raise Exception("Bit depth can only be 8 or 16.")
     
-    imlist = []
-    for im in stack:
+    if callable(images):
+        get_images = images
+    elif auto_contrast == 'stack' and iter(images) is images:
+        raise ValueError("Images can only be read once, pass a function which returns them to autoscale the stack.")
+    else:
+        get_images = lambda: images
         
-        if auto_contrast == 'image':
-            maxVal = np.max(np.abs(im))
-            if fixed_min is None:
-                minVal = np.min(np.abs(im))
-            else:
-                minVal = fixed_min
-                
-        if auto_contrast is not None:
-            im = im.astype('float64') - minVal
-            intrange = maxVal - minVal
-            if intrange > 0:
-                im = im / intrange * (2**bit_depth - 1)
-            else:
-                im[:] = 2**bit_depth - 1
-        imlist.append(Image.fromarray(im.astype(dt)))
+    # First pass to find the range of the whole stack
+    if auto_contrast == 'stack':
+        minVal = None
+        maxVal = None
+        for im in iter_images(get_images()):
+            maxVal = np.max(im) if maxVal is None else max(maxVal, np.max(im))
+            minVal = np.min(im) if minVal is None else min(minVal, np.min(im))
+        if fixed_min is not None:
+            minVal = fixed_min
+    
+    numImages = 0
+    with TiffImagePlugin.AppendingTiffWriter(filename, True) as tifWriter:
+        for im in iter_images(get_images()):
+            
+            if auto_contrast == 'image':
+                maxVal = np.max(np.abs(im))
+                if fixed_min is None:
+                    minVal = np.min(np.abs(im))
+                else:
+                    minVal = fixed_min
+                    
+            if auto_contrast is not None:
+                im = im.astype('float64') - minVal
+                intrange = maxVal - minVal
+                if intrange > 0:
+                    im = im / intrange * (2**bit_depth - 1)
+                else:
+                    im[:] = 2**bit_depth - 1
+                    
+            Image.fromarray(im.astype(dt)).save(tifWriter, format = "TIFF", compression = compression)
+            tifWriter.newFrame()
+            numImages = numImages + 1
+            
+    if numImages == 0:
+        os.remove(filename)
+        raise ValueError("There are no images to write.")
+            
+    return numImages
+    
+    
+def iter_images(images):
+    """ Generator which yields the 2D images from an iterable of images or 
+    chunks of images (chunk, y, x), or from a 3D array.
+    """
+    for im in images:
+        if np.ndim(im) == 3:
+            yield from im
+        else:
+            yield im
 
 
-    imlist[0].save(filename, compression="tiff_lzw", save_all=True,
-           append_images=imlist[1:])
+def load_chunked_info(folder):
+    """ Loads the metadata and per-frame information of a recording made
+    using ChunkedRecorder, without loading any images.
     
+    Arguments:
+        folder   : str or Path
+                   path to recording folder
+                   
+    Returns:
+        tuple of (dict, ndarray), the contents of metadata.json and a
+        structured array with fields frameNumber, timestamp, 
+        hardwareTimestamp and cameraID, one element per image
+    """
+    
+    with open(os.path.join(folder, 'metadata.json')) as metadataFile:
+        metadata = json.load(metadataFile)
+    
+    framesFilename = os.path.join(folder, 'frames.npy')
+    if os.path.exists(framesFilename):
+        frames = np.load(framesFilename)
+    else:
+        frames = None
+        
+    return metadata, frames
     
 
+def load_chunked_stack(folder, start = None, stop = None, startTime = None, endTime = None):
+    """ Loads a range of images from a recording made using ChunkedRecorder.
+    Only the chunks containing the requested images are read and 
+    decompressed. The range can be given either as image indices, or as
+    times, in which case images with timestamps >= startTime and < endTime
+    are returned.
+    
+    Arguments:
+        folder    : str or Path
+                    path to recording folder
+                    
+    Keyword Arguments:
+        start     : int or None
+                    index of first image (default is first image)
+        stop      : int or None
+                    index after last image (default is to the end)
+        startTime : float or None
+                    earliest timestamp to load, as recorded in the 
+                    FrameRecord (default is no limit)
+        endTime   : float or None
+                    timestamp to load up to (default is no limit)
+                    
+    Returns:
+        ndarray, images as numpy array (frame, y, x)
+    """
+    
+    metadata, frames = load_chunked_info(folder)
+    numFrames = metadata['numFrames']
+    chunkFrames = metadata['chunkFrames']
+    shape = tuple(metadata['shape'])
+    dtype = np.dtype(metadata['dtype'])
+    
+    start, stop, step = slice(start, stop).indices(numFrames)
+    
+    if startTime is not None or endTime is not None:
+        if frames is None:
+            raise Exception("Recording has no timestamps.")
+        timestamps = frames['timestamp']
+        inRange = np.ones(numFrames, dtype = bool)
+        if startTime is not None:
+            inRange &= timestamps >= startTime
+        if endTime is not None:
+            inRange &= timestamps < endTime
+        inRange[:start] = False
+        inRange[stop:] = False
+        selected = np.nonzero(inRange)[0]
+        if len(selected) > 0:
+            start, stop = selected[0], selected[-1] + 1
+        else:
+            start = stop = 0
+   
+    data = np.empty((max(stop - start, 0),) + shape, dtype = dtype)
+    
+    if stop > start:
+        for chunkIdx in range(start // chunkFrames, (stop - 1) // chunkFrames + 1):
+            chunkStart = chunkIdx * chunkFrames
+            chunkLength = min(chunkFrames, numFrames - chunkStart)
+            with open(os.path.join(folder, f"chunk_{chunkIdx:06d}"), 'rb') as chunkFile:
+                chunk = decompress(chunkFile.read(), dtype, (chunkLength,) + shape,
+                                   metadata['codec'], metadata['shuffle'])
+            first = max(start, chunkStart)
+            last = min(stop, chunkStart + chunkLength)
+            data[first - start:last - start] = chunk[first - chunkStart:last - chunkStart]
+            
+    return data
+    
 
 def log_scale_image(img, min_val = None):
     """ Generates a log-scaled image, adjusted for good visual appearance,
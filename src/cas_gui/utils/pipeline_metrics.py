@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+PipelineMetrics
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Records rolling statistics for each stage of the acquisition and processing
+pipeline, so that it is possible to see where time is spent and where frames
+are lost. For each stage, the duration of the most recent windowSize frames,
+the queue depth over time and the number of dropped frames are stored.
+
+The standard stages are:
+
+    grab    - time taken to obtain an image from the camera (including any
+              time waiting for the camera). Queue depth is not recorded.
+    queue   - time from acquisition until processing starts. Queue depth is
+              that of the raw image queue, drops are images removed from the
+              raw image queue because it was full.
+    process - processing time. Drops are images lost in processing, for
+              example skipped by the worker pool.
+    display - time taken to convert and display an image. Queue depth is
+              that of the processed image queue, drops are processed images
+              removed from the queue or overwritten in shared memory before
+              they could be displayed.
+    record  - time taken to write an image to a file. Queue depth is that
+              of the queue of images waiting to be recorded, drops are
+              images which could not be added to it.
+    output  - time from acquisition until the processed image is available,
+              i.e. the total latency. Drops are all frames lost anywhere in
+              the pipeline, found from gaps in the frame numbers.
+
+The ImageAcquisitionThread and ImageProcessorThread record times for the
+stages they handle when given a PipelineMetrics object (using the metrics
+keyword argument), the GUI records display and recording times. Other
+stages can be added by using any name.
+
+"""
+
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class StageMetrics:
+    """ Rolling statistics for a single stage of the pipeline.
+
+    Arguments:
+        name       : str
+                     name of stage
+
+    Keyword Arguments:
+        windowSize : int
+                     number of durations and queue depths to keep (default
+                     is 1000)
+    """
+
+    def __init__(self, name, windowSize = 1000):
+
+        self.name = name
+        self.windowSize = windowSize
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """ Clears all recorded values.
+        """
+        with self.lock:
+            self.times = deque(maxlen = self.windowSize)
+            self.queueDepths = deque(maxlen = self.windowSize)
+            self.numFrames = 0
+            self.numDropped = 0
+
+
+    def add_time(self, duration):
+        """ Records the time, in seconds, taken for a frame.
+        """
+        with self.lock:
+            self.times.append(duration)
+            self.numFrames = self.numFrames + 1
+
+
+    def add_drop(self, num = 1):
+        """ Records that num frames have been dropped.
+        """
+        with self.lock:
+            self.numDropped = self.numDropped + num
+
+
+    def add_queue_depth(self, depth):
+        """ Records the current depth of the queue feeding this stage.
+        """
+        with self.lock:
+            self.queueDepths.append((time.perf_counter(), depth))
+
+
+    def get_times(self):
+        """ Returns the recorded durations, in seconds, as a numpy array.
+        """
+        with self.lock:
+            return np.array(self.times)
+
+
+    def get_queue_depths(self):
+        """ Returns the recorded queue depths as a tuple of (times, depths),
+        where times are time.perf_counter() values.
+        """
+        with self.lock:
+            values = np.array(self.queueDepths).reshape(-1, 2)
+        return values[:,0], values[:,1].astype(int)
+
+
+    def get_histogram(self, bins = 20, range = None):
+        """ Returns a histogram of the recorded durations as a tuple of
+        (counts, bin edges), as for numpy.histogram.
+
+        Keyword Arguments:
+            bins  : int or sequence
+                    number of bins, or bin edges (default is 20 bins)
+            range : tuple or None
+                    (min, max) of bins in seconds, default is the range of
+                    the durations
+        """
+        return np.histogram(self.get_times(), bins = bins, range = range)
+
+
+    def get_summary(self):
+        """ Returns a dictionary of statistics: number of frames, number
+        dropped, mean, 50th, 90th and 99th percentile and max time (in
+        seconds), and current and max queue depth. Statistics which have
+        not been recorded are None.
+        """
+        times = self.get_times()
+        with self.lock:
+            depths = [depth for t, depth in self.queueDepths]
+            summary = {'numFrames': self.numFrames,
+                       'numDropped': self.numDropped}
+
+        if len(times) > 0:
+            p50, p90, p99 = np.percentile(times, (50, 90, 99))
+            summary.update({'mean': float(np.mean(times)), 'p50': float(p50),
+                            'p90': float(p90), 'p99': float(p99),
+                            'max': float(np.max(times))})
+        else:
+            summary.update({'mean': None, 'p50': None, 'p90': None,
+                            'p99': None, 'max': None})
+
+        if len(depths) > 0:
+            summary.update({'queueDepth': depths[-1], 'maxQueueDepth': max(depths)})
+        else:
+            summary.update({'queueDepth': None, 'maxQueueDepth': None})
+
+        return summary
+
+
+class PipelineMetrics:
+    """ Rolling statistics for all stages of the pipeline.
+
+    Keyword Arguments:
+        windowSize : int
+                     number of values to keep for each stage (default is 1000)
+    """
+
+    GRAB = 'grab'
+    QUEUE = 'queue'
+    PROCESS = 'process'
+    DISPLAY = 'display'
+    RECORD = 'record'
+    OUTPUT = 'output'
+
+    STAGES = (GRAB, QUEUE, PROCESS, DISPLAY, RECORD, OUTPUT)
+
+    def __init__(self, windowSize = 1000):
+
+        self.windowSize = windowSize
+        self.stages = {}
+        for stage in self.STAGES:
+            self.get_stage(stage)
+        self.lastFrameNumber = -1
+
+
+    def get_stage(self, stage):
+        """ Returns the StageMetrics for a stage, creating it if it does
+        not exist.
+        """
+        if stage not in self.stages:
+            self.stages[stage] = StageMetrics(stage, self.windowSize)
+        return self.stages[stage]
+
+
+    def add_time(self, stage, duration):
+        """ Records the time, in seconds, taken for a frame in a stage.
+        """
+        self.get_stage(stage).add_time(duration)
+
+
+    def add_drop(self, stage, num = 1):
+        """ Records that num frames have been dropped in a stage.
+        """
+        if num > 0:
+            self.get_stage(stage).add_drop(num)
+
+
+    def add_queue_depth(self, stage, depth):
+        """ Records the depth of the queue feeding a stage.
+        """
+        self.get_stage(stage).add_queue_depth(depth)
+
+
+    def timer(self, stage):
+        """ Returns a context manager which records the time taken by the
+        code within it for a stage, e.g.:
+
+            with metrics.timer('display'):
+                display.set_image(image)
+        """
+        return _StageTimer(self, stage)
+
+
+    def add_frame(self, frame, frameStep = 1):
+        """ Records the queue, processing and total times of a processed
+        frame from the stage times in its FrameRecord, and counts frames
+        dropped from gaps in the frame numbers.
+
+        Arguments:
+            frame     : FrameRecord
+                        record of processed frame
+
+        Keyword Arguments:
+            frameStep : int
+                        expected difference in frame numbers between
+                        consecutive frames, e.g. the batch size when
+                        processing batches (default is 1)
+        """
+        queueTime = frame.get_stage_time('acquired', 'processStart')
+        if queueTime is not None:
+            self.add_time(self.QUEUE, queueTime)
+
+        processTime = frame.get_stage_time('processStart', 'processEnd')
+        if processTime is not None:
+            self.add_time(self.PROCESS, processTime)
+
+        latency = frame.get_latency('output')
+        if latency is not None:
+            self.add_time(self.OUTPUT, latency)
+
+        # Frame numbers start again if the acquisition is restarted
+        if frame.frameNumber >= 0:
+            if self.lastFrameNumber >= 0 and frame.frameNumber > self.lastFrameNumber:
+                self.add_drop(self.OUTPUT, frame.frameNumber - self.lastFrameNumber - frameStep)
+            self.lastFrameNumber = frame.frameNumber
+
+
+    def get_summary(self):
+        """ Returns a dictionary of the summary statistics (see
+        StageMetrics.get_summary) for each stage.
+        """
+        return {name: stage.get_summary() for name, stage in list(self.stages.items())}
+
+
+    def format_summary(self):
+        """ Returns a summary of each stage as text, one line per stage,
+        giving the mean and 90th percentile time in ms, the number of frames
+        dropped and the current queue depth.
+        """
+        lines = []
+        for name, summary in self.get_summary().items():
+            if summary['mean'] is not None:
+                times = f"{1000 * summary['mean']:6.1f} {1000 * summary['p90']:6.1f} ms"
+            else:
+                times = f"{'-':>6} {'-':>6} ms"
+            depth = summary['queueDepth'] if summary['queueDepth'] is not None else '-'
+            lines.append(f"{name:<8}{times}  dropped {summary['numDropped']:<5} queue {depth}")
+        return "\n".join(lines)
+
+
+    def reset(self):
+        """ Clears the statistics of all stages.
+        """
+        for stage in list(self.stages.values()):
+            stage.reset()
+        self.lastFrameNumber = -1
+
+
+class _StageTimer:
+    """ Context manager returned by PipelineMetrics.timer().
+    """
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.startTime)
+        return False
@@ -0,0 +1,812 @@
+# -*- coding: utf-8 -*-
+"""
+Recorders
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Classes for writing sequences of images to file. Each recorder is created
+with a filename, and the file is opened when the first image is written (or
+when open() is called), so that its size and type can be taken from the
+image. Images are written using write() and the file is finished using 
+close(). write_frame() accepts either an image or a FrameRecord.
+
+    TifRecorder       - multi-page TIF. 8 and 16 bit images are written 
+                        unchanged, other types are scaled to 16 bit.
+    VideoRecorder     - video file written using OpenCV. By default this is
+                        MJPEG for .avi files, in which case images are 
+                        scaled to 8 bit, or FFV1 for .mkv files, which is
+                        lossless and writes 8 and 16 bit monochrome images
+                        without converting them.
+    RawStreamRecorder - raw stream. Images are written unchanged, with an
+                        index file storing the position, shape and 
+                        timestamps of each image. This is much faster to
+                        write than the other formats and so can sustain
+                        recording at high frame rates. Read the file using
+                        RawStreamReader.
+    ChunkedRecorder   - folder of losslessly compressed blocks of images,
+                        compressed in parallel, with metadata. Read using
+                        load_chunked_stack in im_tools.
+
+create_recorder() returns a recorder of the appropriate type for the file
+extension.
+
+TifRecorder, RawStreamRecorder and ChunkedRecorder are resumable. For these,
+checkpoint() makes sure the images written so far are in the file and 
+returns a dictionary describing the file at that point. If writing is
+interrupted, for example because the program failed, a new recorder for the
+same file can continue from the checkpoint using resume(), discarding any
+images written after it. This is used by BatchEngine to resume processing of
+a file.
+
+Raw stream files (extension .raw) consist of a 64 byte header followed by the
+images, one after another, in their native dtype and C order. The header 
+stores the dtype and shape of the first image. The file is extended in large
+blocks as it is written, and trimmed to the size of the images when closed.
+The index file (the same filename with .idx appended) consists of a 64 byte
+header, storing the number of images, followed by one record per image (see
+RawStreamRecorder.indexDtype). Both headers start with an 8 byte identifier.
+If all the images have the same shape, which is usually the case, the images
+can be opened directly using:
+
+    frames = np.memmap(filename, dtype, mode = 'r', offset = 64, 
+                       shape = (numFrames,) + shape)
+                       
+which is what RawStreamReader does.
+
+"""
+
+import os
+import json
+import struct
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, TiffImagePlugin
+import cv2 as cv
+
+from cas_gui.utils.im_tools import to8bit, to16bit, load_chunked_info
+from cas_gui.utils.compression import compress
+from cas_gui.threads.frame_record import FrameRecord, as_image
+
+
+class Recorder:
+    """ Base class for recorders. Sub-classes implement open_file,
+    write_image and close_file.
+
+    Arguments:
+        filename : str or Path
+                   path to file to write to, folder must exist
+    """
+
+    extensions = ()
+    resumable = False
+
+    def __init__(self, filename):
+
+        self.filename = str(filename)
+        self.numFramesRecorded = 0
+        self.isOpen = False
+
+
+    def open(self, exampleImage):
+        """ Opens the file, using exampleImage to determine the image size
+        and type, if it is not already open. This is called by write() for
+        the first image, but can be called beforehand to check that the
+        file can be created.
+        """
+        if not self.isOpen:
+            self.open_file(exampleImage)
+            self.isOpen = True
+
+
+    def write(self, image):
+        """ Writes an image to the file, opening the file if this is the
+        first image.
+        """
+        self.open(image)
+        self.write_image(image)
+        self.numFramesRecorded = self.numFramesRecorded + 1
+
+
+    def write_frame(self, frame):
+        """ Writes the image of a FrameRecord (or an image) to the file.
+        """
+        self.write(as_image(frame))
+
+
+    def close(self):
+        """ Finishes writing the file.
+        """
+        if self.isOpen:
+            self.close_file()
+            self.isOpen = False
+            
+            
+    def checkpoint(self):
+        """ Makes sure that the images written so far are in the file and 
+        returns a dictionary, which can be saved as JSON, describing the file
+        at this point. 'numFrames' is the number of images which will be kept
+        if the recording is resumed from the checkpoint. Only supported if
+        resumable is True.
+        """
+        if not self.resumable:
+            raise NotImplementedError(f"{type(self).__name__} cannot be resumed.")
+        if not self.isOpen:
+            return {'numFrames': 0}
+        return self.checkpoint_file()
+    
+    
+    def resume(self, checkpoint):
+        """ Re-opens a file which was being written when checkpoint() 
+        returned checkpoint, discarding any images written since, so that 
+        further images are added after those in the checkpoint. Only 
+        supported if resumable is True.
+        """
+        if not self.resumable:
+            raise NotImplementedError(f"{type(self).__name__} cannot be resumed.")
+        if checkpoint['numFrames'] > 0:
+            self.resume_file(checkpoint)
+            self.isOpen = True
+        self.numFramesRecorded = checkpoint['numFrames']
+
+
+    def open_file(self, exampleImage):
+        pass
+
+
+    def write_image(self, image):
+        pass
+
+
+    def close_file(self):
+        pass
+    
+    
+    def checkpoint_file(self):
+        pass
+    
+    
+    def resume_file(self, checkpoint):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+class TifRecorder(Recorder):
+    """ Records images to a multi-page TIF file.
+    """
+
+    extensions = ('.tif', '.tiff')
+    resumable = True
+
+    def open_file(self, exampleImage):
+        self.tifWriter = TiffImagePlugin.AppendingTiffWriter(self.filename, True)
+
+
+    def write_image(self, image):
+        if image.dtype != np.uint8 and image.dtype != np.uint16:
+            image = to16bit(image)
+        Image.fromarray(image).save(self.tifWriter)
+        self.tifWriter.newFrame()
+
+
+    def close_file(self):
+        self.tifWriter.close()
+        
+        
+    def checkpoint_file(self):
+        # After each image, the end of the file and the link to the next
+        # page, which is written when the next image is finished, are known
+        self.tifWriter.f.flush()
+        return {'numFrames': self.numFramesRecorded,
+                'fileSize': self.tifWriter.offsetOfNewPage,
+                'nextPageLink': self.tifWriter.whereToWriteNewIFDOffset}
+    
+    
+    def resume_file(self, checkpoint):
+        with open(self.filename, 'r+b') as tifFile:
+            tifFile.truncate(checkpoint['fileSize'])
+            header = tifFile.read(4)
+            byteOrder = '<' if header[:2] == b'II' else '>'
+            linkFormat = 'Q' if 43 in header[2:4] else 'I'
+            tifFile.seek(checkpoint['nextPageLink'])
+            tifFile.write(struct.pack(byteOrder + linkFormat, 0))
+        self.tifWriter = TiffImagePlugin.AppendingTiffWriter(self.filename, False)
+
+
+class VideoRecorder(Recorder):
+    """ Records images to a video file using OpenCV. 
+    
+    With a lossless codec (FFV1), monochrome 8 and 16 bit images are written 
+    as single channel frames without any conversion, and other monochrome 
+    images are scaled to 16 bit. Colour images, and all images when using 
+    other codecs, are scaled to 8 bit colour frames.
+
+    Arguments:
+        filename   : str or Path
+                     path to file to write to, folder must exist
+
+    Keyword Arguments:
+        frameRate  : float
+                     frame rate of video file in Hz (default is 20)
+        codec      : str or None
+                     four character code of codec, e.g. 'MJPG' or 'FFV1'.
+                     Default is FFV1 for .mkv files, otherwise MJPG
+        numThreads : int
+                     number of threads to use for encoding, 0 (default) 
+                     lets the encoder choose
+    """
+
+    extensions = ('.avi', '.mkv')
+    losslessCodecs = ('FFV1',)
+
+    def __init__(self, filename, frameRate = 20.0, codec = None, numThreads = 0):
+
+        super().__init__(filename)
+        self.frameRate = frameRate
+        if codec is None:
+            codec = 'FFV1' if self.filename.lower().endswith('.mkv') else 'MJPG'
+        self.codec = codec
+        self.numThreads = numThreads
+
+
+    def open_file(self, exampleImage):
+        
+        fourcc = cv.VideoWriter_fourcc(*self.codec)
+        imSize = (np.shape(exampleImage)[1], np.shape(exampleImage)[0])
+        
+        self.writeNative = self.codec in self.losslessCodecs and np.ndim(exampleImage) == 2
+        if self.writeNative:
+            self.depth = cv.CV_8U if exampleImage.dtype == np.uint8 else cv.CV_16U
+            params = [cv.VIDEOWRITER_PROP_DEPTH, self.depth, cv.VIDEOWRITER_PROP_IS_COLOR, 0]
+        else:
+            params = [cv.VIDEOWRITER_PROP_IS_COLOR, 1]
+            
+        # The FFMPEG backend takes encoder options from this environment 
+        # variable when the file is opened
+        optionsVar = 'OPENCV_FFMPEG_WRITER_OPTIONS'
+        oldOptions = os.environ.get(optionsVar)
+        if self.numThreads > 0:
+            os.environ[optionsVar] = f"threads;{self.numThreads}"
+        try:
+            self.videoOut = cv.VideoWriter(self.filename, cv.CAP_FFMPEG, fourcc, self.frameRate, imSize, params)
+        finally:
+            if self.numThreads > 0:
+                if oldOptions is None:
+                    del os.environ[optionsVar]
+                else:
+                    os.environ[optionsVar] = oldOptions
+                
+        if not self.videoOut.isOpened():
+            raise IOError(f"Unable to create video file {self.filename}.")
+
+
+    def write_image(self, image):
+        if self.writeNative:
+            if self.depth == cv.CV_8U:
+                image = image if image.dtype == np.uint8 else to8bit(image)
+            else:
+                image = image if image.dtype == np.uint16 else to16bit(image)
+            self.videoOut.write(image)
+        else:
+            self.videoOut.write(to_video_frame(image))
+
+
+    def close_file(self):
+        self.videoOut.release()
+
+
+class RawStreamRecorder(Recorder):
+    """ Records images unchanged to a raw stream file, with an index file.
+    Images may change shape, but must all have the same dtype.
+    
+    Arguments:
+        filename       : str or Path
+                         path to file to write to, folder must exist
+                    
+    Keyword Arguments:
+        allocateFrames : int
+                         the file is extended by enough space for this many
+                         images at a time (default is 256)
+    """
+    
+    extensions = ('.raw',)
+    resumable = True
+
+    headerBytes = 64
+    fileId = b'CASRAW01'
+    indexId = b'CASIDX01'
+    headerDtype = np.dtype([('id', 'S8'),
+                            ('dtype', 'S8'),
+                            ('ndim', '<i8'),
+                            ('shape', '<i8', (4,))])
+    indexDtype = np.dtype([('offset', '<i8'),
+                           ('frameNumber', '<i8'),
+                           ('timestamp', '<f8'),
+                           ('hardwareTimestamp', '<f8'),
+                           ('cameraID', '<i8'),
+                           ('ndim', '<i8'),
+                           ('shape', '<i8', (4,))])
+    maxDims = 4
+    
+    def __init__(self, filename, allocateFrames = 256):
+        
+        super().__init__(filename)
+        self.indexFilename = index_filename(self.filename)
+        self.allocateFrames = allocateFrames
+        self.currentRecord = None
+        
+        
+    def open_file(self, exampleImage):
+        
+        exampleImage = np.asarray(exampleImage)
+        if exampleImage.ndim > self.maxDims:
+            raise ValueError(f"Images can have at most {self.maxDims} dimensions.")
+        self.dtype = exampleImage.dtype
+        
+        header = np.zeros(1, dtype = self.headerDtype)
+        header['id'] = self.fileId
+        header['dtype'] = self.dtype.str.encode()
+        header['ndim'] = exampleImage.ndim
+        header['shape'][0, :exampleImage.ndim] = exampleImage.shape
+        
+        self.file = open(self.filename, 'wb')
+        self.file.write(header.tobytes().ljust(self.headerBytes, b'\0'))
+        self.dataEnd = self.headerBytes
+        self.allocatedBytes = self.headerBytes
+        self.allocate(self.allocateFrames * exampleImage.nbytes)
+        
+        with open(self.indexFilename, 'wb') as indexFile:
+            indexFile.write(self.indexId.ljust(self.headerBytes, b'\0'))
+        self.indexCapacity = 0
+        self.numIndexed = 0
+        self.resize_index(self.allocateFrames)
+        
+    
+    def allocate(self, numBytes):
+        """ Extends the data file by numBytes bytes. Where possible the space
+        is allocated on the disk now, rather than as the images are written.
+        """
+        self.file.flush()
+        newSize = self.allocatedBytes + numBytes
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.file.fileno(), self.allocatedBytes, numBytes)
+            except OSError:
+                self.file.truncate(newSize)
+        else:
+            self.file.truncate(newSize)
+        self.allocatedBytes = newSize
+    
+    
+    def resize_index(self, capacity):
+        """ Resizes the index file to hold capacity records and maps it.
+        """
+        if self.indexCapacity > 0:
+            self.index.flush()
+            del self.index
+        with open(self.indexFilename, 'r+b') as indexFile:
+            indexFile.truncate(self.headerBytes + capacity * self.indexDtype.itemsize)
+        self.indexHeader = np.memmap(self.indexFilename, dtype = '<i8', mode = 'r+', shape = (self.headerBytes // 8,))
+        self.index = np.memmap(self.indexFilename, dtype = self.indexDtype, mode = 'r+',
+                               offset = self.headerBytes, shape = (capacity,))
+        self.indexCapacity = capacity
+        
+        
+    def write_frame(self, frame):
+        """ Writes an image or FrameRecord to the file. For a FrameRecord
+        the frame number, timestamps and camera ID are stored in the index.
+        """
+        self.currentRecord = frame if isinstance(frame, FrameRecord) else None
+        super().write_frame(frame)
+        
+        
+    def write_image(self, image):
+
+        image = np.ascontiguousarray(image)
+        if image.dtype != self.dtype:
+            raise ValueError(f"Image dtype {image.dtype} does not match dtype of recording {self.dtype}.")
+        if image.ndim > self.maxDims:
+            raise ValueError(f"Images can have at most {self.maxDims} dimensions.")
+        
+        if self.dataEnd + image.nbytes > self.allocatedBytes:
+            self.allocate(max(self.allocateFrames * image.nbytes, self.dataEnd + image.nbytes - self.allocatedBytes))
+        if self.numIndexed == self.indexCapacity:
+            self.resize_index(2 * self.indexCapacity)
+            
+        self.file.write(image.data)
+        
+        entry = self.index[self.numIndexed]
+        entry['offset'] = self.dataEnd
+        entry['ndim'] = image.ndim
+        entry['shape'][:] = 0
+        entry['shape'][:image.ndim] = image.shape
+        record = self.currentRecord
+        if record is not None:
+            entry['frameNumber'] = record.frameNumber
+            entry['timestamp'] = record.timestamp
+            entry['hardwareTimestamp'] = np.nan if record.hardwareTimestamp is None else record.hardwareTimestamp
+            entry['cameraID'] = record.cameraID
+        else:
+            entry['frameNumber'] = self.numIndexed
+            entry['timestamp'] = np.nan
+            entry['hardwareTimestamp'] = np.nan
+            entry['cameraID'] = 0
+            
+        self.dataEnd = self.dataEnd + image.nbytes
+        self.numIndexed = self.numIndexed + 1
+        
+        # Storing the count last means that a reader never sees an 
+        # incomplete entry
+        self.indexHeader[1] = self.numIndexed
+        
+    
+    def close_file(self):
+        
+        self.file.flush()
+        self.file.truncate(self.dataEnd)
+        self.file.close()
+        
+        self.index.flush()
+        self.indexHeader.flush()
+        del self.index, self.indexHeader
+        with open(self.indexFilename, 'r+b') as indexFile:
+            indexFile.truncate(self.headerBytes + self.numIndexed * self.indexDtype.itemsize)
+            
+            
+    def checkpoint_file(self):
+        
+        self.file.flush()
+        self.index.flush()
+        self.indexHeader.flush()
+        return {'numFrames': self.numIndexed, 'dataEnd': self.dataEnd}
+    
+    
+    def resume_file(self, checkpoint):
+        
+        header = np.fromfile(self.filename, dtype = self.headerDtype, count = 1)
+        if len(header) == 0 or header['id'][0] != self.fileId:
+            raise ValueError(f"{self.filename} is not a raw stream file.")
+        self.dtype = np.dtype(header['dtype'][0].decode())
+        
+        self.file = open(self.filename, 'r+b')
+        self.dataEnd = checkpoint['dataEnd']
+        self.file.truncate(self.dataEnd)
+        self.file.seek(self.dataEnd)
+        self.allocatedBytes = self.dataEnd
+        
+        self.indexCapacity = 0
+        self.numIndexed = checkpoint['numFrames']
+        self.resize_index(max(self.allocateFrames, 2 * self.numIndexed))
+        self.indexHeader[1] = self.numIndexed
+            
+            
+class RawStreamReader:
+    """ Reads a file written by RawStreamRecorder. Images are not loaded
+    until they are accessed. 
+    
+    Individual images are obtained using indexing, e.g. reader[10], and are
+    read-only views of the file. If all the images are the same shape, 
+    frames is a read-only memory-mapped array of all the images, of shape 
+    (numFrames,) + image shape, otherwise it is None. index is a 
+    memory-mapped structured array of the index records, with fields offset,
+    frameNumber, timestamp, hardwareTimestamp (NaN if not known), cameraID,
+    ndim and shape.
+    
+    Arguments:
+        filename : str or Path
+                   path to raw stream file
+    """
+    
+    def __init__(self, filename):
+        
+        self.filename = str(filename)
+        headerBytes = RawStreamRecorder.headerBytes
+        
+        header = np.fromfile(self.filename, dtype = RawStreamRecorder.headerDtype, count = 1)
+        if len(header) == 0 or header['id'][0] != RawStreamRecorder.fileId:
+            raise ValueError(f"{self.filename} is not a raw stream file.")
+        self.dtype = np.dtype(header['dtype'][0].decode())
+        
+        indexHeader = np.fromfile(index_filename(self.filename), dtype = '<i8', count = 2)
+        if len(indexHeader) < 2 or indexHeader[:1].tobytes() != RawStreamRecorder.indexId:
+            raise ValueError(f"{index_filename(self.filename)} is not a raw stream index file.")
+        self.numFrames = int(indexHeader[1])
+        
+        self.data = np.memmap(self.filename, dtype = np.uint8, mode = 'r')
+        if self.numFrames > 0:
+            self.index = np.memmap(index_filename(self.filename), dtype = RawStreamRecorder.indexDtype, 
+                                   mode = 'r', offset = headerBytes, shape = (self.numFrames,))
+        else:
+            self.index = np.zeros(0, dtype = RawStreamRecorder.indexDtype)
+        
+        self.frames = None
+        if self.numFrames > 0 and np.all(self.index['shape'] == self.index['shape'][0]) and np.all(self.index['ndim'] == self.index['ndim'][0]):
+            shape = tuple(self.index['shape'][0][:self.index['ndim'][0]])
+            self.frames = np.memmap(self.filename, dtype = self.dtype, mode = 'r', offset = headerBytes,
+                                    shape = (self.numFrames,) + shape)
+            
+            
+    def __len__(self):
+        return self.numFrames
+    
+    
+    def __getitem__(self, idx):
+        """ Returns image number idx.
+        """
+        if self.frames is not None:
+            return self.frames[idx]
+        entry = self.index[idx]
+        shape = tuple(entry['shape'][:entry['ndim']])
+        numBytes = int(np.prod(shape)) * self.dtype.itemsize
+        return self.data[entry['offset']: entry['offset'] + numBytes].view(self.dtype).reshape(shape)
+    
+    
+    def get_frame(self, idx):
+        """ Returns a FrameRecord for image number idx, with the metadata 
+        from the index.
+        """
+        entry = self.index[idx]
+        hardwareTimestamp = float(entry['hardwareTimestamp'])
+        return FrameRecord(self[idx], int(entry['frameNumber']), float(entry['timestamp']),
+                           None if np.isnan(hardwareTimestamp) else hardwareTimestamp,
+                           int(entry['cameraID']))
+    
+    
+    def get_timestamps(self):
+        """ Returns the acquisition timestamps of all the images.
+        """
+        return np.array(self.index['timestamp'])
+    
+    
+class ChunkedRecorder(Recorder):
+    """ Records images to a folder as a chunked, compressed array. Images
+    are collected into chunks of chunkFrames images, and each chunk is
+    compressed and written to a separate file by a pool of threads. All
+    images must have the same shape and dtype.
+    
+    The folder contains:
+        
+        metadata.json     - shape and dtype of the images, number of images,
+                            chunk size, compression settings, the time the
+                            recording started and the metadata passed when
+                            creating the recorder (e.g. camera and processor
+                            settings)
+        frames.npy        - structured array with the frameNumber, timestamp,
+                            hardwareTimestamp (NaN if not known) and cameraID 
+                            of each image
+        chunk_000000 etc. - compressed chunks (see utils.compression)
+        
+    The recording can be read, in whole or in part, using 
+    load_chunked_stack in im_tools.
+    
+    Arguments:
+        filename    : str or Path
+                      path to folder to record to, this is created if it
+                      does not exist
+                    
+    Keyword Arguments:
+        chunkFrames : int
+                      number of images per chunk (default is 32)
+        codec       : str
+                      compression codec, see utils.compression (default is
+                      'zlib')
+        level       : int
+                      compression level (default is 1, fastest)
+        shuffle     : boolean
+                      if True (default), bytes are shuffled before 
+                      compressing, which helps for 16 bit images
+        numThreads  : int
+                      number of compression threads, 0 (default) for one per
+                      CPU
+        metadata    : dict or None
+                      additional metadata to store, must be JSON serialisable
+                      (other values are stored as strings)
+    """
+    
+    extensions = ('.chunks',)
+    resumable = True
+    metadataFilename = 'metadata.json'
+    framesFilename = 'frames.npy'
+    frameDtype = np.dtype([('frameNumber', '<i8'),
+                           ('timestamp', '<f8'),
+                           ('hardwareTimestamp', '<f8'),
+                           ('cameraID', '<i8')])
+    
+    def __init__(self, filename, chunkFrames = 32, codec = 'zlib', level = 1, shuffle = True, 
+                 numThreads = 0, metadata = None):
+        
+        super().__init__(filename)
+        self.chunkFrames = chunkFrames
+        self.codec = codec
+        self.level = level
+        self.shuffle = shuffle
+        self.numThreads = numThreads if numThreads > 0 else (os.cpu_count() or 1)
+        self.metadata = metadata if metadata is not None else {}
+        self.currentRecord = None
+        
+        
+    def open_file(self, exampleImage):
+        
+        exampleImage = np.asarray(exampleImage)
+        os.makedirs(self.filename, exist_ok = True)
+        self.shape = exampleImage.shape
+        self.dtype = exampleImage.dtype
+        self.startTime = datetime.now().isoformat()
+        
+        self.chunk = np.empty((self.chunkFrames,) + self.shape, dtype = self.dtype)
+        self.numInChunk = 0
+        self.numChunks = 0
+        self.compressedBytes = 0
+        self.frames = []
+        
+        self.executor = ThreadPoolExecutor(max_workers = self.numThreads)
+        self.pending = deque()
+        
+        # Check now that the metadata can be written
+        self.write_metadata()
+        
+    
+    def write_frame(self, frame):
+        """ Writes an image or FrameRecord to the file. For a FrameRecord
+        the frame number, timestamps and camera ID are stored.
+        """
+        self.currentRecord = frame if isinstance(frame, FrameRecord) else None
+        super().write_frame(frame)
+        
+        
+    def write_image(self, image):
+        
+        if np.shape(image) != self.shape or image.dtype != self.dtype:
+            raise ValueError(f"Image of shape {np.shape(image)} and type {image.dtype} does not match recording of shape {self.shape} and type {self.dtype}.")
+            
+        self.chunk[self.numInChunk] = image
+        self.numInChunk = self.numInChunk + 1
+        
+        record = self.currentRecord
+        if record is not None:
+            self.frames.append((record.frameNumber, record.timestamp,
+                                np.nan if record.hardwareTimestamp is None else record.hardwareTimestamp,
+                                record.cameraID))
+        else:
+            self.frames.append((len(self.frames), np.nan, np.nan, 0))
+        
+        if self.numInChunk == self.chunkFrames:
+            self.submit_chunk()
+            
+            
+    def submit_chunk(self):
+        """ Passes the current chunk to the thread pool to be compressed and
+        written, and starts a new chunk.
+        """
+        if self.numInChunk == 0:
+            return
+        
+        # If compression is not keeping up, wait for the oldest chunk rather
+        # than using more and more memory
+        while len(self.pending) >= 2 * self.numThreads:
+            self.compressedBytes = self.compressedBytes + self.pending.popleft().result()
+        
+        self.pending.append(self.executor.submit(self.write_chunk, self.numChunks, self.chunk[:self.numInChunk]))
+        self.numChunks = self.numChunks + 1
+        self.chunk = np.empty((self.chunkFrames,) + self.shape, dtype = self.dtype)
+        self.numInChunk = 0
+        
+        
+    def write_chunk(self, chunkIdx, data):
+        """ Compresses a chunk and writes it to file. Called by the thread
+        pool. Returns the number of bytes written.
+        """
+        compressed = compress(data, self.codec, self.level, self.shuffle)
+        with open(chunk_filename(self.filename, chunkIdx), 'wb') as chunkFile:
+            chunkFile.write(compressed)
+        return len(compressed)
+    
+    
+    def write_metadata(self, numFrames = None):
+        """ Writes metadata.json. numFrames is the number of images stored,
+        default is all the images written.
+        """
+        metadata = {'shape': list(self.shape), 
+                    'dtype': self.dtype.str,
+                    'numFrames': len(self.frames) if numFrames is None else numFrames,
+                    'chunkFrames': self.chunkFrames,
+                    'numChunks': self.numChunks,
+                    'codec': self.codec,
+                    'level': self.level,
+                    'shuffle': self.shuffle,
+                    'compressedBytes': self.compressedBytes,
+                    'startTime': self.startTime,
+                    'metadata': self.metadata}
+        with open(os.path.join(self.filename, self.metadataFilename), 'w') as metadataFile:
+            json.dump(metadata, metadataFile, indent = 2, default = str)
+        
+        
+    def close_file(self):
+        
+        self.submit_chunk()
+        while self.pending:
+            self.compressedBytes = self.compressedBytes + self.pending.popleft().result()
+        self.executor.shutdown()
+        
+        np.save(os.path.join(self.filename, self.framesFilename), np.array(self.frames, dtype = self.frameDtype))
+        self.write_metadata()
+        
+        
+    def checkpoint_file(self):
+        
+        # Only images in complete chunks are kept, so that the recording can 
+        # be read up to the checkpoint
+        while self.pending:
+            self.compressedBytes = self.compressedBytes + self.pending.popleft().result()
+        numFrames = self.numChunks * self.chunkFrames
+        np.save(os.path.join(self.filename, self.framesFilename), np.array(self.frames[:numFrames], dtype = self.frameDtype))
+        self.write_metadata(numFrames)
+        return {'numFrames': numFrames, 'compressedBytes': self.compressedBytes}
+    
+    
+    def resume_file(self, checkpoint):
+        
+        metadata, frames = load_chunked_info(self.filename)
+        numFrames = checkpoint['numFrames']
+        self.shape = tuple(metadata['shape'])
+        self.dtype = np.dtype(metadata['dtype'])
+        self.chunkFrames = metadata['chunkFrames']
+        self.codec = metadata['codec']
+        self.level = metadata['level']
+        self.shuffle = metadata['shuffle']
+        self.startTime = metadata['startTime']
+        
+        self.chunk = np.empty((self.chunkFrames,) + self.shape, dtype = self.dtype)
+        self.numInChunk = 0
+        self.numChunks = numFrames // self.chunkFrames
+        self.compressedBytes = checkpoint['compressedBytes']
+        self.frames = frames[:numFrames].tolist()
+        
+        self.executor = ThreadPoolExecutor(max_workers = self.numThreads)
+        self.pending = deque()
+        
+        
+def chunk_filename(folder, chunkIdx):
+    """ Returns the name of the file for a chunk of a ChunkedRecorder
+    recording.
+    """
+    return os.path.join(str(folder), f"chunk_{chunkIdx:06d}")
+
+
+def index_filename(filename):
+    """ Returns the name of the index file for a raw stream file.
+    """
+    return str(filename) + '.idx'
+
+
+def to_video_frame(image):
+    """ Converts an image to a 3 channel 8 bit frame that can be recorded
+    using an OpenCV video writer.
+    """
+    if image.dtype != np.uint8:
+        image = to8bit(image)
+    if image.ndim == 3:
+        return image
+    else:
+        return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+
+
+def create_recorder(filename, **kwargs):
+    """ Returns a recorder for filename, with the type determined by the
+    file extension. Keyword arguments are passed to the recorder.
+    """
+    extension = os.path.splitext(str(filename))[1].lower()
+    for recorderClass in (TifRecorder, VideoRecorder, RawStreamRecorder, ChunkedRecorder):
+        if extension in recorderClass.extensions:
+            return recorderClass(filename, **kwargs)
+    raise ValueError(f"No recorder for files of type '{extension}'.")
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+TiffPageIndex
+
+Part of Kent CAS-GUI: Camera Acquisition System GUI
+
+Memory-mapped access to the pages of multi-page TIFF files, used by
+FileInterface so that any page of a large file can be obtained without
+decoding it or reading the rest of the file.
+
+When the file is opened, the chain of image file directories (IFDs) is read
+once to build an index of the offset, shape and dtype of the image data of
+each page. Classic and BigTIFF files of either byte order are supported. A
+page can be memory-mapped if it is uncompressed, stored in strips (not
+tiles) which are contiguous in the file, and is grayscale or RGB with 8, 16,
+32 or 64 bit samples. This is the case for TIFF files written by PIL, and
+so for recordings made by TifRecorder. Opening a file raises ValueError if
+it is not a TIFF file, and isMappable is False if any page cannot be
+memory-mapped, in which case the file should be read with PIL instead.
+
+get_page() returns a read-only numpy array which is a view of the file, so
+no data is read until the array is used. If all pages have the same shape
+and dtype and are equally spaced in the file, which is usually the case,
+get_stack() returns a single array of shape (numPages, h, w) viewing the
+whole file, otherwise the pages are copied into a new array.
+
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+
+# Tags used
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+# struct format of each TIFF field type which can hold integer values
+FIELD_FORMATS = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 13: 'I', 16: 'Q', 17: 'q', 18: 'Q'}
+FIELD_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class TiffPageIndex:
+    """ Index of the pages of a TIFF file, allowing them to be memory-mapped.
+
+    Arguments:
+        filename : str
+                   path to TIFF file
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError(f"{filename} is empty.")
+
+        try:
+            self.read_index()
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise ValueError(f"{filename} is not a valid TIFF file: {e}")
+
+
+    def read_index(self):
+        """ Reads the IFD of each page and builds the index.
+        """
+
+        byteOrder = bytes(self.map[0:2])
+        if byteOrder == b'II':
+            self.byteOrder = '<'
+        elif byteOrder == b'MM':
+            self.byteOrder = '>'
+        else:
+            raise ValueError("byte order not recognised")
+
+        version = self.unpack('H', 2)
+        if version == 42:
+            self.bigTiff = False
+            ifdOffset = self.unpack('I', 4)
+        elif version == 43:
+            self.bigTiff = True
+            ifdOffset = self.unpack('Q', 8)
+        else:
+            raise ValueError("version not recognised")
+
+        self.offsets = []
+        self.shapes = []
+        self.dtypes = []
+        self.isMappable = True
+        visited = set()
+
+        while ifdOffset != 0 and ifdOffset not in visited:
+            visited.add(ifdOffset)
+            tags, ifdOffset = self.read_ifd(ifdOffset)
+            offset, shape, dtype = self.page_layout(tags)
+            if offset is None:
+                self.isMappable = False
+            self.offsets.append(offset)
+            self.shapes.append(shape)
+            self.dtypes.append(dtype)
+
+        self.numPages = len(self.offsets)
+        if self.numPages == 0:
+            raise ValueError("no pages")
+
+        self.stack = None
+        if self.isMappable:
+            self.stack = self.map_stack()
+
+
+    def unpack(self, fmt, offset):
+        """ Returns a single value of struct format fmt from offset.
+        """
+        return struct.unpack_from(self.byteOrder + fmt, self.map, offset)[0]
+
+
+    def read_ifd(self, ifdOffset):
+        """ Reads the IFD at ifdOffset, returns a tuple of a dictionary of
+        the integer-valued tags, each as a tuple of values, and the offset
+        of the next IFD.
+        """
+
+        if self.bigTiff:
+            numEntries = self.unpack('Q', ifdOffset)
+            entryStart, entrySize, countFormat, inlineSize, offsetFormat = ifdOffset + 8, 20, 'Q', 8, 'Q'
+        else:
+            numEntries = self.unpack('H', ifdOffset)
+            entryStart, entrySize, countFormat, inlineSize, offsetFormat = ifdOffset + 2, 12, 'I', 4, 'I'
+
+        tags = {}
+        for idx in range(numEntries):
+            entry = entryStart + idx * entrySize
+            tag = self.unpack('H', entry)
+            fieldType = self.unpack('H', entry + 2)
+            count = self.unpack(countFormat, entry + 4)
+            if fieldType not in FIELD_FORMATS:
+                continue
+            valueOffset = entry + 4 + inlineSize
+            if count * FIELD_SIZES[fieldType] > inlineSize:
+                valueOffset = self.unpack(offsetFormat, valueOffset)
+            tags[tag] = struct.unpack_from(f"{self.byteOrder}{count}{FIELD_FORMATS[fieldType]}", self.map, valueOffset)
+
+        nextOffset = self.unpack(offsetFormat, entryStart + numEntries * entrySize)
+        return tags, nextOffset
+
+
+    def page_layout(self, tags):
+        """ Returns a tuple of the offset, shape and dtype of the image data
+        of a page from its tags, with an offset of None if the page cannot
+        be memory-mapped.
+        """
+
+        width = tags.get(IMAGE_WIDTH, (0,))[0]
+        height = tags.get(IMAGE_LENGTH, (0,))[0]
+        samplesPerPixel = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+        bits = tags.get(BITS_PER_SAMPLE, (1,))
+        sampleFormat = tags.get(SAMPLE_FORMAT, (1,))[0]
+        shape = (height, width) if samplesPerPixel == 1 else (height, width, samplesPerPixel)
+
+        if (tags.get(COMPRESSION, (1,))[0] != 1 or TILE_WIDTH in tags
+                or STRIP_OFFSETS not in tags or STRIP_BYTE_COUNTS not in tags
+                or tags.get(PHOTOMETRIC, (1,))[0] not in (1, 2)
+                or (samplesPerPixel > 1 and tags.get(PLANAR_CONFIGURATION, (1,))[0] != 1)
+                or len(set(bits)) != 1 or bits[0] not in (8, 16, 32, 64)
+                or sampleFormat not in SAMPLE_KINDS):
+            return None, shape, None
+
+        dtype = np.dtype(f"{self.byteOrder}{SAMPLE_KINDS[sampleFormat]}{bits[0] // 8}")
+        if dtype.kind == 'f' and dtype.itemsize < 4:
+            return None, shape, None
+
+        # Strips must follow each other so the image is one block of memory
+        offsets = tags[STRIP_OFFSETS]
+        counts = tags[STRIP_BYTE_COUNTS]
+        for idx in range(1, len(offsets)):
+            if offsets[idx] != offsets[idx - 1] + counts[idx - 1]:
+                return None, shape, dtype
+        if offsets[0] + int(np.prod(shape)) * dtype.itemsize > len(self.map):
+            return None, shape, dtype
+
+        return offsets[0], shape, dtype
+
+
+    def map_stack(self):
+        """ Returns an array of shape (numPages, h, w) viewing all the pages, or
+        None if the pages differ in shape or dtype or are not equally spaced.
+        """
+
+        if len(set(self.shapes)) != 1 or len(set(self.dtypes)) != 1:
+            return None
+
+        stride = self.offsets[1] - self.offsets[0] if self.numPages > 1 else 1
+        if stride <= 0 or np.any(np.diff(self.offsets) != stride):
+            return None
+
+        dtype = self.dtypes[0]
+        shape = self.shapes[0]
+        pageStrides = tuple(int(np.prod(shape[idx + 1:])) * dtype.itemsize for idx in range(len(shape)))
+        return np.ndarray((self.numPages,) + shape, dtype = dtype, buffer = self.map,
+                          offset = self.offsets[0], strides = (stride,) + pageStrides)
+
+
+    def get_page(self, idx):
+        """ Returns page idx as a read-only array viewing the file. Raises
+        ValueError if the page cannot be memory-mapped.
+        """
+
+        if self.stack is not None:
+            return self.stack[idx]
+        if self.offsets[idx] is None:
+            raise ValueError(f"Page {idx} of {self.filename} cannot be memory-mapped.")
+        return np.ndarray(self.shapes[idx], dtype = self.dtypes[idx], buffer = self.map, offset = self.offsets[idx])
+
+
+    def get_stack(self):
+        """ Returns all the pages as an array of shape (numPages, h, w). This
+        is a view of the file if possible, otherwise a copy.
+        """
+
+        if self.stack is not None:
+            return self.stack
+        return np.stack([self.get_page(idx) for idx in range(self.numPages)])
+
+
+    def close(self):
+        """ Closes the file. Arrays already returned remain valid, since each
+        holds a reference to the memory map, which is therefore not closed
+        here but released once they are no longer used.
+        """
+        self.stack = None
+        self.map = None
+        self.file.close()
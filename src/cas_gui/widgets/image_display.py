@@ -25,6 +25,8 @@ import time
 
 import cv2 as cv
 
+from cas_gui.threads.display_render_thread import DisplayRenderThread
+
 class ImageDisplay(QLabel):
     
    ELLIPSE = 0
@@ -39,6 +41,7 @@ class ImageDisplay(QLabel):
     
    mouseMoved = pyqtSignal(int, int)
    roiChanged = pyqtSignal()  
+   imageRendered = pyqtSignal()
 
 
    imageSize = (0,0)
@@ -103,6 +106,17 @@ class ImageDisplay(QLabel):
    colortable = None
    roi = None
    
+   lut = None
+   lutKey = None
+   
+   decimateDisplay = True          # Decimate images larger than the widget before converting for display
+   autoscaleMaxPixels = 256 * 256  # Maximum number of pixels used for autoscale statistics, None for all
+   autoscalePercentiles = None     # e.g. (1, 99) to autoscale between these percentiles
+   autoscaleSmoothing = 0          # Weight of previous range in running autoscale estimate, 0 for none
+   autoscaleRange = None
+   cropShape = None
+   renderThread = None
+   
    lastFrameTime = 0
 
 
@@ -116,6 +130,7 @@ class ImageDisplay(QLabel):
 
        self.setMouseTracking(True)
        self.setCursor(Qt.CrossCursor)    
+       self.imageRendered.connect(self.show_latest_rendered_image)
        self.mouseX = 0
        self.mouseY = 0
        
@@ -273,42 +288,175 @@ class ImageDisplay(QLabel):
        if img is not None and np.size(img) > 0:           
            
            t1 = time.perf_counter()
-           if self.autoScale: #and np.max(img) != 0:
+           if self.autoScale:
+               lower, upper = self.get_autoscale_range(img)
+           else:
+               lower, upper = self.displayMin, self.displayMax
+           
+           # Only the part of the image being displayed is converted
+           scaledSize = QtCore.QSize(self.geometry().width(), self.geometry().height()-40)
+           self.render((self.MONO, self.zoom(img), lower, upper, self.autoScale, self.colortable, scaledSize))
+      
+       else:
+
+           self.pmap = None
+
+
+   def render_mono(self, img, lower, upper, autoScale, colortable, scaledSize):
+       """ Converts the part of a grayscale image being displayed to 8 bit and returns 
+       a tuple of the 8 bit image and a QImage scaled to `scaledSize`.
+       """
+       
+       # Conversion is at no more than the resolution of the screen
+       img = self.downscale(img, scaledSize)
+       
+       if img.dtype == np.uint8 or img.dtype == np.uint16:
+           
+           # 8 and 16 bit images are converted using a lookup table
+           lut = self.get_lut(np.iinfo(img.dtype).max + 1, math.floor(lower), math.ceil(upper))
+           if img.dtype == np.uint8:
+               displayImage = cv.LUT(np.ascontiguousarray(img), lut)
+           else:
+               displayImage = np.take(lut, img)
+           
+       else:
+           if autoScale: #and np.max(img) != 0:
                img = img.astype('float32')
-               img = img - np.min(img)
-               m = max(np.max(img), self.minAutoscaleUpper)
+               img = img - lower
+               m = upper - lower
                if m > 0:
                    sf =  255 / m
                else:
                    sf = 0
-               img = img * sf
+               img = np.clip(img * sf, 0, 255)
               
                #img = cv.normalize(img,0,255,cv.NORM_MINMAX)           
             
-           img = img.astype('uint8')
-           
-           
-           #if self.fixedView:
-           #    self.getView(img)
-               
-           #else:    
-           self.displayImage = self.zoom(img)          
-            
-           self.image = QtGui.QImage(self.displayImage.copy(), self.displayImage.shape[1], self.displayImage.shape[0], self.displayImage.shape[1], QtGui.QImage.Format_Indexed8)
-                      
-           # Set colormap
-           if self.colortable is not None:
-               self.image.setColorTable(self.colortable)
-           
-           scaledSize = QtCore.QSize(self.geometry().width(), self.geometry().height()-40)
-           self.pmap = QtGui.QPixmap.fromImage(self.image).scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
-           self.setPixmap(self.pmap)
-      
+           displayImage = np.ascontiguousarray(img.astype('uint8'))
+        
+       image = QtGui.QImage(displayImage, displayImage.shape[1], displayImage.shape[0], displayImage.shape[1], QtGui.QImage.Format_Indexed8)
+                  
+       # Set colormap
+       if colortable is not None:
+           image.setColorTable(colortable)
+       
+       return displayImage, image.scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
+   
+   
+   def render(self, job):
+       """ Renders an image for display, either immediately or by passing it to the 
+       render thread if it is enabled. `job` is a tuple of the image mode 
+       (MONO or RGB) followed by the arguments to render_mono or render_rgb.
+       """
+       if self.renderThread is not None:
+           self.renderThread.submit(job)
        else:
-
-           self.pmap = None
+           self.show_rendered_image(self.render_job(job))
+   
+   
+   def render_job(self, job):
+       """ Renders an image for display, see render().
+       """
+       if job[0] == self.MONO:
+           return self.render_mono(*job[1:])
+       else:
+           return self.render_rgb(*job[1:])
+       
+   
+   def show_rendered_image(self, rendered):
+       """ Shows a tuple of (8 bit image, scaled QImage) returned by render_mono or
+       render_rgb.
+       """
+       self.displayImage, self.image = rendered
+       self.pmap = QtGui.QPixmap.fromImage(self.image)
+       self.setPixmap(self.pmap)
+       
+       
+   def show_latest_rendered_image(self):
+       """ Shows the most recent image from the render thread, if there is one which
+       has not already been shown. Called when the render thread has rendered an image.
+       """
+       if self.renderThread is not None:
+           rendered = self.renderThread.get_latest()
+           if rendered is not None:
+               self.show_rendered_image(rendered)
+       
+       
+   def set_render_thread_enabled(self, enabled, metrics = None):
+       """ Sets whether images are rendered for display in a separate thread (True) or
+       in the GUI thread (False). When using the render thread, only the most recent 
+       image is rendered and shown, images arriving faster than this are dropped.
+       The render times and dropped images are recorded in the display stage of 
+       metrics (a PipelineMetrics), if provided.
+       """
+       if enabled and self.renderThread is None:
+           self.renderThread = DisplayRenderThread(self.render_job, callback = self.imageRendered.emit,
+                                                   metrics = metrics)
+           self.renderThread.start()
+       elif not enabled and self.renderThread is not None:
+           self.renderThread.stop()
+           self.renderThread = None
 
 
+   def get_autoscale_range(self, img):
+       """ Returns a tuple of (lower, upper), the range of pixel values to display 
+       when autoscaling. The statistics are calculated from a subsample of the image 
+       of at most `autoscaleMaxPixels` pixels. If `autoscalePercentiles` is a tuple 
+       of (low, high) percentiles, these are used rather than the minimum and 
+       maximum. If `autoscaleSmoothing` is greater than 0, the range is a running 
+       average over recent images, with this weight given to the previous range.
+       """
+       if self.autoscaleMaxPixels is not None and np.size(img) > self.autoscaleMaxPixels:
+           step = math.ceil(math.sqrt(np.size(img) / self.autoscaleMaxPixels))
+           img = img[::step, ::step]
+           
+       if self.autoscalePercentiles is not None:
+           lower, upper = np.percentile(img, self.autoscalePercentiles)
+       else:
+           lower, upper = np.min(img), np.max(img)
+       lower = float(lower)
+       upper = lower + max(float(upper) - lower, self.minAutoscaleUpper)
+       
+       if self.autoscaleSmoothing > 0 and self.autoscaleRange is not None:
+           lower = self.autoscaleSmoothing * self.autoscaleRange[0] + (1 - self.autoscaleSmoothing) * lower
+           upper = self.autoscaleSmoothing * self.autoscaleRange[1] + (1 - self.autoscaleSmoothing) * upper
+       self.autoscaleRange = (lower, upper)
+       
+       return lower, upper
+   
+   
+   def downscale(self, img, scaledSize):
+       """ Returns `img` decimated so that it is no larger than needed to fill 
+       `scaledSize`, if `decimateDisplay` is True. Otherwise returns `img`.
+       """
+       if self.decimateDisplay:
+           targetW = scaledSize.width()
+           targetH = scaledSize.height()
+           if targetW > 0 and targetH > 0:
+               step = int(min(img.shape[0] / targetH, img.shape[1] / targetW))
+               if step > 1:
+                   return img[::step, ::step]
+       return img
+   
+   
+   def get_lut(self, size, lower, upper):
+       """ Returns a lookup table of `size` entries which converts pixel values
+       to 8 bit values for display, with `lower` or below mapped to 0 and 
+       `upper` or above to 255. The table is only rebuilt when `size`, `lower`
+       or `upper` change.
+       """
+       key = (size, lower, upper)
+       if key != self.lutKey:
+           values = np.arange(size, dtype = 'float32') - lower
+           if upper > lower:
+               values = values * (255 / (upper - lower))
+           else:
+               values[:] = 0
+           self.lut = np.clip(values, 0, 255).astype('uint8')
+           self.lutKey = key
+       return self.lut
+   
+   
    def set_rgb_image(self, img):
        """ Sets a colour RGB image as the current image """
        
@@ -342,23 +490,25 @@ class ImageDisplay(QLabel):
            #     img = img - self.displayMin
            #     img = (img / self.displayMax * 255)
            
-           img = img.astype('uint8')
-
-           imgZoom = self.zoom(img)
-       
-           self.displayImage = np.empty((imgZoom.shape[0], imgZoom.shape[1], 4), np.uint8, 'C')       
-           self.displayImage[...,0] = imgZoom[...,2]
-           self.displayImage[...,1] = imgZoom[...,1]
-           self.displayImage[...,2] = imgZoom[...,0]
-           self.displayImage[...,3].fill(255)
-    
-           self.displayImage2 = self.displayImage.copy()
-           self.image = QtGui.QImage(self.displayImage2.copy(), self.displayImage.shape[1], self.displayImage.shape[0], QtGui.QImage.Format_RGB32)
            scaledSize = QtCore.QSize(self.geometry().width(), self.geometry().height()-40)
+           self.render((self.RGB, self.zoom(img), scaledSize))
+           
+           
+   def render_rgb(self, imgZoom, scaledSize):
+       """ Converts the part of a colour image being displayed to 8 bit and returns
+       a tuple of the 8 bit image and a QImage scaled to `scaledSize`.
+       """
+       imgZoom = self.downscale(imgZoom, scaledSize).astype('uint8')
+       
+       displayImage = np.empty((imgZoom.shape[0], imgZoom.shape[1], 4), np.uint8, 'C')       
+       displayImage[...,0] = imgZoom[...,2]
+       displayImage[...,1] = imgZoom[...,1]
+       displayImage[...,2] = imgZoom[...,0]
+       displayImage[...,3].fill(255)
 
-           self.pmap = QtGui.QPixmap.fromImage(self.image).scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
-    
-           self.setPixmap(self.pmap)
+       image = QtGui.QImage(displayImage, displayImage.shape[1], displayImage.shape[0], QtGui.QImage.Format_RGB32)
+
+       return displayImage, image.scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
        
        
        
@@ -419,7 +569,8 @@ class ImageDisplay(QLabel):
             self.displayW = img.shape[1]
             self.displayH = img.shape[0]
             zoomImage = img    
-               
+        
+        self.cropShape = np.shape(zoomImage)[0:2]       
         return zoomImage
     
    
@@ -434,8 +585,8 @@ class ImageDisplay(QLabel):
            return None, None
        else:
            xOffset, yOffset = self.screen_offsets()
-           screenX = round((x - self.displayX) * (self.pmap.width()) / np.shape(self.displayImage)[1] + xOffset)
-           screenY = round((y - self.displayY) * (self.pmap.height()) / np.shape(self.displayImage)[0] + yOffset)
+           screenX = round((x - self.displayX) * (self.pmap.width()) / self.cropShape[1] + xOffset)
+           screenY = round((y - self.displayY) * (self.pmap.height()) / self.cropShape[0] + yOffset)
            return screenX, screenY
        
        
@@ -446,8 +597,8 @@ class ImageDisplay(QLabel):
            return None, None
        else:
            xOffset, yOffset = self.screen_offsets()
-           imageX = math.floor( (x - xOffset) / (self.pmap.width()) * np.shape(self.displayImage)[1] + self.displayX)
-           imageY = math.floor( (y - yOffset) / (self.pmap.height()) * np.shape(self.displayImage)[0] + self.displayY)
+           imageX = math.floor( (x - xOffset) / (self.pmap.width()) * self.cropShape[1] + self.displayX)
+           imageY = math.floor( (y - yOffset) / (self.pmap.height()) * self.cropShape[0] + self.displayY)
            return imageX, imageY
    
         
@@ -458,8 +609,8 @@ class ImageDisplay(QLabel):
            return None, None
        else:
            xOffset, yOffset = self.screen_offsets()
-           imageX = round( (x - xOffset) / (self.pmap.width()) * np.shape(self.displayImage)[1] + self.displayX)
-           imageY = round( (y - yOffset) / (self.pmap.height()) * np.shape(self.displayImage)[0] + self.displayY)
+           imageX = round( (x - xOffset) / (self.pmap.width()) * self.cropShape[1] + self.displayX)
+           imageY = round( (y - yOffset) / (self.pmap.height()) * self.cropShape[0] + self.displayY)
            return int(imageX), int(imageY)
        
   
@@ -477,8 +628,8 @@ class ImageDisplay(QLabel):
            
    def screen_dims(self, x,y):       
            """ Convert image dimensions to screen dimensions """
-           screenX = round(x * (self.pmap.width()) / np.shape(self.displayImage)[1])
-           screenY = round(y * (self.pmap.height()) / np.shape(self.displayImage)[0])               
+           screenX = round(x * (self.pmap.width()) / self.cropShape[1])
+           screenY = round(y * (self.pmap.height()) / self.cropShape[0])               
            return int(screenX), int(screenY)
        
         
@@ -852,8 +1003,8 @@ class ImageDisplay(QLabel):
        
        
    def set_display_range(self, lower, upper):
-       """ Sets the intensity range used for display if set_auto_scale is False. Pixels
-       of 'lower' or below will be mapped to 0, 'upper' and above to 255.
+       """ Sets the intensity range used for display of 8 and 16 bit images if set_auto_scale 
+       is False. Pixels of 'lower' or below will be mapped to 0, 'upper' and above to 255.
        """
        self.displayMin = lower
        self.displayMax = upper